@@ -0,0 +1,323 @@
+"""A local stand-in for the OpenAI API, for benchmarks and tests without network.
+
+It serves the chat completions (streaming, tool calls), embeddings and speech endpoints,
+with a configurable first token delay and generation speed.
+
+    python -m gptui.benchmark.fake_openai_server --port 8000 --tokens-per-second 50
+"""
+from __future__ import annotations
+import argparse
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+import wave
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+_WORDS = (
+    "the model streams tokens to the terminal while the user waits for the answer and every chunk "
+    "goes through the handlers the dispatcher and the display before it reaches the screen"
+).split()
+
+_CODE_BLOCK = [
+    "\n\n```python\n",
+    "def fibonacci(n: int) -> int:\n",
+    "    a, b = 0, 1\n",
+    "    for _ in range(n):\n",
+    "        a, b = b, a + b\n",
+    "    return a\n",
+    "```\n\n",
+]
+
+
+@dataclass
+class FakeServerOptions:
+    tokens_per_second: float = 0.0  # 0 for as fast as possible.
+    first_token_delay: float = 0.0  # Seconds before the first chunk.
+    completion_tokens: int = 200  # Tokens of a generated reply.
+    chunk_tokens: int = 1  # Tokens per streamed chunk.
+    code_blocks: bool = True  # Put a code block in the middle of a reply.
+    tool_calls: bool = False  # Reply with a call of the first tool, if the request has tools and the last message is not a tool reply.
+    tool_arguments: str = "{}"
+    embedding_dimensions: int = 1536
+    stalls: int = 0  # The number of streams, from the first one, which stall.
+    stall_after: int = 10  # The chunks sent by a stalling stream before it stalls.
+    stall_seconds: float = 30.0
+
+
+def reply_tokens(options: FakeServerOptions, seed: str = "") -> list[str]:
+    "The deterministic tokens of a generated reply, roughly one word each."
+    rng = random.Random(seed)
+    tokens = [(" " if i else "") + rng.choice(_WORDS) for i in range(options.completion_tokens)]
+    if options.code_blocks and options.completion_tokens >= 2 * len(_CODE_BLOCK):
+        middle = len(tokens) // 2
+        tokens[middle:middle + len(_CODE_BLOCK)] = _CODE_BLOCK
+    return tokens
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeOpenAIHTTPServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json({"object": "list", "data": [{"id": "gpt-4", "object": "model", "created": 0, "owned_by": "gptui"}]})
+        else:
+            self._send_json({"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json({"error": {"message": "Invalid JSON body.", "type": "invalid_request_error"}}, status=400)
+            return
+        self.server.requests.append({"path": self.path, "body": body})
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/chat/completions"):
+            self._chat_completions(body)
+        elif path.endswith("/embeddings"):
+            self._embeddings(body)
+        elif path.endswith("/audio/speech"):
+            self._speech(body)
+        else:
+            self._send_json({"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}}, status=404)
+
+    def _headers(self) -> dict:
+        return {
+            "x-ratelimit-limit-requests": "1000000",
+            "x-ratelimit-limit-tokens": "100000000",
+            "x-ratelimit-remaining-requests": "999999",
+            "x-ratelimit-remaining-tokens": "99999999",
+        }
+
+    def _send_json(self, data: dict, status: int = 200) -> None:
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in self._headers().items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _tool_call(self, body: dict) -> dict | None:
+        options = self.server.options
+        tools = body.get("tools")
+        messages = body.get("messages") or []
+        if not (options.tool_calls and tools) or (messages and messages[-1].get("role") == "tool"):
+            return None
+        return {"id": "call_0", "type": "function", "function": {"name": tools[0]["function"]["name"], "arguments": options.tool_arguments}}
+
+    def _chat_completions(self, body: dict) -> None:
+        options = self.server.options
+        model = body.get("model", "gpt-4")
+        tool_call = self._tool_call(body)
+        tokens = reply_tokens(options, seed=json.dumps(body.get("messages"), sort_keys=True))
+        prompt_tokens = len(json.dumps(body.get("messages", [])).split())
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens)}
+        if not body.get("stream"):
+            time.sleep(options.first_token_delay + (len(tokens) / options.tokens_per_second if options.tokens_per_second else 0))
+            message = {"role": "assistant", "content": None if tool_call else "".join(tokens)}
+            if tool_call:
+                message["tool_calls"] = [tool_call]
+            self._send_json(
+                {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_call else "stop"}],
+                    "usage": usage,
+                }
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in self._headers().items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        created = int(time.time())
+
+        def chunk(delta: dict, finish_reason: str | None = None) -> dict:
+            return {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+
+        if tool_call:
+            arguments = tool_call["function"]["arguments"]
+            pieces = [arguments[i:i + 8] for i in range(0, len(arguments), 8)] or [""]
+            deltas = [{"role": "assistant", "content": None, "tool_calls": [{"index": 0, "id": tool_call["id"], "type": "function", "function": {"name": tool_call["function"]["name"], "arguments": ""}}]}]
+            deltas += [{"tool_calls": [{"index": 0, "function": {"arguments": piece}}]} for piece in pieces]
+            finish_reason = "tool_calls"
+        else:
+            step = max(options.chunk_tokens, 1)
+            deltas = [{"role": "assistant", "content": ""}]
+            deltas += [{"content": "".join(tokens[i:i + step])} for i in range(0, len(tokens), step)]
+            finish_reason = "stop"
+
+        with self.server.lock:
+            stall = self.server.stalls_done < options.stalls
+            self.server.stalls_done += stall
+        interval = options.chunk_tokens / options.tokens_per_second if options.tokens_per_second else 0
+        start = time.monotonic() + options.first_token_delay
+        try:
+            for i, delta in enumerate(deltas):
+                # Paced against the start, so that the speed does not drift with the time spent writing.
+                delay = start + i * interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                if stall and i == options.stall_after:
+                    time.sleep(options.stall_seconds)
+                    self.close_connection = True
+                    return
+                self._write_event(json.dumps(chunk(delta)))
+            self._write_event(json.dumps(chunk({}, finish_reason)))
+            self._write_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def _write_event(self, data: str) -> None:
+        event = f"data: {data}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(event):x}\r\n".encode("ascii") + event + b"\r\n")
+        self.wfile.flush()
+
+    def _embeddings(self, body: dict) -> None:
+        inputs = body.get("input", "")
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        dimensions = body.get("dimensions") or self.server.options.embedding_dimensions
+        data = []
+        for index, text in enumerate(inputs):
+            # The same text always gets the same vector.
+            rng = random.Random(hashlib.sha256(str(text).encode("utf-8")).digest())
+            data.append({"object": "embedding", "index": index, "embedding": [rng.uniform(-1, 1) for _ in range(dimensions)]})
+        tokens_num = sum(len(str(text).split()) for text in inputs)
+        self._send_json(
+            {
+                "object": "list",
+                "data": data,
+                "model": body.get("model", "text-embedding-ada-002"),
+                "usage": {"prompt_tokens": tokens_num, "total_tokens": tokens_num},
+            }
+        )
+
+    def _speech(self, body: dict) -> None:
+        # A short silence, whatever the requested format.
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(8000)
+            wav.writeframes(b"\x00\x00" * 800)
+        audio = buffer.getvalue()
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/wav")
+        self.send_header("Content-Length", str(len(audio)))
+        self.end_headers()
+        self.wfile.write(audio)
+
+
+class FakeOpenAIHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], options: FakeServerOptions):
+        super().__init__(address, _Handler)
+        self.options = options
+        self.requests: list[dict] = []
+        self.lock = threading.Lock()
+        self.stalls_done = 0
+
+
+class FakeOpenAIServer:
+    """Run the fake OpenAI API in a background thread.
+
+    with FakeOpenAIServer(FakeServerOptions(tokens_per_second=50)) as server:
+        client = OpenAI(api_key="fake", base_url=server.base_url)
+    """
+
+    def __init__(self, options: FakeServerOptions | None = None, host: str = "127.0.0.1", port: int = 0):
+        self.options = options or FakeServerOptions()
+        self.httpd = FakeOpenAIHTTPServer((host, port), self.options)
+        self._thread: threading.Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def requests(self) -> list[dict]:
+        "The bodies of the requests received, with their paths."
+        return self.httpd.requests
+
+    def start(self) -> FakeOpenAIServer:
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> FakeOpenAIServer:
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def serve_in_process(options: FakeServerOptions, address_queue) -> None:
+    "Serve until killed, putting the base url into the queue. It is the target of a separate process."
+    server = FakeOpenAIServer(options)
+    address_queue.put(server.base_url)
+    server.httpd.serve_forever()
+
+
+def main(argv: list[str] | None = None) -> None:
+    defaults = FakeServerOptions()
+    parser = argparse.ArgumentParser(description="A local stand-in for the OpenAI API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    for name, value in asdict(defaults).items():
+        flag = "--" + name.replace("_", "-")
+        if isinstance(value, bool):
+            parser.add_argument(flag, action=argparse.BooleanOptionalAction, default=value)
+        else:
+            parser.add_argument(flag, type=type(value), default=value)
+    args = parser.parse_args(argv)
+    options = FakeServerOptions(**{name: getattr(args, name) for name in asdict(defaults)})
+    server = FakeOpenAIServer(options, host=args.host, port=args.port)
+    print(f"Fake OpenAI API serving at {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
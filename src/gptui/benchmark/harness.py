@@ -0,0 +1,329 @@
+"""The end-to-end benchmark of a streamed chat response, 'gptui-bench'.
+
+It drives OpenaiChat.chat_stream -> ResponseHandler -> ChatResponse.stream_display headlessly,
+with the real commander, handlers and decorator, against the fake OpenAI server in a separate process,
+so that its CPU and memory are not counted. It runs offline.
+
+    gptui-bench --runs 5 --tokens-per-second 200 --first-token-delay 0.1 --max-chunk-overhead-ms 5
+"""
+from __future__ import annotations
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from types import SimpleNamespace
+
+from .fake_openai_server import FakeServerOptions, serve_in_process
+
+
+@dataclass
+class RunResult:
+    chunks: int = 0  # The content chunks streamed by the server.
+    display_batches: int = 0  # The displays of content, fewer than the chunks if they are coalesced.
+    first_token_latency: float = 0.0  # Seconds from sending to displaying the first content.
+    first_token_overhead: float = 0.0  # The first token latency beyond the delay of the server.
+    chunk_overhead: float = 0.0  # Seconds per chunk spent beyond the pacing of the server.
+    display_times: list[float] = field(default_factory=list)
+    cpu_per_1k_tokens: float = 0.0  # CPU seconds of this process per 1000 completion tokens.
+
+
+def content_chunks(options: FakeServerOptions) -> int:
+    "The chunks with content in a reply of the fake server, after the first one which carries the role only."
+    return math.ceil(options.completion_tokens / max(options.chunk_tokens, 1))
+
+
+def use_offline_tokenizer() -> bool:
+    """Count tokens with a byte level encoding if the tiktoken encodings can not be loaded, e.g. in an offline CI.
+    Return True if it is used.
+    """
+    import tiktoken
+
+    try:
+        tiktoken.encoding_for_model("gpt-4")
+        return False
+    except Exception:
+        pass
+    encoding = tiktoken.Encoding(
+        name="offline_bytes",
+        pat_str=r"\S+|\s+",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={},
+    )
+    tiktoken.encoding_for_model = lambda model: encoding
+    tiktoken.get_encoding = lambda name: encoding
+    return True
+
+
+def peak_rss_mb() -> float | None:
+    "The peak resident set size of this process in MB, None if it is unknown on the platform."
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # In bytes on macOS, in kilobytes elsewhere.
+    return max_rss / (1024 * 1024) if sys.platform == "darwin" else max_rss / 1024
+
+
+class _Widget(SimpleNamespace):
+    pass
+
+
+class _ChatRegion:
+    "Collect the lines written by ChatResponse, in place of the chat window."
+
+    def __init__(self, width: int):
+        self.content_size = SimpleNamespace(width=width)
+        self.lines: list = []
+
+    def write_lines(self, lines) -> None:
+        self.lines.extend(lines)
+
+    def right_pop_lines(self, num: int = 1, refresh: bool = True) -> None:
+        if num > 0:
+            del self.lines[-num:]
+
+
+class _MainScreen:
+    def __init__(self, width: int):
+        self.widgets = {
+            "#chat_region": _ChatRegion(width),
+            "#chat_tabs": _Widget(active_tab=_Widget(id="lqt1")),
+            "#file_wrap_display": _Widget(value=False),
+        }
+
+    def query_one(self, selector: str):
+        return self.widgets[selector]
+
+
+class HeadlessApp:
+    "The parts of MainApp used by the response pipeline, displaying into a chat region in memory."
+
+    def __init__(self, width: int = 100):
+        from ..controllers.decorate_display_control import DecorateDisplay
+        from ..views.tui import MainApp
+
+        self.main_screen = _MainScreen(width)
+        self.decorate_display = DecorateDisplay(self)
+        self.drivers = _Widget(copy_code=lambda content: None)
+        self._main_app = MainApp
+
+    def decorator(self, *args, **kwargs):
+        return self._main_app.decorator(self, *args, **kwargs)
+
+    def decorate_content(self, *args, **kwargs):
+        return self._main_app.decorate_content(self, *args, **kwargs)
+
+    def message_frame(self, *args, **kwargs):
+        return self._main_app.message_frame(self, *args, **kwargs)
+
+
+class Bench:
+    def __init__(self, base_url: str, server_options: FakeServerOptions, async_client: bool = False, width: int = 100):
+        from ..controllers.chat_response_control import ChatResponse
+        from ..gptui_kernel.manager import Manager
+        from ..models.openai_chat import AsyncOpenaiChat, OpenaiChat
+        from ..models.signals import response_to_user_message_stream_signal
+
+        self.server_options = server_options
+        self._dot_env_dir = tempfile.TemporaryDirectory()
+        dot_env_path = os.path.join(self._dot_env_dir.name, ".env")
+        with open(dot_env_path, "w") as f:
+            f.write("OPENAI_API_KEY=fake\n")
+        # The openai clients take the base url from the environment.
+        os.environ["OPENAI_BASE_URL"] = base_url
+
+        self.app = HeadlessApp(width=width)
+        self.manager = Manager(self.app, dot_env_config_path=dot_env_path)
+        commander = self.manager.gk_kernel.commander
+        self._commander_thread = threading.Thread(target=commander.run, daemon=True)
+        self._commander_thread.start()
+        self.manager.register_jobs(module_name="gptui.models.jobs")
+        self.manager.register_handlers(module_name="gptui.models.handlers")
+        self.openai_chat = AsyncOpenaiChat(self.manager) if async_client else OpenaiChat(self.manager)
+
+        self.chat_response = ChatResponse(self.app)
+        self._display = self.chat_response.stream_display
+        self.chat_response.stream_display = self._timed_stream_display
+        self._end = threading.Event()
+        self._first_content_at: float | None = None
+        self._display_times: list[float] = []
+        self._display_batches = 0
+        # Connected after ChatResponse, so the end is seen after it has been displayed.
+        response_to_user_message_stream_signal.connect(self._on_response)
+
+    def _timed_stream_display(self, message: dict, *args, **kwargs) -> None:
+        start = time.perf_counter()
+        self._display(message, *args, **kwargs)
+        self._display_times.append(time.perf_counter() - start)
+        if message["flag"] == "content" and message["content"]["content"]:
+            self._display_batches += 1
+            if self._first_content_at is None:
+                self._first_content_at = time.perf_counter()
+
+    def _on_response(self, sender, **kwargs) -> None:
+        if kwargs["message"]["flag"] == "end":
+            self._end.set()
+
+    def wait_ready(self, timeout: float = 10) -> None:
+        deadline = time.monotonic() + timeout
+        while not self.manager.gk_kernel.commander.running_status:
+            if time.monotonic() > deadline:
+                raise TimeoutError("The commander did not start.")
+            time.sleep(0.01)
+
+    def run_once(self, model: str = "gpt-4", timeout: float = 120) -> RunResult:
+        from ..models.context import OpenaiContext
+
+        context = OpenaiContext(
+            chat_context=[],
+            id=1,
+            parameters={"model": model, "stream": True},
+            max_sending_tokens_num=4000,
+            chat_context_saver="inner",
+            chat_context_saver_for_sending="inner",
+        )
+        self._end.clear()
+        self._first_content_at = None
+        self._display_times = []
+        self._display_batches = 0
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        self.openai_chat.chat_stream(context, {"role": "user", "content": "Tell me a story with some code."})
+        if not self._end.wait(timeout):
+            raise TimeoutError(f"No complete response within {timeout}s.")
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+
+        options = self.server_options
+        # The pacing is that of the chunks sent, which the displays may coalesce into fewer batches.
+        chunks = max(content_chunks(options), 1)
+        interval = options.chunk_tokens / options.tokens_per_second if options.tokens_per_second else 0
+        # The first chunk carries the role only, the content chunks follow one interval after another.
+        pacing = options.first_token_delay + chunks * interval
+        first_token_latency = (self._first_content_at or time.perf_counter()) - start
+        return RunResult(
+            chunks=content_chunks(options),
+            display_batches=self._display_batches,
+            first_token_latency=first_token_latency,
+            first_token_overhead=first_token_latency - options.first_token_delay - interval,
+            chunk_overhead=max(elapsed - pacing, 0.0) / chunks,
+            display_times=self._display_times,
+            cpu_per_1k_tokens=cpu / max(options.completion_tokens, 1) * 1000,
+        )
+
+    def close(self) -> None:
+        self.manager.gk_kernel.commander.exit()
+        self._dot_env_dir.cleanup()
+
+
+def summarize(results: list[RunResult]) -> dict:
+    "The medians over the runs, except for the display times which are pooled."
+    display_times = sorted(t for result in results for t in result.display_times)
+    # The nearest rank, the smallest time which is not less than 95% of the times.
+    p95_index = max(math.ceil(len(display_times) * 0.95) - 1, 0)
+    return {
+        "runs": len(results),
+        "chunks": results[0].chunks if results else 0,
+        "display_batches": statistics.median(r.display_batches for r in results) if results else 0,
+        "first_token_latency_ms": statistics.median(r.first_token_latency for r in results) * 1000,
+        "first_token_overhead_ms": statistics.median(r.first_token_overhead for r in results) * 1000,
+        "chunk_overhead_ms": statistics.median(r.chunk_overhead for r in results) * 1000,
+        "display_mean_ms": statistics.fmean(display_times) * 1000 if display_times else 0.0,
+        "display_p95_ms": display_times[p95_index] * 1000 if display_times else 0.0,
+        "cpu_per_1k_tokens_s": statistics.median(r.cpu_per_1k_tokens for r in results),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def check_thresholds(summary: dict, args: argparse.Namespace) -> list[str]:
+    "The metrics beyond their thresholds."
+    failures = []
+    for key, threshold in (
+        ("first_token_overhead_ms", args.max_first_token_overhead_ms),
+        ("chunk_overhead_ms", args.max_chunk_overhead_ms),
+        ("cpu_per_1k_tokens_s", args.max_cpu_per_1k),
+        ("peak_rss_mb", args.max_rss_mb),
+    ):
+        value = summary.get(key)
+        if threshold is not None and value is not None and value > threshold:
+            failures.append(f"{key} {value:.3f} > {threshold}")
+    return failures
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="gptui-bench", description="Benchmark the streamed chat response pipeline offline.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1, help="Runs before the measured runs.")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="The generation speed of the fake server, 0 for as fast as possible.")
+    parser.add_argument("--first-token-delay", type=float, default=0.0)
+    parser.add_argument("--completion-tokens", type=int, default=500)
+    parser.add_argument("--chunk-tokens", type=int, default=1)
+    parser.add_argument("--async-client", action="store_true", help="Use AsyncOpenaiChat instead of OpenaiChat.")
+    parser.add_argument("--width", type=int, default=100, help="The width of the chat window.")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    parser.add_argument("--max-first-token-overhead-ms", type=float)
+    parser.add_argument("--max-chunk-overhead-ms", type=float)
+    parser.add_argument("--max-cpu-per-1k", type=float, help="CPU seconds per 1000 tokens.")
+    parser.add_argument("--max-rss-mb", type=float)
+    args = parser.parse_args(argv)
+
+    server_options = FakeServerOptions(
+        tokens_per_second=args.tokens_per_second,
+        first_token_delay=args.first_token_delay,
+        completion_tokens=args.completion_tokens,
+        chunk_tokens=args.chunk_tokens,
+    )
+    offline_tokenizer = use_offline_tokenizer()
+    context = multiprocessing.get_context("spawn")
+    address_queue = context.Queue()
+    server_process = context.Process(target=serve_in_process, args=(server_options, address_queue), daemon=True)
+    server_process.start()
+    bench = None
+    try:
+        base_url = address_queue.get(timeout=30)
+        bench = Bench(base_url, server_options, async_client=args.async_client, width=args.width)
+        bench.wait_ready()
+        for _ in range(args.warmup):
+            bench.run_once()
+        results = [bench.run_once() for _ in range(args.runs)]
+    finally:
+        if bench is not None:
+            bench.close()
+        server_process.terminate()
+        server_process.join()
+
+    summary = summarize(results)
+    summary["client"] = "async" if args.async_client else "sync"
+    summary["offline_tokenizer"] = offline_tokenizer
+    summary["server"] = asdict(server_options)
+    failures = check_thresholds(summary, args)
+    summary["failures"] = failures
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(f"client:                 {summary['client']}")
+        print(f"runs x chunks:          {summary['runs']} x {summary['chunks']}")
+        print(f"first token latency:    {summary['first_token_latency_ms']:.2f} ms")
+        print(f"first token overhead:   {summary['first_token_overhead_ms']:.2f} ms")
+        print(f"overhead per chunk:     {summary['chunk_overhead_ms']:.3f} ms")
+        print(f"display batches:        {summary['display_batches']:g}")
+        print(f"display per batch:      {summary['display_mean_ms']:.3f} ms (p95 {summary['display_p95_ms']:.3f} ms)")
+        print(f"CPU per 1k tokens:      {summary['cpu_per_1k_tokens_s']:.3f} s")
+        if summary["peak_rss_mb"] is not None:
+            print(f"peak RSS:               {summary['peak_rss_mb']:.1f} MB")
+        for failure in failures:
+            print(f"FAILED: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""The micro-benchmark of highlighting code blocks, the direct Pygments to Rich formatter against the ANSI round trip.
+
+It highlights large source files, by default some of the standard library, both ways and checks that they render the same,
+text and styles.
+
+    python -m gptui.benchmark.highlight_bench --repeat 5 path/to/file.py
+"""
+from __future__ import annotations
+import argparse
+import inspect
+import io
+import json
+import os
+import time
+
+from pygments import highlight
+from pygments.formatters import TerminalTrueColorFormatter
+from pygments.lexers import get_lexer_for_filename
+from pygments.util import ClassNotFound
+from rich.console import Console
+
+from ..controllers.decorate_display_control import highlight_to_text
+from ..utils.my_text import MyText as Text
+
+
+def ansi_round_trip(code: str, lexer, style: str = "material") -> Text:
+    "The former way: code to an ANSI string with TerminalTrueColorFormatter, parsed back into a Text."
+    return Text.from_ansi(highlight(code, lexer, TerminalTrueColorFormatter(style=style)))
+
+
+def render(text: Text) -> str:
+    "The text rendered with its styles, as ANSI escape codes, so that two texts styled differently do not compare equal."
+    console = Console(color_system="truecolor", width=120, record=True, file=io.StringIO())
+    console.print(text, soft_wrap=True)
+    return console.export_text(styles=True)
+
+
+def default_sources() -> list[str]:
+    import typing
+    import unittest.case
+
+    return [inspect.getsourcefile(module) for module in (argparse, typing, unittest.case)]
+
+
+def best_time(func, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_file(path: str, repeat: int, style: str = "material") -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        code = f.read().strip()
+    try:
+        lexer = get_lexer_for_filename(path)
+    except ClassNotFound:
+        return {"file": path, "skipped": "no lexer"}
+    round_trip = best_time(lambda: ansi_round_trip(code, lexer, style), repeat)
+    direct = best_time(lambda: highlight_to_text(code, lexer, style), repeat)
+    same = render(ansi_round_trip(code, lexer, style)) == render(highlight_to_text(code, lexer, style))
+    return {
+        "file": os.path.basename(path),
+        "lines": code.count("\n") + 1,
+        "ansi_round_trip_ms": round_trip * 1000,
+        "direct_ms": direct * 1000,
+        "speedup": round_trip / direct if direct else None,
+        "same_text": same,
+    }
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark highlighting code blocks into Rich text.")
+    parser.add_argument("files", nargs="*", help="Source files to highlight, some large modules of the standard library by default.")
+    parser.add_argument("--repeat", type=int, default=5, help="The best of this many runs is reported.")
+    parser.add_argument("--style", default="material")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    args = parser.parse_args(argv)
+
+    results = [bench_file(path, args.repeat, args.style) for path in args.files or default_sources()]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        if "skipped" in result:
+            print(f"{result['file']}: skipped, {result['skipped']}")
+            continue
+        print(
+            f"{result['file']} ({result['lines']} lines): "
+            f"ANSI round trip {result['ansi_round_trip_ms']:.1f} ms, direct {result['direct_ms']:.1f} ms, "
+            f"{result['speedup']:.2f}x{'' if result['same_text'] else ', THE TEXTS DIFFER'}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,5 @@
 import logging
 
-from .dash_board_control import DashBoard
 from ..models.signals import chat_context_extend_signal, chat_context_extend_for_sending_signal
 from ..views.common_message import CommonMessage
 
@@ -10,7 +9,8 @@ gptui_logger = logging.getLogger("gptui_logger")
 class ChatContextControl:
     def __init__(self, app):
         self.app = app
-        self.dash_board = DashBoard(app)
+        # Shared with the app, so that the dashboard is redrawn with what it displayed last.
+        self.dash_board = app.dash_board
         self.chat_context_to_vectorize_buffer = {}
         chat_context_extend_signal.connect(self.chat_context_extend)
         chat_context_extend_for_sending_signal.connect(self.chat_context_extend_for_sending)
@@ -1,8 +1,8 @@
 import logging
 import threading
 
+from .decorate_display_control import IncrementalDecorator
 from ..utils.my_text import MyText as Text
-from ..utils.my_text import MyLines as Lines
 from ..models.signals import response_to_user_message_stream_signal, response_auxiliary_message_signal
 
 
@@ -42,7 +42,7 @@ class ChatResponse:
         if context_id not in self.buffer:
             self.buffer[context_id] = {
                 "chat_stream_content": {"role": "assistant", "content": ""},
-                "decorate_chat_stream_content_lines": Lines(),
+                "decorate_chat_stream_content_lines": IncrementalDecorator(self.app),
                 "last_tab_id": tab_id,
             }
         buffer_context = self.buffer[context_id]
@@ -51,19 +51,16 @@ class ChatResponse:
         if message["flag"] == "content":
             # This condition being met indicates that the currently generated content corresponds with the active tab window,
             # and it is not the first time being displayed.
-            if context_id == tab_id == buffer_context["last_tab_id"]:
-                length = len(buffer_context["decorate_chat_stream_content_lines"])
-                self.chat_region.right_pop_lines(length, refresh=False)
+            displayed = context_id == tab_id == buffer_context["last_tab_id"]
             chat_stream_content["content"] += char
             if context_id == tab_id:
-                buffer_context["decorate_chat_stream_content_lines"] = self.app.decorator(chat_stream_content, stream, copy_code)
-                self.chat_region.write_lines(buffer_context["decorate_chat_stream_content_lines"])
+                self.write_stream_lines(buffer_context["decorate_chat_stream_content_lines"], chat_stream_content, displayed, stream, copy_code)
         elif message["flag"] == "end":
             if context_id == tab_id:
                 self.stream_display(message={"content": {"content": "", "context_id": context_id}, "flag": "content"}, stream=False, copy_code=True)
                 self.chat_region.write_lines([Text()])
             chat_stream_content["content"] = ""
-            buffer_context["decorate_chat_stream_content_lines"] = Lines()
+            buffer_context["decorate_chat_stream_content_lines"].reset()
         buffer_context["last_tab_id"] = tab_id
 
     def handle_group_talk_response(self, sender, **kwargs):
@@ -84,7 +81,7 @@ class ChatResponse:
         if group_talk_manager_id not in self.buffer:
             self.buffer[group_talk_manager_id] = {
                 "group_talk_chat_stream_content": {"role": "assistant", "name": "", "content": ""},
-                "group_talk_decorate_chat_stream_content_lines": Lines(),
+                "group_talk_decorate_chat_stream_content_lines": IncrementalDecorator(self.app),
                 "last_tab_id": tab_id,
             }
         buffer_context = self.buffer[group_talk_manager_id]
@@ -94,17 +91,30 @@ class ChatResponse:
         if message["flag"] == "content":
             # This condition being met indicates that the currently generated content corresponds with the active tab window,
             # and it is not the first time being displayed.
-            if group_talk_manager_id == tab_id == buffer_context["last_tab_id"]:
-                length = len(buffer_context["group_talk_decorate_chat_stream_content_lines"])
-                self.chat_region.right_pop_lines(length, refresh=False)
+            displayed = group_talk_manager_id == tab_id == buffer_context["last_tab_id"]
             group_talk_chat_stream_content["content"] += char
-            buffer_context["group_talk_decorate_chat_stream_content_lines"] = self.app.decorator(group_talk_chat_stream_content, stream, copy_code)
             if group_talk_manager_id == tab_id:
-                self.chat_region.write_lines(buffer_context["group_talk_decorate_chat_stream_content_lines"])
+                self.write_stream_lines(buffer_context["group_talk_decorate_chat_stream_content_lines"], group_talk_chat_stream_content, displayed, stream, copy_code)
         elif message["flag"] == "end":
             if group_talk_manager_id == tab_id:
                 self.group_talk_stream_display(message={"content": {"role": "assistant", "name": message_dict["name"], "content": "", "group_talk_manager_id": group_talk_manager_id}, "flag": "content"}, stream=False, copy_code=True)
                 self.chat_region.write_lines([Text()])
             group_talk_chat_stream_content["content"] = ""
-            buffer_context["group_talk_decorate_chat_stream_content_lines"] = Lines()
+            buffer_context["group_talk_decorate_chat_stream_content_lines"].reset()
         buffer_context["last_tab_id"] = tab_id
+
+    def write_stream_lines(self, decoration: IncrementalDecorator, piece: dict, displayed: bool, stream: bool, copy_code: bool) -> None:
+        """Display the message being streamed in place of its previous lines, which are displayed if displayed is True.
+        While streaming, only the lines which changed are written again. The last display decorates the message as a whole.
+        """
+        if stream:
+            remove_num, new_lines = decoration.update(piece)
+            if not displayed:
+                remove_num, new_lines = 0, decoration.lines()
+        else:
+            remove_num = decoration.line_count if displayed else 0
+            new_lines = self.app.decorator(piece, stream, copy_code)
+            decoration.reset()
+            decoration.line_count = len(new_lines)
+        self.chat_region.right_pop_lines(remove_num, refresh=False)
+        self.chat_region.write_lines(new_lines)
@@ -2,12 +2,16 @@ import bisect
 import math
 
 from ..models.context import OpenaiContext
+from ..models.openai_tokens_truncate import prefix_cache_tracker
+from ..models.stream_limiter import stream_limiter
 from ..utils.my_text import MyText as Text
 
 
 class DashBoard:
     def __init__(self, app):
         self.app = app
+        self._last_display: tuple[int, OpenaiContext] | None = None
+        self._queue_rows_shown: list[str] = []
 
     def dash_board_display(self, tokens_num_window: int, conversation_id: int | None = None):
         "Display the token's monitor in dashboard"
@@ -26,6 +30,30 @@ class DashBoard:
             first_role = roles[0]
             self.display(tokens_num_window=tokens_num_window, openai_context=first_role.context)
 
+    def queue_rows(self) -> list[Text]:
+        "The rows at the top of the dashboard showing the waiting streams and the longest wait, if any stream is waiting."
+        info = stream_limiter.info()
+        if not info["waiting"]:
+            return []
+        return [
+            Text(f"Q{min(info['waiting'], 99):<2}", "yellow"),
+            Text(f"{min(round(info['longest_wait']), 99):>2}s", "yellow"),
+        ]
+
+    def prefix_cache_rows(self, openai_context: OpenaiContext) -> list[Text]:
+        "The row showing the expected prompt prefix cache hit of the last request, if its history was truncated."
+        fraction = prefix_cache_tracker.cached_prefix_fraction(openai_context.id, truncated_only=True)
+        if fraction is None:
+            return []
+        return [Text(f"{min(round(fraction * 100), 99):>2}%", "cyan")]
+
+    def queue_refresh(self):
+        "Redraw the dashboard if the rows of the stream queue have changed."
+        if self._last_display is None:
+            return
+        if [str(row) for row in self.queue_rows()] != self._queue_rows_shown:
+            self.display(*self._last_display)
+
     def display(self, tokens_num_window: int, openai_context: OpenaiContext):
         "Display the token's monitor in dashboard"
         
@@ -44,12 +72,18 @@ class DashBoard:
         if tokens_num_window == 0:
             display.update(Text("ಠ_ಠ\n" * height, "yellow"))
             return
+
+        self._last_display = (tokens_num_window, openai_context)
+        queue_rows = self.queue_rows()
+        self._queue_rows_shown = [str(row) for row in queue_rows]
+        top_rows = queue_rows + self.prefix_cache_rows(openai_context)
+        height = max(height - len(top_rows), 1)
         
         tokens_num = openai_context.tokens_num
         assert tokens_num is not None
-        tokens_num_list = openai_context.tokens_num_list
+        tokens_num_index = openai_context.tokens_num_index
         bead_index_list = openai_context.bead_info["positions"]
-        bead_tokens_list = [sum(tokens_num_list[:index]) for index in bead_index_list]
+        bead_tokens_list = [tokens_num_index.prefix_sum(index) for index in bead_index_list]
         bead_length_list = openai_context.bead_info["lengths"]
 
         tokens_proportion = tokens_num / tokens_num_window
@@ -114,6 +148,8 @@ class DashBoard:
                 else:
                     indicator_content_right.append(Text("-", "green"))
         indicator_content = Text('')
+        for row in top_rows:
+            indicator_content = indicator_content + row + Text('\n')
 
         for i in range(height):
             indicator_content = indicator_content + indicator_content_left[i] + indicator_content_middle[i] + indicator_content_middle[i] + Text('\n')
@@ -1,14 +1,20 @@
-import copy
+import itertools
 import logging
 import re
 import os
-from typing import Self
+import threading
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from typing import Callable, Iterable, NamedTuple, Self
 
-from pygments import highlight
+from pygments.lexer import Lexer
 from pygments.lexers import get_lexer_by_name, ClassNotFound
-from pygments.formatters import TerminalTrueColorFormatter
+from pygments.styles import get_style_by_name
+from pygments.token import _TokenType
+from rich.color import Color
 from rich.console import Console
 from rich.style import Style
+from rich.text import Span
 
 from ..views.theme import theme_color as tc
 from ..utils.file_icon import file_icon
@@ -22,10 +28,12 @@ gptui_logger = logging.getLogger("gptui_logger")
 class DecorateDisplay:
     def __init__(self, app):
         self.app = app
-        self.code_block_list = []
-        self.chain_lines: Lines | None = None
-        self.chain_length_list: list | None = None
-        self.chain_max_width: int | None = None
+        # The code blocks to be copied by their indexes, which are never reused, so that a stale index copies nothing.
+        self.code_blocks: dict[int, str] = {}
+        self.code_block_index_dict: dict[str, int] = {}
+        self._code_block_counter = itertools.count()
+        # The indexes handed out since the chat window was last cleared, they may be on the screen.
+        self.code_block_pinned: set[int] = set()
     
     def pre_wrap_and_highlight(
         self,
@@ -33,6 +41,7 @@ class DecorateDisplay:
         stream: bool = False,
         copy_code: bool = False,
         wrap: dict | None = None,
+        code_blocks: list[int] | None = None,
     ) -> Text:
         """Wrap and highlight a string that might contain a file.
 
@@ -75,6 +84,7 @@ class DecorateDisplay:
                     wrap (bool): Whether wrap file content into a file icon.
                     wrap_num (int): Icon numbers in each line.
                 words_color: Specify the color of the text, excluding the file icons.
+            code_blocks: If it is a list, the indexes of the code blocks to be copied are appended to it.
             
         Example:
             wrap={"file_wrap": {"wrap: True", "wrap_num": 4}, "words_color": "white"}
@@ -86,7 +96,7 @@ class DecorateDisplay:
         wrap_num = file_wrap["wrap_num"]
         words_color = wrap.get("words_color", tc("white") or "white")
         if wrap_bool is True:
-            out = self.wrap_files_in_string(extract_files_from_string(inp_string), wrap_num=wrap_num, stream=stream, copy_code=copy_code, words_color=words_color)
+            out = self.wrap_files_in_string(extract_files_from_string(inp_string), wrap_num=wrap_num, stream=stream, copy_code=copy_code, words_color=words_color, code_blocks=code_blocks)
             return out
         else:
             file_start_flag = "******************** FILE CONTENT BEGIN ********************"
@@ -97,19 +107,19 @@ class DecorateDisplay:
                 file_start = inp_string.find(file_start_flag, start)
                 if file_start == -1:
                     # This is content after 'file_end_flag' or there is no file block
-                    out_string_list.append(self.highlight_code_block_from_plain_text(inp_string[start:], stream=stream, copy_code=copy_code, words_color=words_color))
+                    out_string_list.append(self.highlight_code_block_from_plain_text(inp_string[start:], stream=stream, copy_code=copy_code, words_color=words_color, code_blocks=code_blocks))
                     break
                 # This is content before file begin
-                out_string_list.append(self.highlight_code_block_from_plain_text(inp_string[start:file_start], stream=stream, copy_code=copy_code, words_color=words_color))
+                out_string_list.append(self.highlight_code_block_from_plain_text(inp_string[start:file_start], stream=stream, copy_code=copy_code, words_color=words_color, code_blocks=code_blocks))
                 # file begin flag
                 out_string_list.append(Text(file_start_flag, tc("cyan") or "cyan"))
                 start = file_start + len(file_start_flag)
                 file_end = inp_string.find(file_end_flag, start)
                 if file_end == -1:
-                    out_string_list.append(self.highlight_code_block_from_plain_text(inp_string[start:], stream=stream, copy_code=copy_code, words_color=words_color))
+                    out_string_list.append(self.highlight_code_block_from_plain_text(inp_string[start:], stream=stream, copy_code=copy_code, words_color=words_color, code_blocks=code_blocks))
                     break
                 # content in file block
-                out_string_list.append(self.highlight_code_block_from_plain_text(inp_string[start:file_end], stream=stream, copy_code=copy_code, words_color=words_color))
+                out_string_list.append(self.highlight_code_block_from_plain_text(inp_string[start:file_end], stream=stream, copy_code=copy_code, words_color=words_color, code_blocks=code_blocks))
                 # file finish flag
                 out_string_list.append(Text(file_end_flag, tc("cyan") or "cyan"))
                 start = file_end + len(file_end_flag)
@@ -124,6 +134,7 @@ class DecorateDisplay:
         stream: bool = False,
         copy_code: bool = False,
         words_color: str | None = None,
+        code_blocks: list[int] | None = None,
     ) -> Text:
         """Translate the content within the string to the corresponding file icon.
         
@@ -134,6 +145,7 @@ class DecorateDisplay:
             copy_code:
                 Switch in highlight_code_block_from_plain_text.
             words_color: Specify the color of the text outside of files.
+            code_blocks: Switch in highlight_code_block_from_plain_text.
         """
         words_color = words_color or tc("white") or "white"
         part_list = []
@@ -150,7 +162,7 @@ class DecorateDisplay:
         for part in string_data:
             if isinstance(part, str):
                 if part:
-                    part_list.append(self.highlight_code_block_from_plain_text(part, stream=stream, copy_code=copy_code, words_color=words_color))
+                    part_list.append(self.highlight_code_block_from_plain_text(part, stream=stream, copy_code=copy_code, words_color=words_color, code_blocks=code_blocks))
             else:
                 files_icon = []
                 for file_name in part:
@@ -171,6 +183,7 @@ class DecorateDisplay:
         stream: bool = False,
         copy_code: bool = False,
         words_color: str | None = None,
+        code_blocks: list[int] | None = None,
     ) -> Text:
         words_color = words_color or tc("white") or "white"
         output_text = Text()
@@ -197,33 +210,22 @@ class DecorateDisplay:
             output_text.append_text(Text(inp_string[:code_start], words_color))
             # Extract the language specifier.
             lang = inp_string[code_start+3:lang_end].strip()
-            # Try to get a Pygments lexer for this language.
-            try:
-                lexer = get_lexer_by_name(lang)
-            except ClassNotFound:
-                # If the language is not found, no lexer is available.
-                lexer = None
+            # Try to get a Pygments lexer for this language, it is None if the language is not found.
+            lexer = lexer_by_name(lang)
             # If a lexer is found, highlight the code block.
             if lexer is not None:
                 # language name display
                 lang_display = ' ' + lang + ' '
                 lang_display_text = Text(lang_display.upper(), f"reverse italic bold {tc('white') or 'white'}")
+                # Extract the code from the code block.
+                code = inp_string[lang_end+1:code_end].strip()
                 if copy_code:
-                    action_string = f"app.copy_code({len(self.code_block_list)})"
+                    action_string = f"app.copy_code({self.code_block_index(code, code_blocks)})"
                     lang_display_text.on(click=action_string)
                 output_text.append_text(lang_display_text + Text('\n'))
 
-                # Create a formatter with a specific style.
-                formatter = TerminalTrueColorFormatter(style="material")
-                # Extract the code from the code block.
-                code = inp_string[lang_end+1:code_end].strip()
-                # Use Pygments to highlight the code, which will return an ANSI string.
-                ansi_text = highlight(code, lexer, formatter)
-                # Create a Text object from the ANSI string and append it to the output text.
-                output_text.append_text(Text.from_ansi(ansi_text))
-                # add the code to code_block_list to be copied
-                if copy_code:
-                    self.code_block_list.append(code)
+                # Highlight the code, or get it from the cache if it has been highlighted before, and append it to the output text.
+                output_text.append_text(highlight_cache.highlight(code, lang, lexer))
             # If no lexer is found, append the unhighlighted code block to the output text.
             else:
                 output_text.append_text(Text(inp_string[code_start:code_end], words_color))
@@ -232,17 +234,17 @@ class DecorateDisplay:
         
         return output_text
 
-    def text_to_lines_chain(self, inp: Text, container_width: int) -> Self:
+    def text_to_lines_chain(self, inp: Text, container_width: int) -> "DecorateChain":
         """Convert the Text object into a Lines object.
         
-        This operation is a chainable operation.
+        This operation starts a new chain.
         
         Args:
             inp: The Text object that needs to be converted.
             container_width: Specify the width of the display area.
 
         Returns:
-            Self
+            DecorateChain
         """
         console = Console()
         total_lines = Lines()
@@ -252,20 +254,17 @@ class DecorateDisplay:
             total_lines.extend(lin)
         length_list = list(map(lambda line: line.cell_len, total_lines))
         max_width = max(length_list)
-        self.chain_lines = total_lines
-        self.chain_length_list = length_list
-        self.chain_max_width = max_width
-        return self
+        return DecorateChain(total_lines, length_list, max_width)
 
     def background_chain(
         self,
         inp: Text,
         container_width: int,
         background_color = None
-    ) -> Self:
+    ) -> "DecorateChain":
         """Add a background color to the specified content.
 
-        This operation is a chainable operation.
+        This operation starts a new chain.
         
         Args:
             inp: The content that needs background color.
@@ -273,7 +272,7 @@ class DecorateDisplay:
             background_color: Specify the color.
         
         Returns:
-            Self
+            DecorateChain
         """
         console = Console()
         total_lines = Lines()
@@ -289,10 +288,88 @@ class DecorateDisplay:
             if background_color:
                 line.stylize(Style(bgcolor=background_color))
             out.append(line)
-        self.chain_lines = out
-        self.chain_length_list = length_list
-        self.chain_max_width = max_width
-        return self
+        return DecorateChain(out, length_list, max_width)
+
+    def indicator(self, inp: Text, displayer_width: int, indicator_color: str) -> Lines:
+        """Add an indicator to the left of the given Text.
+
+        The indicator occupies the width of three characters,
+        and the text content will be displayed with a width of displayer_width-3.
+        Any part exceeding this width will be automatically folded.
+
+        Args:
+            inp: Content that requires an indicator.
+            displayer_width: The width of the displayer.
+            indicator_color: Specify the indicator color.
+
+        Returns:
+            Line object.
+        """
+        console = Console()
+        total_lines = Lines()
+        lines = inp.split(allow_blank=True)
+        for line in lines:
+            lin = line.wrap(console=console, width=displayer_width-3, overflow="fold", no_wrap=False)
+            total_lines.extend(lin)
+        first_time = True
+        out = Lines()
+        for line in total_lines:
+            if first_time:
+                out.append(Text(u'\u251c'+u'\u2500'+' ', indicator_color).append_text(line))
+                first_time = False
+            else:
+                out.append(Text(u'\u2502' + '  ', indicator_color).append_text(line))
+        return out
+
+    def action_copy_code(self, index: int) -> None:
+        content = self.code_blocks.get(index)
+        if content is None:
+            gptui_logger.warning(f"The code block {index} to be copied has been released.")
+            return
+        self.app.drivers.copy_code(content)
+
+    def code_block_index(self, code: str, code_blocks: list[int] | None = None) -> int:
+        """The index of the code in code_blocks, it is added if it is not there.
+        The same code gets the same index, as a message is decorated again each time it comes into view.
+        If code_blocks is a list, the index is appended to it.
+        """
+        index = self.code_block_index_dict.get(code)
+        if index is None:
+            index = next(self._code_block_counter)
+            self.code_blocks[index] = code
+            self.code_block_index_dict[code] = index
+        self.code_block_pinned.add(index)
+        if code_blocks is not None:
+            code_blocks.append(index)
+        return index
+
+    def pin_code_blocks(self, indexes: Iterable[int]) -> None:
+        "The code blocks are shown again, e.g. by lines from rendered_lines_cache."
+        self.code_block_pinned.update(indexes)
+
+    def release_code_blocks(self, indexes: Iterable[int]) -> None:
+        "Drop the code blocks which are no longer referenced by cached lines, unless they may be on the screen."
+        for index in indexes:
+            if index not in self.code_block_pinned and (code := self.code_blocks.pop(index, None)) is not None:
+                del self.code_block_index_dict[code]
+
+    def clear_code_block(self, keep: Iterable[int] = ()) -> None:
+        "Drop the code blocks when the chat window is cleared, except those kept, e.g. referenced by cached lines."
+        keep = set(keep)
+        self.code_blocks = {index: code for index, code in self.code_blocks.items() if index in keep}
+        self.code_block_index_dict = {code: index for index, code in self.code_blocks.items()}
+        self.code_block_pinned = set()
+
+
+class DecorateChain:
+    """The lines being decorated by a chain of operations, such as background_chain().panel_chain().indicator_chain().
+
+    Every chain has its own state, so that messages can be decorated on different threads at the same time.
+    """
+    def __init__(self, chain_lines: Lines, chain_length_list: list, chain_max_width: int):
+        self.chain_lines = chain_lines
+        self.chain_length_list = chain_length_list
+        self.chain_max_width = chain_max_width
 
     def panel_chain(
         self,
@@ -331,9 +408,6 @@ class DecorateDisplay:
             Self
         """
         out = Lines()
-        assert self.chain_lines is not None, "self.chain_lines can not be None"
-        assert self.chain_length_list is not None, "self.chain_length_list can not be None"
-        assert self.chain_max_width is not None, "self.chain_max_width can not be None"
         max_width = self.chain_max_width
         if line_type == 0:
             horizental = u'\u2500' * max_width
@@ -381,9 +455,6 @@ class DecorateDisplay:
         """
         first_time = True
         out = Lines()
-        assert self.chain_lines is not None, "self.chain_lines can not be None"
-        assert self.chain_length_list is not None, "self.chain_length_list can not be None"
-        assert self.chain_max_width is not None, "self.chain_max_width can not be None"
         for line in self.chain_lines:
             if first_time:
                 out.append(Text(u'\u251c'+u'\u2500'+' ', indicator_color).append_text(line))
@@ -394,51 +465,258 @@ class DecorateDisplay:
         self.chain_length_list = [length + 3 for length in self.chain_length_list]
         self.chain_max_width += 3
         return self
-    
-    def indicator(self, inp: Text, displayer_width: int, indicator_color: str) -> Lines:
-        """Add an indicator to the left of the given Text.
 
-        The indicator occupies the width of three characters,
-        and the text content will be displayed with a width of displayer_width-3.
-        Any part exceeding this width will be automatically folded.
 
-        Args:
-            inp: Content that requires an indicator.
-            displayer_width: The width of the displayer.
-            indicator_color: Specify the indicator color.
+@lru_cache(maxsize=128)
+def lexer_by_name(lang: str) -> Lexer | None:
+    "The Pygments lexer of the language, created once and shared, or None if the language is not found."
+    try:
+        return get_lexer_by_name(lang)
+    except ClassNotFound:
+        return None
 
-        Returns:
-            Line object.
-        """
-        console = Console()
-        total_lines = Lines()
-        lines = inp.split(allow_blank=True)
-        for line in lines:
-            lin = line.wrap(console=console, width=displayer_width-3, overflow="fold", no_wrap=False)
-            total_lines.extend(lin)
-        first_time = True
-        out = Lines()
-        for line in total_lines:
-            if first_time:
-                out.append(Text(u'\u251c'+u'\u2500'+' ', indicator_color).append_text(line))
-                first_time = False
-            else:
-                out.append(Text(u'\u2502' + '  ', indicator_color).append_text(line))
-        return out
 
-    def action_copy_code(self, index: int) -> None:
-        content = self.code_block_list[index]
-        self.app.drivers.copy_code(content)
+class TokenStyle(NamedTuple):
+    "What the escape sequences of TerminalTrueColorFormatter around a token do to the style of Text.from_ansi."
+    on: Style  # Added to the current style for the token.
+    off: Style  # Added to the current style after the token, to reset its colors to the default.
+    reset: bool  # The style is reset entirely after the token, as it is bold, italic or underlined.
 
-    def clear_code_block(self) -> None:
-        self.code_block_list = []
 
-    def get_and_reset_chain(self) -> dict:
-        result = {"lines": copy.copy(self.chain_lines), "length_list": copy.copy(self.chain_length_list), "max_width": self.chain_max_width}
-        self.chain_lines = None
-        self.chain_length_list = None
-        self.chain_max_width = None
-        return result
+@lru_cache(maxsize=8)
+def rich_styles(style: str) -> dict[_TokenType, TokenStyle]:
+    """The styles of the Pygments token types in the Pygments style, as TerminalTrueColorFormatter writes them.
+    A token type without a style of its own gets the style of its closest parent in highlight_to_text.
+    """
+    def rgb(color: str) -> Color | None:
+        # Not a hex color, e.g. an ansi color name, is ignored by the formatter.
+        try:
+            value = int(color, 16)
+        except ValueError:
+            return None
+        return Color.from_rgb((value >> 16) & 0xff, (value >> 8) & 0xff, value & 0xff)
+
+    styles = {}
+    for token_type, definition in get_style_by_name(style):
+        color = rgb(definition["color"]) if definition["color"] else None
+        bgcolor = rgb(definition["bgcolor"]) if definition["bgcolor"] else None
+        bold = bool(definition["bold"])
+        italic = bool(definition["italic"])
+        underline = bool(definition["underline"])
+        styles[token_type] = TokenStyle(
+            on=Style(color=color, bgcolor=bgcolor, bold=bold or None, italic=italic or None, underline=underline or None),
+            off=Style(color="default" if color else None, bgcolor="default" if bgcolor else None),
+            reset=bold or italic or underline,
+        )
+    return styles
+
+
+_UNSTYLED = TokenStyle(on=Style.null(), off=Style.null(), reset=False)
+
+
+def highlight_to_text(code: str, lexer: Lexer, style: str = "material") -> Text:
+    """Highlight the code with Pygments into a Text, mapping the token types straight to Rich styles.
+    It is the same as Text.from_ansi(pygments.highlight(code, lexer, TerminalTrueColorFormatter(style=style))),
+    without going through the ANSI string, for any Pygments style. As in Text.from_ansi, a token also gets
+    what the reset after the previous token left, e.g. the default color.
+    """
+    styles = rich_styles(style)
+    parts = []
+    spans = []
+    position = 0
+    current = Style.null()
+    # The end of the last line written without escape sequences, the next one is a part of the same span.
+    bare_end = -1
+    # The style of a line and the style after it, by the style before it and the style of its token, which are few.
+    transitions = {}
+    for token_type, value in lexer.get_tokens(code):
+        if token_type not in styles:
+            # Resolved once, the styles are shared by all the code of the style.
+            parent = token_type.parent
+            while parent is not None and parent not in styles:
+                parent = parent.parent
+            styles[token_type] = styles[parent] if parent is not None else _UNSTYLED
+        token_style = styles[token_type]
+        bare = not token_style.on and not token_style.off
+        # The formatter writes every line of the token between its escape sequences, the newlines are left out.
+        start = position
+        for line in value.split("\n") if "\n" in value else (value,):
+            if line:
+                transition = transitions.get((current, token_style))
+                if transition is None:
+                    after = Style.null() if token_style.reset else current + token_style.off
+                    transition = transitions[(current, token_style)] = (current + token_style.on, after)
+                line_style, after = transition
+                if line_style:
+                    if bare and bare_end == start:
+                        spans[-1] = Span(spans[-1].start, start + len(line), line_style)
+                    else:
+                        spans.append(Span(start, start + len(line), line_style))
+                bare_end = start + len(line) if bare else -1
+                current = after
+            start += len(line) + 1
+        parts.append(value)
+        position += len(value)
+    plain = "".join(parts)
+    # The lexer ends the code with a newline, which is not part of the highlighted text.
+    if plain.endswith("\n"):
+        plain = plain[:-1]
+        spans = [span if span.end <= len(plain) else Span(span.start, len(plain), span.style) for span in spans if span.start < len(plain)]
+    return Text(plain, spans=spans)
+
+
+class HighlightCache:
+    """A bounded LRU cache of highlighted code blocks keyed by (language, style, code hash),
+    so that displaying a conversation again, e.g. when switching tabs or resizing the window, does not lex its code blocks again.
+
+    The cached Text objects are shared and must not be modified.
+    """
+
+    def __init__(self, maxsize: int = 512, style: str = "material"):
+        self.maxsize = maxsize
+        self.style = style
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[tuple[str, str, int, int], Text] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def highlight(self, code: str, lang: str, lexer: Lexer) -> Text:
+        "Return the code highlighted with the lexer of the language."
+        key = (lang, self.style, len(code), hash(code))
+        with self._lock:
+            text = self._cache.get(key)
+            if text is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return text
+        text = highlight_to_text(code, lexer, style=self.style)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = text
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return text
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+highlight_cache = HighlightCache()
+
+
+class RenderedLines(NamedTuple):
+    lines: Lines
+    code_blocks: tuple[int, ...]  # The indexes of the code blocks to be copied, in DecorateDisplay, which the lines refer to.
+
+
+class RenderedLinesCache:
+    """A LRU cache of the decorated lines of the messages of conversations,
+    keyed by (conversation, message index, content width, theme, file wrap),
+    so that switching back to a conversation does not decorate its history again.
+
+    It is bounded by the total number of lines, which is what its memory grows with.
+    An entry holds the message it was decorated from and is dropped when the message at its index has changed,
+    the entries of a conversation, of a theme or of the other widths are dropped with the invalidate methods.
+    The code blocks referred to by the dropped entries, and by no other entry, are passed to on_release.
+    The cached Lines objects are shared and must not be modified.
+    """
+
+    def __init__(self, max_lines: int = 50000, on_release: Callable[[Iterable[int]], None] | None = None):
+        self.max_lines = max_lines
+        self.on_release = on_release
+        self.hits = 0
+        self.misses = 0
+        self._lines_num = 0
+        self._cache: OrderedDict[tuple[str, int, int, str, bool], tuple[tuple, RenderedLines]] = OrderedDict()
+        self._code_block_refs: Counter[int] = Counter()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _message(piece: dict) -> tuple:
+        return (piece["role"], piece.get("name"), piece["content"])
+
+    def get(self, key: tuple[str, int, int, str, bool], piece: dict) -> RenderedLines | None:
+        "The lines of the message decorated before, None if it was not or if it has changed since."
+        released = []
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                message, rendered = entry
+                if message == self._message(piece):
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return rendered
+                self._pop(key, released)
+            self.misses += 1
+        self._release(released)
+        return None
+
+    def put(self, key: tuple[str, int, int, str, bool], piece: dict, lines: Lines, code_blocks: Iterable[int] = ()) -> None:
+        released = []
+        with self._lock:
+            if key in self._cache:
+                self._pop(key, released)
+            rendered = RenderedLines(lines, tuple(code_blocks))
+            self._cache[key] = (self._message(piece), rendered)
+            self._lines_num += len(lines)
+            self._code_block_refs.update(rendered.code_blocks)
+            while self._lines_num > self.max_lines and len(self._cache) > 1:
+                self._pop(next(iter(self._cache)), released)
+        self._release(released)
+
+    def _pop(self, key, released: list[int]) -> None:
+        _, rendered = self._cache.pop(key)
+        self._lines_num -= len(rendered.lines)
+        for index in rendered.code_blocks:
+            self._code_block_refs[index] -= 1
+            if self._code_block_refs[index] <= 0:
+                del self._code_block_refs[index]
+                released.append(index)
+
+    def _release(self, released: list[int]) -> None:
+        if released and self.on_release is not None:
+            self.on_release(released)
+
+    def _invalidate(self, predicate) -> None:
+        released = []
+        with self._lock:
+            for key in [key for key in self._cache if predicate(key)]:
+                self._pop(key, released)
+        self._release(released)
+
+    def invalidate_conversation(self, conversation: str) -> None:
+        "Drop the messages of the conversation, e.g. when it is closed."
+        self._invalidate(lambda key: key[0] == conversation)
+
+    def invalidate_theme(self, theme: str) -> None:
+        "Drop the messages decorated with the colors of the theme."
+        self._invalidate(lambda key: key[3] == theme)
+
+    def invalidate_width(self, keep: int) -> None:
+        "Drop the messages decorated for any width but the one kept, when the chat window is resized."
+        self._invalidate(lambda key: key[2] != keep)
+
+    def code_blocks(self) -> set[int]:
+        "The code blocks referred to by the cached lines."
+        with self._lock:
+            return set(self._code_block_refs)
+
+    @property
+    def lines_num(self) -> int:
+        return self._lines_num
+
+    def clear(self) -> None:
+        self._invalidate(lambda key: True)
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+rendered_lines_cache = RenderedLinesCache()
 
 
 def extract_files_from_string(inp_string: str) -> list:
@@ -466,3 +744,125 @@ def extract_files_from_string(inp_string: str) -> list:
             result.append(block)
     
     return result
+
+
+FILE_BEGIN_FLAG = "******************** FILE CONTENT BEGIN ********************"
+FILE_FINISH_FLAG = "******************** FILE CONTENT FINISH *******************"
+
+
+class IncrementalDecorator:
+    """Decorate a message while it is streamed, the way app.decorator does, in time linear in the length of the message.
+
+    The content is settled up to the last line which ends outside of code and file blocks. The settled lines are decorated
+    once and kept, only the unfinished trailing block is decorated again on each update. The frame of the settled lines
+    is rebuilt only when the message gets wider. The last display of a message should go through app.decorator,
+    which decorates it as a whole and sets up copy_code.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.console = Console()
+        self.reset()
+
+    def reset(self) -> None:
+        self.key = None
+        self.scanned = 0  # content[:scanned] is made of complete lines.
+        self.fences = 0  # The "```" in content[:scanned].
+        self.in_file = False
+        self.pending = 0  # The end of the last line, to be settled if the next line is not a file flag.
+        self.settled = 0  # content[:settled] is decorated into settled_lines.
+        self.settled_lines = Lines()
+        self.settled_widths: list[int] = []
+        self.settled_max_width = 0
+        self.max_width = 0
+        self.framed = Lines()  # The name, the top border and the settled lines, in the frame.
+        self.tail = Lines()  # The trailing block and the bottom border, in the frame.
+        self.line_count = 0  # The lines given out by the last update.
+
+    def lines(self) -> Lines:
+        "All the lines of the message as last updated."
+        return Lines([*self.framed, *self.tail])
+
+    def update(self, piece: dict, stream: bool = True, emoji: bool = True) -> tuple[int, Lines]:
+        """Decorate the message again after its content has grown.
+
+        Return the number of lines to remove from the end of the lines given out so far, and the lines to append.
+        """
+        content = piece["content"]
+        displayer = self.app.main_screen.query_one("#chat_region")
+        wrap_file = self.app.main_screen.query_one("#file_wrap_display").value
+        key = (piece["role"], piece.get("name"), displayer.content_size.width, wrap_file, stream, emoji)
+        remove_num = self.line_count
+        if key != self.key or len(content) < self.scanned:
+            self.reset()
+            self.key = key
+        width = displayer.content_size.width - 5
+        color, role_display = self.app.message_frame(piece["role"], piece.get("name"))
+
+        settle_to = self.settled
+        if (end := content.rfind("\n", self.scanned) + 1) > self.scanned:
+            position = self.scanned
+            for line in content[self.scanned:end - 1].split("\n"):
+                position += len(line) + 1
+                self.fences += line.count("```")
+                begin, finish = line.rfind(FILE_BEGIN_FLAG), line.rfind(FILE_FINISH_FLAG)
+                if begin != finish:
+                    self.in_file = begin > finish
+                # Wrapped into icons, a file block is joined to the lines next to it, which are not settled apart from it.
+                flagged = wrap_file and begin != finish
+                if self.pending and not flagged:
+                    settle_to = self.pending
+                self.pending = 0
+                if self.fences % 2 == 0 and not self.in_file and not flagged:
+                    if wrap_file:
+                        self.pending = position
+                    else:
+                        settle_to = position
+            self.scanned = end
+        new_settled = Lines()
+        new_settled_widths = []
+        if settle_to > self.settled:
+            # The newline which ends the settled content separates it from the rest.
+            new_settled = self._wrap(self.app.decorate_content(content[self.settled:settle_to - 1], stream=stream, copy_code=False, emoji=emoji), width)
+            new_settled_widths = [line.cell_len for line in new_settled]
+            self.settled_lines.extend(new_settled)
+            self.settled_widths.extend(new_settled_widths)
+            self.settled_max_width = max([self.settled_max_width, *new_settled_widths])
+            self.settled = settle_to
+        tail_lines = self._wrap(self.app.decorate_content(content[self.settled:], stream=stream, copy_code=False, emoji=emoji), width)
+        tail_widths = [line.cell_len for line in tail_lines]
+
+        max_width = max([self.settled_max_width, *tail_widths])
+        if max_width != self.max_width or not self.framed:
+            self.max_width = max_width
+            self.framed = Lines(self._indicate(line, color, first=(i == 0)) for i, line in enumerate([*role_display, self._border("╭", "╮", color)]))
+            self.framed.extend(self._row(line, line_width, color) for line, line_width in zip(self.settled_lines, self.settled_widths))
+            new_lines = Lines(self.framed)
+        else:
+            remove_num -= len(self.framed)
+            new_lines = Lines(self._row(line, line_width, color) for line, line_width in zip(new_settled, new_settled_widths))
+            self.framed.extend(new_lines)
+        self.tail = Lines(self._row(line, line_width, color) for line, line_width in zip(tail_lines, tail_widths))
+        self.tail.append(self._indicate(self._border("╰", "╯", color), color))
+        new_lines.extend(self.tail)
+        self.line_count = len(self.framed) + len(self.tail)
+        return remove_num, new_lines
+
+    def _wrap(self, inp: Text, width: int) -> Lines:
+        # The same wrapping as DecorateDisplay.background_chain.
+        total_lines = Lines()
+        for line in inp.split(allow_blank=True):
+            total_lines.extend(line.wrap(console=self.console, width=width, overflow="fold", no_wrap=False))
+        return total_lines
+
+    def _border(self, left: str, right: str, color: str) -> Text:
+        return Text(left + "-" * self.max_width + right, color)
+
+    def _row(self, line: Text, line_width: int, color: str) -> Text:
+        # The same frame as DecorateChain.panel_chain with line_type 3.
+        return self._indicate(Text("┆", color) + line + Text(" " * (self.max_width - line_width)) + Text("┆", color), color)
+
+    @staticmethod
+    def _indicate(line: Text, color: str, first: bool = False) -> Text:
+        # The same indicator as DecorateChain.indicator_chain.
+        return Text("├" + "─" + " " if first else "│" + "  ", color).append_text(line)
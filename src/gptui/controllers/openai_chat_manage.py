@@ -4,7 +4,9 @@ import logging
 import math
 import os
 import random
+import threading
 import time
+from concurrent.futures import Future
 from dataclasses import asdict
 from typing import Literal, Generator, Iterable
 
@@ -14,11 +16,12 @@ from semantic_kernel.connectors.ai.open_ai import OpenAITextEmbedding
 
 from .ai_care_sensors import time_now
 from ..gptui_kernel.manager import ManagerInterface
-from ..models.blinker_wrapper import async_wrapper_with_loop, async_wrapper_without_loop
-from ..models.context import BeadOpenaiContext, OpenaiContext
+from ..models.blinker_wrapper import async_wrapper_with_loop, async_wrapper_without_loop, async_wrapper_deferred, event_loop_bridge
+from ..models.context import BeadOpenaiContext, OpenaiContext, prefill_tokens_num
 from ..models.jobs import GroupTalkManager
 from ..models.openai_chat import OpenaiChatInterface, OpenAIGroupTalk
 from ..models.openai_chat_inner_service import chat_service_for_inner
+from ..models.request_scheduler import RequestPriority
 from ..models.signals import (
     notification_signal,
     response_to_user_message_stream_signal,
@@ -95,6 +98,7 @@ class OpenaiChatManage:
                     for key, value in old_conversation_dict.items():
                         # rebuild OpenaiContext
                         openai_context_build = value["openai_context"]
+                        tokens_num_state = value.pop("tokens_num", None)
                         # retrieve plugins list
                         openai_context_build["plugins"] = plugins_from_name(
                             manager=manager,
@@ -102,11 +106,14 @@ class OpenaiChatManage:
                             plugins_name_list=conversation_plugins_dict[key],
                         )
                         value["openai_context"] = BeadOpenaiContext(**openai_context_build)
+                        # Trust the persisted tokens num to avoid re-tokenizing unchanged history.
+                        value["openai_context"].load_tokens_num_state(tokens_num_state)
                         # convert id to int
                         new_conversation_dict[int(key)] = value
                         self.conversation_id_set.add(int(key))
                     self.conversation_dict = new_conversation_dict
                     self.conversation_active = int(conversation_cache["conversation_active"])
+                self.prefill_tokens_num_in_background([value["openai_context"] for value in self.conversation_dict.values()])
             except Exception as e:
                 text = Text(f"{type(e).__name__}    " + "Read conversation cache failed, opened a new conversation.", "red")
                 app.post_message(AnimationRequest(
@@ -137,6 +144,18 @@ class OpenaiChatManage:
         self.ai_care_depth_default = app.config["tui_config"]["ai_care_depth"]
         self.ai_care_depth: int = self.ai_care_depth_default
 
+    def prefill_tokens_num_in_background(self, contexts: list[OpenaiContext]) -> threading.Thread:
+        "Count the tokens num of the loaded contexts in a background thread, so the UI does not wait for it."
+        def prefill():
+            try:
+                prefill_tokens_num(contexts)
+            except Exception as e:
+                # The tokens num will be counted lazily on first access.
+                gptui_logger.warning(f"Prefill tokens num failed. Error: {e}")
+        thread = threading.Thread(target=prefill, daemon=True)
+        thread.start()
+        return thread
+
     def reset_ai_care_depth(self):
         if self.ai_care_depth_default <= 1:
             self.ai_care_depth = self.ai_care_depth_default
@@ -303,6 +322,8 @@ class OpenaiChatManage:
         # Do not save plugins information
         # Clear the plugin list to avoid errors, because when the plugin list contains a Manager object, 'asdict' will raise an error.
         conversation["openai_context"].plugins = []
+        # Save the tokens num tagged with the encoding name, so that loading does not need to re-tokenize.
+        conversation["tokens_num"] = conversation["openai_context"].tokens_num_state()
         # Replace openai_context object with dict version for serialization
         conversation["openai_context"] = asdict(conversation["openai_context"])
         
@@ -354,7 +375,9 @@ class OpenaiChatManage:
                 return False, e
             else:
                 openai_context_build = conversation["openai_context"]
+                tokens_num_state = conversation.pop("tokens_num", None)
                 openai_context = BeadOpenaiContext(**openai_context_build)
+                openai_context.load_tokens_num_state(tokens_num_state)
                 openai_parameters = openai_context.parameters
                 model = openai_parameters.get("model")
                 if model is None:
@@ -366,6 +389,7 @@ class OpenaiChatManage:
                 conversation["openai_context"] = openai_context
                 self.conversation_dict[id] = conversation
                 self.conversation_active = id
+                self.prefill_tokens_num_in_background([openai_context])
                 return True, id
 
     def get_file_id_and_save(self, conversation_id: int, input_dialog_prompt: str | None = None) -> None:
@@ -510,6 +534,8 @@ class OpenaiChatManage:
             messages_list=messages_list,
             context=chat_context,
             openai_api_client=self.openai_client,
+            priority=RequestPriority.BACKGROUND,
+            call_site="ai_care",
         )
         def response_gen(response: Iterable):
             for chunk in response:
@@ -527,10 +553,12 @@ class OpenaiChatManage:
         char_list = []
         voice_buffer = ""
         first_times = True
+        # The receivers of the stream are not waited for one by one, but all together at the end.
+        deferred = []
         for char in to_user_message:
-            response_to_user_message_stream_signal.send(
+            deferred += response_to_user_message_stream_signal.send(
                 self,
-                _async_wrapper=async_wrapper_without_loop,
+                _async_wrapper=async_wrapper_deferred,
                 message={"content": {"content": char.lstrip() if first_times else char, "context_id": context_id}, "flag": "content"},
             )
             char_list.append(char)
@@ -540,13 +568,14 @@ class OpenaiChatManage:
             if response_to_user_message_sentence_stream_signal.receivers:
                 voice_buffer += char
                 if char.startswith((".","!","?",";",":","。","！","？","；","：","\n")):
-                    response_to_user_message_sentence_stream_signal.send(
+                    deferred += response_to_user_message_sentence_stream_signal.send(
                         self,
-                        _async_wrapper=async_wrapper_without_loop,
+                        _async_wrapper=async_wrapper_deferred,
                         message={"content": voice_buffer, "flag": "content"},
                     )
                     voice_buffer = ""
 
+        event_loop_bridge.wait(result for _, result in deferred if isinstance(result, Future))
         response_to_user_message_stream_signal.send(
             self,
             _async_wrapper=async_wrapper_without_loop,
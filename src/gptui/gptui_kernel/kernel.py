@@ -1,4 +1,5 @@
 from __future__ import annotations
+import itertools
 import json
 import logging
 import sys
@@ -19,6 +20,10 @@ from .kernel_exceptions import (
 from .null_logger import get_null_logger
 
 
+# Shared by all kernels, so that a plugins version identifies the plugin set across kernels.
+_plugins_version_counter = itertools.count(1)
+
+
 class KernelInterface(metaclass=ABCMeta):
     @property
     @abstractmethod
@@ -58,6 +63,11 @@ class KernelInterface(metaclass=ABCMeta):
     @abstractmethod
     def plugins_in_kernel(self) -> list[tuple]:
         ...
+
+    @property
+    @abstractmethod
+    def plugins_version(self) -> int:
+        ...
     
     @property
     @abstractmethod
@@ -104,6 +114,7 @@ class Kernel(KernelInterface):
         self._functions_meta_in_kernel = {}
         self._functions_link_in_kernel = {}
         self._plugins_in_kernel = []
+        self._plugins_version = next(_plugins_version_counter)
 
     @property
     def commander(self) -> ac.CommanderAsyncInterface:
@@ -133,6 +144,7 @@ class Kernel(KernelInterface):
         if self._dose_plugins_match_sk_kernel(sk_kernel=sk_kernel, plugins_list=plugins_in_kernel) is True:
             self._sk_kernel = sk_kernel
             self._plugins_in_kernel = plugins_in_kernel
+            self._plugins_version = next(_plugins_version_counter)
         else:
             raise PluginsMatchError(sk_kernel, plugins_in_kernel)
     
@@ -155,6 +167,13 @@ class Kernel(KernelInterface):
         else:
             raise PluginsMatchError(self.sk_kernel, self._plugins_in_kernel)
 
+    @property
+    def plugins_version(self) -> int:
+        """A number that changes whenever the registered plugins change.
+        It is unique across kernels, so it can be used as a cache key of anything derived from the plugin set, e.g. the functions schema.
+        """
+        return self._plugins_version
+
     @staticmethod
     def make_basic_semantic_kernel(dot_env_config_path: str | None = None) -> sk.Kernel:
         dot_env_config_path = dot_env_config_path or '.env'
@@ -212,6 +231,7 @@ class Kernel(KernelInterface):
         self._plugins_in_kernel.extend(new_plugins_list)
         self._functions_meta_in_kernel = functions_meta_in_kernel
         self._functions_link_in_kernel = functions_link_in_kernel
+        self._plugins_version = next(_plugins_version_counter)
 
     def context_render(self, args: dict, function: SKFunctionBase) -> SKContext:
         context = self.sk_kernel.create_new_context()
@@ -69,6 +69,11 @@ class ManagerInterface(metaclass=ABCMeta):
     def available_functions_link(self) -> list[dict]:
         ...
 
+    @property
+    @abstractmethod
+    def plugins_version(self) -> int:
+        ...
+
     @abstractmethod
     def load_services(self, where, skill_name) -> None:
         ...
@@ -178,6 +183,13 @@ class Manager(ManagerInterface):
         _, link = self.gk_kernel.llm_function_call.sk_plugins_to_openai_functions()
         return link
 
+    @property
+    def plugins_version(self) -> int:
+        """The plugins version of gk_kernel, it identifies the current available_functions_meta.
+        Read it before available_functions_meta, so a concurrent plugin change can only leave the value under an outdated version.
+        """
+        return self.gk_kernel.plugins_version
+
     def load_services(self, where, skill_name) -> None:
         if isinstance(where, str):
             self.services.sk_kernel.import_semantic_skill_from_directory(where, skill_name)
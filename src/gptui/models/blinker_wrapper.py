@@ -1,4 +1,8 @@
+from __future__ import annotations
 import asyncio
+import concurrent.futures
+import threading
+from typing import Any, Coroutine, Iterable
 
 
 def sync_wrapper(func):
@@ -38,6 +42,7 @@ def async_wrapper_without_loop(func):
     """
     Wrap a coroutine function receiver to a sync receiver.
     Suitable for cases where signals are sent without an event loop.
+    The coroutine runs in the long-lived loop of event_loop_bridge, instead of a new loop for each signal.
 
     Return: return the value returned from coroutine.
     
@@ -45,5 +50,78 @@ def async_wrapper_without_loop(func):
         result = signal.send("sender", _async_wrapper=async_wrapper_without_loop, message="message")
     """
     def inner(*args, **kwargs):
-        return asyncio.run(func(*args, **kwargs))
+        return event_loop_bridge.run(func(*args, **kwargs))
     return inner
+
+def async_wrapper_deferred(func):
+    """
+    Wrap a coroutine function receiver to a sync receiver which does not wait for it.
+    Suitable for cases where signals are sent without an event loop and frequently, e.g. for each chunk of a stream.
+    The coroutines are run in the loop of event_loop_bridge in the order they are sent.
+
+    Return: concurrent.futures.Future
+
+    Example of waiting for the receivers:
+        result = signal.send(sender, _async_wrapper=async_wrapper_deferred, message="message")
+        event_loop_bridge.wait([item[1] for item in result if isinstance(item[1], concurrent.futures.Future)])
+    """
+    def inner(*args, **kwargs):
+        return event_loop_bridge.submit(func(*args, **kwargs))
+    return inner
+
+
+class EventLoopBridge:
+    """A long-lived event loop in a daemon thread, to which sync code submits coroutines.
+    The loop is started at the first submission.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=loop.run_forever, name="gptui_event_loop_bridge", daemon=True)
+                self._thread.start()
+                self._loop = loop
+            return self._loop
+
+    def submit(self, coro: Coroutine) -> concurrent.futures.Future:
+        "Schedule the coroutine in the loop of the bridge, coroutines are started in the order they are submitted."
+        if self._thread is threading.current_thread():
+            coro.close()
+            raise RuntimeError("Can not wait for a coroutine of the event loop bridge from its own loop.")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Coroutine, timeout: float | None = None) -> Any:
+        "Run the coroutine in the loop of the bridge and return its result."
+        return self.submit(coro).result(timeout)
+
+    def run_batch(self, coros: Iterable[Coroutine], timeout: float | None = None) -> list:
+        "Run the coroutines in one hop to the loop of the bridge, one after another, and return their results."
+        async def batch(coros: list[Coroutine]) -> list:
+            return [await coro for coro in coros]
+        return self.run(batch(list(coros)), timeout)
+
+    @staticmethod
+    def wait(futures: Iterable[concurrent.futures.Future], timeout: float | None = None) -> list:
+        "Wait for the futures of deferred receivers and return their results."
+        return [future.result(timeout) for future in futures]
+
+    def stop(self) -> None:
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None:
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        loop.close()
+
+
+event_loop_bridge = EventLoopBridge()
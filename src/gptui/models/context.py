@@ -1,12 +1,22 @@
 from __future__ import annotations
 import copy
 import logging
+import threading
+import weakref
 from dataclasses import dataclass, field
-from typing import Literal, TypeVar, Generic
+from typing import Iterable, Literal, Sequence, TypeVar, Generic, overload
 
 from openai.types.chat import ChatCompletionMessageParam
 
-from .utils.tokens_num import tokens_num_from_chat_context
+from .utils.tokens_num import (
+    message_content_tokens_num,
+    message_overhead_tokens_num,
+    message_tokens_overhead,
+    tokenizer_registry,
+    tokens_num_cache,
+    tokens_num_from_chat_context,
+)
+from .utils.tokens_num_index import ChainedTokensNumIndex, TokensNumIndex
 
 
 gptui_logger = logging.getLogger("gptui_logger")
@@ -37,36 +47,132 @@ class OpenaiContext(Context[ChatCompletionMessageParam]):
     plugins: list = field(default_factory=list)
     
     def __post_init__(self, *args, **kwargs):
-        self._tokens_num_list = []
+        self._tokens_num_index = TokensNumIndex()
         self._tokens_num_model = self.parameters.get("model")
+        # The encoding-dependent part of the tokens num of each message, tagged with the encoding name,
+        # so that switching between models sharing the same encoding only recomputes the overhead.
+        self._content_tokens_num_list: list[int] = []
+        self._tokens_num_encoding: str | None = None
+        # Guards the tokens num index, which is also synchronized by 'prefill_tokens_num' in a background thread.
+        self._tokens_num_lock = threading.RLock()
+        # The views sharing chat_context, they get their own copy before a message is inserted or popped.
+        self._views: weakref.WeakSet[OpenaiContextView] = weakref.WeakSet()
+
+    def _count_messages(self, messages: list, model: str) -> tuple[list[int], list[int]]:
+        "Return the content tokens num and the tokens num of each message."
+        self._tokens_num_encoding, content_tokens_num_list, tokens_num_list = count_messages_tokens_num(messages, model)
+        return content_tokens_num_list, tokens_num_list
+
+    def _rebuild_tokens_num(self, model: str) -> None:
+        assert self.chat_context is not None
+        self._content_tokens_num_list, tokens_num_list = self._count_messages(self.chat_context, model)
+        self._tokens_num_index = TokensNumIndex(tokens_num_list)
+
+    def _switch_tokens_num_model(self, model: str) -> None:
+        assert self.chat_context is not None
+        counting_model, tokens_per_message, tokens_per_name = message_tokens_overhead(model)
+        encoding_name = tokenizer_registry.encoding_for_model(counting_model).name
+        if encoding_name == self._tokens_num_encoding and len(self._tokens_num_index) <= len(self.chat_context):
+            # Same encoding, only the overhead term changes.
+            tokens_num_list = [
+                content_tokens_num + message_overhead_tokens_num(message, tokens_per_message, tokens_per_name)
+                for content_tokens_num, message in zip(self._content_tokens_num_list, self.chat_context)
+            ]
+            self._tokens_num_index = TokensNumIndex(tokens_num_list)
+        else:
+            self._rebuild_tokens_num(model)
+        self._tokens_num_model = model
+
+    @property
+    def tokens_num_index(self) -> TokensNumIndex:
+        """The per-message tokens num with its cumulative sum, synchronized with chat_context."""
+        with self._tokens_num_lock:
+            if self.chat_context is None:
+                self._tokens_num_index.clear()
+                self._content_tokens_num_list = []
+                return self._tokens_num_index
+            model = self.parameters.get("model")
+            if model is None:
+                raise ValueError("Parameter 'model' have not been set.")
+            if model != self._tokens_num_model:
+                self._switch_tokens_num_model(model)
+            if len(self.chat_context) == len(self._tokens_num_index):
+                return self._tokens_num_index
+            elif len(self.chat_context) < len(self._tokens_num_index):
+                self._rebuild_tokens_num(model)
+                return self._tokens_num_index
+            else:
+                content_tokens_num_list, tokens_num_list = self._count_messages(self.chat_context[len(self._tokens_num_index):], model)
+                self._content_tokens_num_list.extend(content_tokens_num_list)
+                self._tokens_num_index.extend(tokens_num_list)
+                return self._tokens_num_index
 
     @property
     def tokens_num_list(self) -> list:
-        if self.chat_context is None:
-            self._tokens_num_list = []
-            return self._tokens_num_list
-        model = self.parameters.get("model")
-        if model is None:
-            raise ValueError("Parameter 'model' have not been set.")
-        if model != self._tokens_num_model:
-            self._tokens_num_list = [tokens_num_from_chat_context([message], model=model) for message in self.chat_context]
-            self._tokens_num_model = model
-            return self._tokens_num_list
-        if len(self.chat_context) == len(self._tokens_num_list):
-            return self._tokens_num_list
-        elif len(self.chat_context) < len(self._tokens_num_list):
-            self._tokens_num_list = [tokens_num_from_chat_context([message], model=model) for message in self.chat_context]
-            return self._tokens_num_list
-        else:
-            tokens_num_list = [tokens_num_from_chat_context([message], model=model) for message in self.chat_context[len(self._tokens_num_list):]]
-            self._tokens_num_list.extend(tokens_num_list)
-            return self._tokens_num_list
+        return self.tokens_num_index.values
         
     @property
     def tokens_num(self) -> int | None:
         if self.chat_context is None:
             return None
-        return sum(self.tokens_num_list)
+        return self.tokens_num_index.total
+
+    def tokens_num_state(self) -> dict | None:
+        """Return the content tokens num of each message tagged with the encoding name,
+        in a compact form to be persisted alongside chat_context.
+        Return None if it can not be counted.
+        """
+        try:
+            self.tokens_num_index
+        except (ValueError, NotImplementedError):
+            return None
+        if self._tokens_num_encoding is None:
+            return None
+        return {"encoding": self._tokens_num_encoding, "content_tokens_num": list(self._content_tokens_num_list)}
+
+    def load_tokens_num_state(self, state: dict | None) -> bool:
+        """Restore the tokens num persisted by 'tokens_num_state' without tokenizing.
+        It is trusted only when the encoding matches the current model and it is aligned with chat_context.
+        Return whether it has been restored.
+        """
+        model = self.parameters.get("model")
+        if not state or model is None or self.chat_context is None:
+            return False
+        content_tokens_num_list = state.get("content_tokens_num")
+        if not isinstance(content_tokens_num_list, list) or len(content_tokens_num_list) != len(self.chat_context):
+            return False
+        try:
+            counting_model, tokens_per_message, tokens_per_name = message_tokens_overhead(model)
+        except NotImplementedError:
+            return False
+        encoding_name = tokenizer_registry.encoding_for_model(counting_model).name
+        if state.get("encoding") != encoding_name:
+            return False
+        with self._tokens_num_lock:
+            self._content_tokens_num_list = list(content_tokens_num_list)
+            self._tokens_num_index = TokensNumIndex(
+                [
+                    content_tokens_num + message_overhead_tokens_num(message, tokens_per_message, tokens_per_name)
+                    for content_tokens_num, message in zip(content_tokens_num_list, self.chat_context)
+                ]
+            )
+            self._tokens_num_encoding = encoding_name
+            self._tokens_num_model = model
+        return True
+
+    def view(self, parameters: dict | None = None) -> OpenaiContextView:
+        """Return a copy-on-write view of this context for a one-off request.
+        parameters: replace the parameters in the view, default to a shallow copy of the parameters of this context.
+        """
+        view = OpenaiContextView(base=self, parameters=parameters)
+        self._views.add(view)
+        return view
+
+    def _detach_views(self) -> None:
+        "Give the views their own copy of the messages they see, before the shared messages are changed in place."
+        for view in list(self._views):
+            view._detach()
+        self._views = weakref.WeakSet()
 
     def chat_context_append(self, message: ChatCompletionMessageParam, tokens_num_update: bool = True) -> None:
         """Write chat message to the chat_context, automatically calculate and update the number of tokens.
@@ -75,19 +181,46 @@ class OpenaiContext(Context[ChatCompletionMessageParam]):
         """
         if self.chat_context is None:
             self.chat_context = []
-        self.chat_context.append(message)
-        if tokens_num_update is True:
+        with self._tokens_num_lock:
+            self.chat_context.append(message)
+            if tokens_num_update is True:
+                model = self.parameters.get("model")
+                # Only update in place when the index is in sync, otherwise it will be synchronized lazily.
+                if model is not None and model == self._tokens_num_model and len(self._tokens_num_index) == len(self.chat_context) - 1:
+                    (content_tokens_num,), (tokens_num,) = self._count_messages([message], model)
+                    self._content_tokens_num_list.append(content_tokens_num)
+                    self._tokens_num_index.append(tokens_num)
+
+    def chat_context_insert(self, index: int, message: ChatCompletionMessageParam) -> None:
+        "Insert a message into chat context, and insert the correponding tokens num into the tokens num index."
+        if self.chat_context is None:
+            self.chat_context = []
+        with self._tokens_num_lock:
+            self._detach_views()
+            in_sync = len(self._tokens_num_index) == len(self.chat_context)
+            self.chat_context.insert(index, message)
             model = self.parameters.get("model")
-            if model is not None:
-                tokens_num = tokens_num_from_chat_context([message], model=model)
-                self._tokens_num_list.append(tokens_num)
+            if in_sync and model is not None and model == self._tokens_num_model:
+                (content_tokens_num,), (tokens_num,) = self._count_messages([message], model)
+                self._content_tokens_num_list.insert(index, content_tokens_num)
+                self._tokens_num_index.insert(index, tokens_num)
+            else:
+                self._content_tokens_num_list = []
+                self._tokens_num_index.clear()
 
     def chat_context_pop(self, pop_index: int = -1) -> ChatCompletionMessageParam:
-        "Pop a message from chat context, and delete the correponding tokens num in _tokens_num_list."
-        self._tokens_num_list.pop(pop_index)
+        "Pop a message from chat context, and delete the correponding tokens num in the tokens num index."
         if self.chat_context is None:
             raise ValueError(f"Field 'chat_context' has not been set.")
-        return self.chat_context.pop(pop_index)
+        with self._tokens_num_lock:
+            self._detach_views()
+            if len(self._tokens_num_index) == len(self.chat_context):
+                self._content_tokens_num_list.pop(pop_index)
+                self._tokens_num_index.pop(pop_index)
+            else:
+                self._content_tokens_num_list = []
+                self._tokens_num_index.clear()
+            return self.chat_context.pop(pop_index)
 
     
     def __deepcopy__(self, memo):
@@ -107,10 +240,12 @@ class OpenaiContext(Context[ChatCompletionMessageParam]):
         
         for k in dir(self):
             attr = getattr(self, k)
-            if not k.startswith("__") and not callable(attr) and not dose_only_read(getattr(self.__class__, k, None)) and k != "plugins":
+            if not k.startswith("__") and not callable(attr) and not dose_only_read(getattr(self.__class__, k, None)) and k not in ("plugins", "_tokens_num_lock", "_views"):
                 setattr(new_instance, k, copy.deepcopy(attr, memo))
 
         setattr(new_instance, "plugins", copy.copy(self.plugins))
+        setattr(new_instance, "_tokens_num_lock", threading.RLock())
+        setattr(new_instance, "_views", weakref.WeakSet())
 
         memo[id(self)] = new_instance
 
@@ -135,15 +270,242 @@ class BeadOpenaiContext(OpenaiContext):
             self.chat_context_append(message=one_message, tokens_num_update=True)
         self.bead_info["lengths"].append(tokens_num_from_chat_context(chat_context=bead_content, model=self.parameters["model"]))
 
+    @property
+    def bead_positions(self) -> list[int]:
+        "The positions of the inserted beads in the chat_context."
+        return self.bead_info["positions"]
+
+    @property
+    def tokens_num_since_bead(self) -> int:
+        """The tokens num of the messages from the last bead on, including the bead itself.
+        It is the difference of two running sums kept by the tokens num index, so it is O(1) once the index is in sync,
+        and it follows appends, inserts and pops without a separate counter to invalidate.
+        """
+        last_bead_position = self.bead_info["positions"][-1] if self.bead_info["positions"] else 0
+        tokens_num_index = self.tokens_num_index
+        return tokens_num_index.range_sum(min(last_bead_position, len(tokens_num_index)))
+
     def auto_insert_bead(self) -> bool:
         """Automatically determine whether the bead needs to be inserted.
         If so, insert the bead and return True;
         otherwise, return False.
         """
-        last_bead_position = self.bead_info["positions"][-1] if self.bead_info["positions"] else 0
-        tokens_num_without_bead = sum(self.tokens_num_list[last_bead_position:])
         assert self.max_sending_tokens_num is not None
-        if tokens_num_without_bead >= self.max_sending_tokens_num * 0.95:
+        if self.tokens_num_since_bead >= self.max_sending_tokens_num * 0.95:
             self.insert_bead()
             return True
         return False
+
+
+class OverlayMessages(Sequence):
+    "The first 'base_length' messages of a shared list followed by local messages, the shared list is not copied."
+
+    def __init__(self, base: list, base_length: int, tail: list):
+        self.base = base
+        self.base_length = base_length
+        self.tail = tail
+
+    def __len__(self) -> int:
+        return self.base_length + len(self.tail)
+
+    @overload
+    def __getitem__(self, index: int) -> ChatCompletionMessageParam:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[ChatCompletionMessageParam]:
+        ...
+
+    def __getitem__(self, index):
+        length = len(self)
+        if isinstance(index, slice):
+            start, stop, step = index.indices(length)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            n = self.base_length
+            return self.base[min(start, n):min(stop, n)] + self.tail[max(start - n, 0):max(stop - n, 0)]
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("message index out of range")
+        if index < self.base_length:
+            return self.base[index]
+        return self.tail[index - self.base_length]
+
+
+class OpenaiContextView:
+    """A copy-on-write view of an OpenaiContext for one-off requests, such as function call replies,
+    AI-care messages and group talk roles.
+
+    The messages of the base context are shared read-only, only the appended messages and the parameters are local,
+    so that a request does not need to deep copy the whole history. The view sees the base messages present when it was created:
+    messages appended to the base are not seen, and the base gives its views their own copy of the messages and of their tokens num
+    before 'chat_context_insert' or 'chat_context_pop' changes them. Changing the list of the base in place otherwise is not guarded.
+    The counted tokens num of the base are reused if the model is the same; the view never writes to the base.
+    """
+
+    def __init__(self, base: OpenaiContext, parameters: dict | None = None):
+        self.base = base
+        self.parameters = dict(base.parameters) if parameters is None else parameters
+        self.max_sending_tokens_num = base.max_sending_tokens_num
+        self.messages: list[ChatCompletionMessageParam] = []
+        # The list of the base is shared until the view is detached, only its first '_base_length' messages are seen.
+        self._base_messages: list[ChatCompletionMessageParam] = base.chat_context if base.chat_context is not None else []
+        self._base_length = len(self._base_messages)
+        self._detached = False
+        self._base_tokens_num_index: TokensNumIndex | None = None
+        self._base_tokens_num_model: str | None = None
+        self._tail_tokens_num_index = TokensNumIndex()
+        self._tail_tokens_num_model: str | None = None
+        if isinstance(base, BeadOpenaiContext) and base.bead_info["positions"]:
+            self._last_bead_position = min(base.bead_info["positions"][-1], self._base_length)
+        else:
+            self._last_bead_position = 0
+        self._view_bead_positions: list[int] = []
+
+    @property
+    def id(self) -> str | int | None:
+        return self.base.id
+
+    @property
+    def plugins(self) -> list:
+        return self.base.plugins
+
+    @property
+    def chat_context(self) -> OverlayMessages:
+        return OverlayMessages(self._base_messages, self._base_length, self.messages)
+
+    @property
+    def bead(self) -> list[ChatCompletionMessageParam]:
+        return self.base.bead if isinstance(self.base, BeadOpenaiContext) else []
+
+    @property
+    def bead_positions(self) -> list[int]:
+        "The positions of the beads in the messages of the view, including a bead inserted into the view."
+        if not isinstance(self.base, BeadOpenaiContext):
+            return []
+        positions = [position for position in self.base.bead_info["positions"] if position < self._base_length]
+        return positions + self._view_bead_positions
+
+    def chat_context_append(self, message: ChatCompletionMessageParam, tokens_num_update: bool = True) -> None:
+        "Append a message to the view only, its tokens num is counted lazily."
+        self.messages.append(message)
+
+    def _detach(self) -> None:
+        "Copy the base messages seen by the view and their tokens num, the base is about to change them in place."
+        self._base_messages = self._base_messages[:self._base_length]
+        if self._base_tokens_num_index is not None and self._base_tokens_num_index is self.base._tokens_num_index:
+            self._base_tokens_num_index = TokensNumIndex(self._base_tokens_num_index.values[:self._base_length])
+        self._detached = True
+
+    def _base_index(self, model: str) -> TokensNumIndex:
+        if self._base_tokens_num_index is not None and self._base_tokens_num_model == model:
+            return self._base_tokens_num_index
+        with self.base._tokens_num_lock:
+            base_index = self.base._tokens_num_index
+            if not self._detached and self.base._tokens_num_model == model and len(base_index) >= self._base_length:
+                self._base_tokens_num_index = base_index
+                self._base_tokens_num_model = model
+                return base_index
+        # The base has not been counted for this model, or it has changed, count it here without touching the base.
+        # The content tokens num are usually cached, so it is cheap.
+        self._base_tokens_num_index = TokensNumIndex(count_messages_tokens_num(self._base_messages[:self._base_length], model)[2])
+        self._base_tokens_num_model = model
+        return self._base_tokens_num_index
+
+    @property
+    def tokens_num_index(self) -> ChainedTokensNumIndex:
+        model = self.parameters.get("model")
+        if model is None:
+            raise ValueError("Parameter 'model' have not been set.")
+        tail_index = self._tail_tokens_num_index
+        if self._tail_tokens_num_model != model or len(tail_index) > len(self.messages):
+            tail_index.clear()
+            self._tail_tokens_num_model = model
+        if len(tail_index) < len(self.messages):
+            tail_index.extend(count_messages_tokens_num(self.messages[len(tail_index):], model)[2])
+        return ChainedTokensNumIndex(self._base_index(model), self._base_length, tail_index)
+
+    @property
+    def tokens_num_list(self) -> list:
+        return self.tokens_num_index.values
+
+    @property
+    def tokens_num(self) -> int:
+        return self.tokens_num_index.total
+
+    def auto_insert_bead(self) -> bool:
+        """The same as 'BeadOpenaiContext.auto_insert_bead', but the bead is only inserted into the view.
+        Always return False if the base is not a BeadOpenaiContext.
+        """
+        if not isinstance(self.base, BeadOpenaiContext):
+            return False
+        tokens_num_without_bead = self.tokens_num_index.range_sum(self._last_bead_position)
+        assert self.max_sending_tokens_num is not None
+        if tokens_num_without_bead >= self.max_sending_tokens_num * 0.95:
+            self._last_bead_position = len(self.chat_context)
+            self._view_bead_positions.append(self._last_bead_position)
+            for one_message in copy.deepcopy(self.base.bead):
+                self.chat_context_append(message=one_message)
+            return True
+        return False
+
+
+def count_messages_tokens_num(messages: Iterable, model: str) -> tuple[str, list[int], list[int]]:
+    "Return the encoding name, the content tokens num and the tokens num of each message."
+    counting_model, tokens_per_message, tokens_per_name = message_tokens_overhead(model)
+    encoding = tokenizer_registry.encoding_for_model(counting_model)
+    messages = list(messages)
+    content_tokens_num_list = [message_content_tokens_num(message, encoding) for message in messages]
+    tokens_num_list = [
+        content_tokens_num + message_overhead_tokens_num(message, tokens_per_message, tokens_per_name)
+        for content_tokens_num, message in zip(content_tokens_num_list, messages)
+    ]
+    return encoding.name, content_tokens_num_list, tokens_num_list
+
+
+def prefill_tokens_num(contexts: Iterable[OpenaiContext], num_threads: int = 8) -> None:
+    """Count the not yet counted messages of all contexts at once.
+
+    The strings of all pending messages are batch encoded per encoding across a thread pool,
+    instead of being encoded one message at a time on first access of 'tokens_num_list'.
+    It is safe to run in a background thread: the counts are added under the lock of the context only if it has not been
+    synchronized or changed in the meantime, otherwise the context is left to its lazy synchronization.
+    """
+    pending: dict[str, list[tuple[OpenaiContext, int, list, int, int]]] = {}
+    encodings = {}
+    for context in contexts:
+        model = context.parameters.get("model")
+        with context._tokens_num_lock:
+            if context.chat_context is None or model is None or model != context._tokens_num_model:
+                continue
+            start = len(context._tokens_num_index)
+            messages = context.chat_context[start:]
+        if not messages:
+            continue
+        counting_model, tokens_per_message, tokens_per_name = message_tokens_overhead(model)
+        encoding = tokenizer_registry.encoding_for_model(counting_model)
+        encodings[encoding.name] = encoding
+        pending.setdefault(encoding.name, []).append((context, start, messages, tokens_per_message, tokens_per_name))
+
+    for encoding_name, items in pending.items():
+        strings = [str(value) for _, _, messages, _, _ in items for message in messages for value in message.values() if value]
+        counts = iter(tokens_num_cache.tokens_num_batch(strings, encodings[encoding_name], num_threads=num_threads))
+        for context, start, messages, tokens_per_message, tokens_per_name in items:
+            content_tokens_num_list = [sum(next(counts) for value in message.values() if value) for message in messages]
+            tokens_num_list = [
+                content_tokens_num + message_overhead_tokens_num(message, tokens_per_message, tokens_per_name)
+                for content_tokens_num, message in zip(content_tokens_num_list, messages)
+            ]
+            with context._tokens_num_lock:
+                if (
+                    len(context._tokens_num_index) != start
+                    or context._tokens_num_model != context.parameters.get("model")
+                    or context.chat_context is None
+                    or context.chat_context[start:start + len(messages)] != messages
+                ):
+                    # The context has been synchronized or changed meanwhile.
+                    continue
+                context._tokens_num_encoding = encoding_name
+                context._content_tokens_num_list.extend(content_tokens_num_list)
+                context._tokens_num_index.extend(tokens_num_list)
@@ -0,0 +1,66 @@
+from __future__ import annotations
+import json
+import threading
+import weakref
+from dataclasses import dataclass
+
+from .context import OpenaiContext
+
+
+class OpenaiContextRegistry:
+    """Keep weak references to the live contexts handed to plugins, so that a handle can be resolved lazily
+    without serializing the context.
+    """
+
+    def __init__(self):
+        self._contexts: weakref.WeakValueDictionary[int, OpenaiContext] = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def handle(self, context: OpenaiContext) -> OpenaiContextHandle:
+        "Register the context and return its handle."
+        key = id(context)
+        with self._lock:
+            self._contexts[key] = context
+        return OpenaiContextHandle(id=context.id, key=key)
+
+    def get(self, handle: OpenaiContextHandle) -> OpenaiContext | None:
+        "Return the context of the handle, or None if it does not exist anymore."
+        with self._lock:
+            context = self._contexts.get(handle.key)
+        # The key is the object id, check the context id in case the key has been reused by another context.
+        if context is None or context.id != handle.id:
+            return None
+        return context
+
+
+openai_context_registry = OpenaiContextRegistry()
+
+
+@dataclass(frozen=True)
+class OpenaiContextHandle:
+    """A lightweight reference to an OpenaiContext passed to plugins in place of the serialized context.
+
+    Its string form is a small JSON object with the "id" of the context, so plugins only reading the id
+    keep working, and a "handle" key used to get the context itself.
+    """
+    id: int | str | None
+    key: int
+
+    def to_json(self) -> str:
+        return json.dumps({"id": self.id, "handle": self.key})
+
+    @classmethod
+    def from_json(cls, handle_str: str) -> OpenaiContextHandle:
+        """Parse the string form of a handle.
+        Raise ValueError if it is not a handle, e.g. the value has been provided by the LLM.
+        """
+        try:
+            handle_dict = json.loads(handle_str)
+            return cls(id=handle_dict["id"], key=int(handle_dict["handle"]))
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"'{handle_str}' is not a valid context handle.") from e
+
+    @property
+    def context(self) -> OpenaiContext | None:
+        "The live context, or None if it does not exist anymore."
+        return openai_context_registry.get(self)
@@ -5,6 +5,9 @@ from semantic_kernel.skill_definition import sk_function
 
 from ....gptui_kernel import Kernel
 from ....gptui_kernel.manager import auto_init_params
+from ...request_scheduler import RequestPriority, request_scheduler
+from ...response_cache import response_cache
+from ...utils.tokens_num import tokens_num_from_string
 
 
 gptui_logger = logging.getLogger("gptui_logger")
@@ -43,9 +46,33 @@ class ConversationService:
         )
         
         chat_context = chat_context_to_string(chat_context_json_str)
+        cache_request = {"model": "gpt-3.5-turbo-instruct", "prompt": sk_prompt, "input": chat_context, "max_tokens": 50}
+        if (cached := response_cache.get("conversation_title", cache_request)) is not None:
+            return cached[1]
         # A new kernel must be created here, otherwise, there will be context confilicts.
         gk_kernel = Kernel(self.manager.dot_env_config_path)
         make_title_function = gk_kernel.sk_kernel.create_semantic_function(sk_prompt, max_tokens=50)
-        name = await make_title_function.invoke_async(chat_context)
+
+        async def make_title():
+            result = await make_title_function.invoke_async(chat_context)
+            if result.error_occurred:
+                # The function does not raise, the error of the request is raised here so that the scheduler can retry it.
+                error = result.last_exception
+                if error is None:
+                    raise RuntimeError(result.last_error_description)
+                raise (error.__cause__ if isinstance(error.__cause__, Exception) else error)
+            return result
+
+        # Titles are not urgent, they give way to the conversations in the request scheduler.
+        try:
+            name = await request_scheduler.async_call(
+                make_title,
+                model="gpt-3.5-turbo-instruct",
+                tokens_num=tokens_num_from_string(sk_prompt + chat_context, model="gpt-3.5-turbo-instruct") + 50,
+                priority=RequestPriority.BACKGROUND,
+            )
+        except Exception as e:
+            return f"Error: {e}"
         name = str(name)
+        response_cache.put("conversation_title", cache_request, "text", name)
         return name
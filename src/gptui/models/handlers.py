@@ -12,6 +12,7 @@ from agere.utils.llm_async_converters import LLMAsyncAdapter
 
 from .blinker_wrapper import sync_wrapper, async_wrapper_with_loop
 from .context import OpenaiContext
+from .context_handle import openai_context_registry
 from .signals import (
     chat_context_extend_signal,
     common_message_signal,
@@ -20,8 +21,10 @@ from .signals import (
     response_to_user_message_stream_signal,
     response_to_user_message_sentence_stream_signal,
 )
-from .openai_chat_inner_service import chat_service_for_inner
+from .openai_chat_inner_service import async_chat_service_for_inner, chat_service_for_inner
 from .openai_error import OpenaiErrorHandler
+from .stream_coalescer import is_sentence_boundary, stream_flush_policy
+from .stream_limiter import stream_limiter
 from .utils.openai_api import openai_api_client
 from ..gptui_kernel.manager import ManagerInterface
 
@@ -29,6 +32,42 @@ from ..gptui_kernel.manager import ManagerInterface
 gptui_logger = logging.getLogger("gptui_logger")
 
 
+class LLMNativeAsyncAdapter(LLMAsyncAdapter):
+    """LLMAsyncAdapter which iterates an async response, e.g. from AsyncOpenAI, natively in the event loop.
+    A sync response is still read in a thread chunk by chunk.
+    """
+
+    async def llm_to_async_iterable(
+        self,
+        response: Iterable | AsyncIterable,
+        at_receiving_start: list | None = None,
+        at_receiving_end: list | None = None,
+    ):
+        if not isinstance(response, AsyncIterable):
+            async for chunk in super().llm_to_async_iterable(
+                response=response,
+                at_receiving_start=at_receiving_start,
+                at_receiving_end=at_receiving_end,
+            ):
+                yield chunk
+            return
+        if at_receiving_start is not None:
+            self._at_receiving_start = at_receiving_start
+        if at_receiving_end is not None:
+            self._at_receiving_end = at_receiving_end
+        self.received_message = []
+        is_first_time = True
+        async for chunk in response:
+            if is_first_time is True:
+                await self.at_receiving_start()
+                is_first_time = False
+            self.received_message.append(chunk)
+            yield chunk
+        if is_first_time is True:
+            await self.at_receiving_start()
+        await self.at_receiving_end()
+
+
 class ResponseHandler:
     """A handler to handle response from LLM."""
     def __init__(self, manager: ManagerInterface, context: OpenaiContext):
@@ -45,28 +84,31 @@ class ResponseHandler:
     ):
         """handler that handle response from LLM"""
         make_role_generator = await async_dispatcher_tools_call_for_openai(
-            source=LLMAsyncAdapter(logger=gptui_logger).llm_to_async_iterable(
+            source=LLMNativeAsyncAdapter(logger=gptui_logger).llm_to_async_iterable(
                 response=response,
                 at_receiving_start=at_receiving_start,
                 at_receiving_end=at_receiving_end,
             ),
         )
+        # The follow-up request of function calls goes the same way as the response, sync or native async.
+        async_client = isinstance(response, AsyncIterable)
         to_user_gen = make_role_generator("to_user")
         function_call_gen = make_role_generator("function_call")
-        response_to_user_job = BasicJob(OpenaiHandler(self.manager, self.context).user_handler(user_gen=to_user_gen))
+        response_to_user_job = BasicJob(OpenaiHandler(self.manager, self.context, async_client=async_client).user_handler(user_gen=to_user_gen))
         await self_handler.put_job(job=response_to_user_job)
-        function_call_job = BasicJob(OpenaiHandler(self.manager, self.context).function_call_handler(function_call_gen=function_call_gen))
+        function_call_job = BasicJob(OpenaiHandler(self.manager, self.context, async_client=async_client).function_call_handler(function_call_gen=function_call_gen))
         await self_handler.put_job(job=function_call_job)
 
 
 class OpenaiHandler:
     """A handler for processing OpenAI responses"""
 
-    def __init__(self, manager: ManagerInterface, context: OpenaiContext):
+    def __init__(self, manager: ManagerInterface, context: OpenaiContext, async_client: bool = False):
         self.manager = manager
         self.context = context
         self.chat_context_saver = context.chat_context_saver
-        self.openai_api_client = openai_api_client(manager.dot_env_config_path)
+        self.async_client = async_client
+        self.openai_api_client = openai_api_client(manager.dot_env_config_path, async_client=async_client)
 
     @handler(PASS_WORD)
     async def user_handler(self, self_handler, user_gen) -> None:
@@ -81,26 +123,30 @@ class OpenaiHandler:
         empty_status = None
         collected_messages = ""
         voice_buffer = ""
+        voice = bool(response_to_user_message_sentence_stream_signal.receivers)
         
-        async for char in user_gen:
+        # The deltas are displayed in batches, so that the display work follows the frame rate rather than the token rate.
+        async for deltas in stream_flush_policy.coalesce(user_gen, boundary=is_sentence_boundary if voice else None):
             empty_status = False
-            collected_messages += char
+            content = "".join(deltas)
+            collected_messages += content
             await response_to_user_message_stream_signal.send_async(
                 self,
                 _sync_wrapper=sync_wrapper,
-                message={"content": {"content": char, "context_id": self.context.id}, "flag": "content"},
+                message={"content": {"content": content, "context_id": self.context.id}, "flag": "content"},
             )
             
             # Send voice signal
             if response_to_user_message_sentence_stream_signal.receivers:
-                voice_buffer += char
-                if char.startswith((".","!","?",";",":","。","！","？","；","：","\n")):
-                    await response_to_user_message_sentence_stream_signal.send_async(
-                        self,
-                        _sync_wrapper=sync_wrapper,
-                        message={"content": voice_buffer, "flag": "content"},
-                    )
-                    voice_buffer = ""
+                for char in deltas:
+                    voice_buffer += char
+                    if is_sentence_boundary(char):
+                        await response_to_user_message_sentence_stream_signal.send_async(
+                            self,
+                            _sync_wrapper=sync_wrapper,
+                            message={"content": voice_buffer, "flag": "content"},
+                        )
+                        voice_buffer = ""
         
         if empty_status is None:
             return
@@ -171,7 +217,11 @@ class OpenaiHandler:
                 context = self.manager.gk_kernel.context_render(args=function_args, function=function_to_call)
                 
                 # Dose insert context
-                if context.variables.get("openai_context") == "AUTO":
+                # "AUTO" gets a handle of the context, "AUTO_FULL" is the opt-in for the serialized context with its whole history.
+                openai_context_para = context.variables.get("openai_context")
+                if openai_context_para == "AUTO":
+                    context["openai_context"] = openai_context_registry.handle(self.context).to_json()
+                elif openai_context_para == "AUTO_FULL":
                     openai_context_deepcopy = copy.deepcopy(self.context)
                     openai_context_deepcopy.plugins = [repr(plugin) for plugin in openai_context_deepcopy.plugins]
                     context["openai_context"] = json.dumps(asdict(openai_context_deepcopy))
@@ -240,6 +290,7 @@ class OpenaiHandler:
         ]
 
         gptui_logger.info(f"Function response: {message}")
+        plugins_version = self.manager.plugins_version
         functions = self.manager.available_functions_meta
         await notification_signal.send_async(
             self,
@@ -253,22 +304,20 @@ class OpenaiHandler:
             }
         )
         if functions:
-            paras = {"messages_list": message, "context": self.context, "openai_api_client": self.openai_api_client, "tools": functions, "tool_choice": "auto"}
+            paras = {"messages_list": message, "context": self.context, "openai_api_client": self.openai_api_client, "tools": functions, "tool_choice": "auto", "tools_version": plugins_version}
         else:
             paras = {"messages_list": message, "context": self.context, "openai_api_client": self.openai_api_client}
         
-        # retry twice
-        last_exception = None
-        for _ in range(2):
-            try:
-                response = await asyncio.to_thread(chat_service_for_inner, **paras)
-                break
-            except Exception as e:
-                last_exception = e
-                await asyncio.sleep(5)
-        else:
-            assert last_exception is not None
-            OpenaiErrorHandler().openai_error_handle(error=last_exception, context=self.context)
+        # Transient errors are retried with backoff by the request scheduler.
+        try:
+            if self.async_client:
+                response = await async_chat_service_for_inner(**paras)
+            else:
+                # Wait for the slot here, a thread of the loop's executor should not be blocked waiting for it.
+                stream_slot = await stream_limiter.async_acquire(self.context.id)
+                response = await asyncio.to_thread(chat_service_for_inner, **paras, stream_slot=stream_slot)
+        except Exception as e:
+            OpenaiErrorHandler().openai_error_handle(error=e, context=self.context)
             self.context.chat_context_append(
                 {
                     "role": "user",
@@ -278,7 +327,7 @@ class OpenaiHandler:
                     )
                 }
             )
-            raise last_exception
+            raise e
 
         if self.chat_context_saver == "outer":
             await chat_context_extend_signal.send_async(
@@ -376,7 +425,7 @@ class GroupTalkHandler:
 
     @handler(PASS_WORD)
     async def parse_stream_response(self, self_handler, role_name, stream_response):
-        async_stream_response = LLMAsyncAdapter().llm_to_async_iterable(stream_response)
+        async_stream_response = LLMNativeAsyncAdapter().llm_to_async_iterable(stream_response)
         talk_manager = self_handler.ancestor_chain[-2]
         if not talk_manager.running:
             return
@@ -400,7 +449,7 @@ class GroupTalkHandler:
                             "content": f"SYS_INNER: Host says to you: Yes, you are {role_name}, you can talk now. Reply directly with what you want to say, without additionally thanking the host.",
                         }
                     )
-                    async_talk_stream_response = LLMAsyncAdapter().llm_to_async_iterable(response)
+                    async_talk_stream_response = LLMNativeAsyncAdapter().llm_to_async_iterable(response)
                     talk_content = await self.stream_response_display_and_result(role_name=role_name, async_stream_response=async_talk_stream_response, talk_manager=talk_manager)
                 except Exception as e:
                     # If receiving the message fails, set talk_manager.speaking to None to avoid blocking the group chat.
@@ -427,11 +476,15 @@ class GroupTalkHandler:
         return full_response_content      
 
     async def stream_response_display_and_result(self, role_name: str, async_stream_response: AsyncIterable, talk_manager) -> str:
+        async def chunk_contents():
+            async for chunk in async_stream_response:
+                chunk_content = chunk.choices[0].delta.content
+                if chunk_content:
+                    yield chunk_content
+
         chunk_list = []
-        async for chunk in async_stream_response:
-            chunk_content = chunk.choices[0].delta.content
-            if not chunk_content:
-                continue
+        async for deltas in stream_flush_policy.coalesce(chunk_contents()):
+            chunk_content = "".join(deltas)
             await response_auxiliary_message_signal.send_async(
                 self,
                 _sync_wrapper=sync_wrapper,
@@ -3,7 +3,7 @@ import logging
 from abc import ABCMeta, abstractmethod
 from typing import Literal
 
-from agere.commander import Callback
+from agere.commander import PASS_WORD, BasicJob, Callback, handler
 from openai.types.chat import ChatCompletionMessageParam
 
 from .blinker_wrapper import async_wrapper_without_loop, async_wrapper_with_loop, sync_wrapper
@@ -11,7 +11,9 @@ from .context import OpenaiContext
 from .jobs import ResponseJob, GroupTalkManager
 from .openai_error import OpenaiErrorHandler
 from .openai_tokens_truncate import trim_excess_tokens
+from .request_scheduler import RequestPriority, request_scheduler
 from .signals import notification_signal, chat_context_extend_for_sending_signal
+from .stream_limiter import stream_limiter
 from .utils.openai_api import openai_api_client
 from .utils.tokens_num import tokens_num_for_functions_call
 from ..gptui_kernel.manager import ManagerInterface
@@ -64,7 +66,7 @@ class OpenaiChat(OpenaiChatInterface):
         "Pop a message from context"
         if context.chat_context is None:
             raise ValueError(f"Field 'chat_context' in {context.chat_context} has not been set.")
-        return context.chat_context.pop(pop_index)
+        return context.chat_context_pop(pop_index)
 
     def chat(self, context: OpenaiContext, message: dict | list[dict]) -> None:
         "Chat with openai"
@@ -101,13 +103,19 @@ class OpenaiChat(OpenaiChatInterface):
         )
         try:
             tools_para = {}
+            offset_tokens_num = 0
+            plugins_version = self.manager.plugins_version
             if available_functions := self.manager.available_functions_meta:
-                tools_para = {"tools": available_functions, "tool_choice": "auto"}
+                tools_para = {"tools": available_functions, "tool_choice": "auto", "tools_version": plugins_version}
                 response_mode = "function_call"
+                offset_tokens_num = -tokens_num_for_functions_call(
+                    available_functions,
+                    model=context.parameters["model"],
+                    version=plugins_version,
+                )
             else:
                 response_mode = "no_function_call"
             
-            offset_tokens_num = -tokens_num_for_functions_call(tools_para["tools"], model=context.parameters["model"])
             trim_messages = trim_excess_tokens(context, offset=offset_tokens_num)
 
             # Delete the tool reply messages at the beginning of the information list.
@@ -118,11 +126,15 @@ class OpenaiChat(OpenaiChatInterface):
             while trim_messages and trim_messages[0].get("role") == "tool":
                 trim_messages.pop(0)
 
-            response = self.openai_api_client.with_options(timeout=20.0).chat.completions.create(
-                messages=trim_messages,
-                **tools_para,
-                **context.parameters,
-            )
+            with stream_limiter.acquire(context.id):
+                response = request_scheduler.chat_completions_create(
+                    self.openai_api_client,
+                    priority=RequestPriority.USER,
+                    call_site="chat",
+                    messages=trim_messages,
+                    **tools_para,
+                    **context.parameters,
+                )
         except Exception as e:
             notification_signal.send(
                 self,
@@ -209,6 +221,37 @@ class OpenaiChat(OpenaiChatInterface):
     
     def chat_stream(self, context: OpenaiContext, message: dict | list[dict]) -> None:
         "stream version of chat function with openai"
+        self._append_for_sending(context=context, message=message)
+        try:
+            trim_messages, tools_para = self._messages_for_sending(context)
+            # The slot of the stream is held until the response has been received.
+            response = stream_limiter.open_stream(
+                context.id,
+                lambda: request_scheduler.chat_completions_create(
+                    self.openai_api_client,
+                    priority=RequestPriority.USER,
+                    call_site="chat",
+                    messages=trim_messages,
+                    **tools_para,
+                    **context.parameters,
+                ),
+            )
+        except Exception as e:
+            self._sending_error(error=e, context=context, event_loop=False)
+            return
+        
+        callback, at_receiving_start = self._response_callbacks(context)
+        job = ResponseJob(
+            manager=self.manager,
+            response=response,
+            context=context,
+            callback=callback,
+            at_receiving_start=at_receiving_start,
+        )
+        self.manager.gk_kernel.commander.put_job_threadsafe(job)
+
+    def _append_for_sending(self, context: OpenaiContext, message: dict | list[dict]) -> None:
+        "Save the message from the user to the context, and notify that it is being sent."
         if isinstance(message, dict):
             messages_list = [message]
         else:
@@ -240,42 +283,47 @@ class OpenaiChat(OpenaiChatInterface):
                 "flag":"info",
             }
         )
-        try:
-            tools_para = {}
-            if available_functions := self.manager.available_functions_meta:
-                tools_para = {"tools": available_functions, "tool_choice": "auto"}
-            
-            offset_tokens_num = -tokens_num_for_functions_call(tools_para["tools"], model=context.parameters["model"])
-            trim_messages = trim_excess_tokens(context, offset=offset_tokens_num)
-
-            # Delete the tool reply messages at the beginning of the information list.
-            # This is because if the information starts with a function reply message,
-            # it indicates that the function call information has already been truncated.
-            # The OpenAI API requires that function reply messages must be responses to function calls.
-            # Therefore, if the function reply messages are not removed, it will result in an OpenAI API error.
-            while trim_messages and trim_messages[0].get("role") == "tool":
-                trim_messages.pop(0)
 
-            response = self.openai_api_client.with_options(timeout=20.0).chat.completions.create(
-                messages = trim_messages,
-                **tools_para,
-                **context.parameters,
-                )
-        except Exception as e:
-            notification_signal.send(
-                self,
-                _async_wrapper=async_wrapper_without_loop,
-                message={
-                    "content":{
-                        "content":{"error":e, "context":context},
-                        "description":"An error occurred in communication with OpenAI initiated by user."
-                    },
-                    "flag":"info"
-                }
+    def _messages_for_sending(self, context: OpenaiContext) -> tuple[list, dict]:
+        "Return the trimmed messages and the tools parameters to be sent, with the version of the tools schema for the request scheduler."
+        tools_para = {}
+        offset_tokens_num = 0
+        plugins_version = self.manager.plugins_version
+        if available_functions := self.manager.available_functions_meta:
+            tools_para = {"tools": available_functions, "tool_choice": "auto", "tools_version": plugins_version}
+            offset_tokens_num = -tokens_num_for_functions_call(
+                available_functions,
+                model=context.parameters["model"],
+                version=plugins_version,
             )
-            OpenaiErrorHandler().openai_error_handle(error=e, context=context, event_loop=False)
-            return
         
+        trim_messages = trim_excess_tokens(context, offset=offset_tokens_num)
+
+        # Delete the tool reply messages at the beginning of the information list.
+        # This is because if the information starts with a function reply message,
+        # it indicates that the function call information has already been truncated.
+        # The OpenAI API requires that function reply messages must be responses to function calls.
+        # Therefore, if the function reply messages are not removed, it will result in an OpenAI API error.
+        while trim_messages and trim_messages[0].get("role") == "tool":
+            trim_messages.pop(0)
+        return trim_messages, tools_para
+
+    def _sending_error(self, error: Exception, context: OpenaiContext, event_loop: bool) -> None:
+        notification_signal.send(
+            self,
+            _async_wrapper=async_wrapper_with_loop if event_loop else async_wrapper_without_loop,
+            message={
+                "content":{
+                    "content":{"error":error, "context":context},
+                    "description":"An error occurred in communication with OpenAI initiated by user."
+                },
+                "flag":"info"
+            }
+        )
+        OpenaiErrorHandler().openai_error_handle(error=error, context=context, event_loop=event_loop)
+
+    def _response_callbacks(self, context: OpenaiContext) -> tuple[Callback, list[dict]]:
+        "Return the job callback and the at_receiving_start callbacks of the response job."
         callback = Callback(
             at_job_start=[
                 {
@@ -333,16 +381,61 @@ class OpenaiChat(OpenaiChatInterface):
                 },
             },
         ]
+        return callback, at_receiving_start
 
-        job = ResponseJob(
-            manager=self.manager,
-            response=response,
-            context=context,
-            callback=callback,
-            at_receiving_start=at_receiving_start,
-        )
+
+class AsyncOpenaiChat(OpenaiChat):
+    """Stream with AsyncOpenAI on the loop of the commander.
+
+    The request is awaited by a handler in the commander, and the response is handled as a native async iterator,
+    instead of blocking a thread per request and hopping to a thread for every chunk.
+    The non-stream 'chat' is the same as OpenaiChat.
+    """
+    def __init__(self, manager: ManagerInterface):
+        super().__init__(manager)
+        self.async_openai_api_client = openai_api_client(manager.dot_env_config_path, async_client=True)
+
+    def chat_stream(self, context: OpenaiContext, message: dict | list[dict]) -> None:
+        "stream version of chat function with openai, it returns once the request has been handed to the commander"
+        self._append_for_sending(context=context, message=message)
+        try:
+            # Trimming counts tokens, so it is done here rather than in the loop of the commander.
+            trim_messages, tools_para = self._messages_for_sending(context)
+        except Exception as e:
+            self._sending_error(error=e, context=context, event_loop=False)
+            return
+        job = BasicJob(self.request_handler(context=context, messages=trim_messages, tools_para=tools_para))
         self.manager.gk_kernel.commander.put_job_threadsafe(job)
 
+    @handler(PASS_WORD)
+    async def request_handler(self, self_handler, context: OpenaiContext, messages: list, tools_para: dict) -> None:
+        try:
+            response = await stream_limiter.async_open_stream(
+                context.id,
+                lambda: request_scheduler.async_chat_completions_create(
+                    self.async_openai_api_client,
+                    priority=RequestPriority.USER,
+                    call_site="chat",
+                    messages=messages,
+                    **tools_para,
+                    **context.parameters,
+                ),
+            )
+        except Exception as e:
+            self._sending_error(error=e, context=context, event_loop=True)
+            return
+
+        callback, at_receiving_start = self._response_callbacks(context)
+        await self_handler.put_job(
+            ResponseJob(
+                manager=self.manager,
+                response=response,
+                context=context,
+                callback=callback,
+                at_receiving_start=at_receiving_start,
+            )
+        )
+
 
 def response_to_stream_format(mode: Literal["no_function_call", "function_call"], response) -> list:
     if mode == "no_function_call":
@@ -1,12 +1,13 @@
-import copy
 import logging
-from typing import Iterable
+from typing import AsyncIterable, Hashable, Iterable
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 
-from .context import OpenaiContext
+from .context import OpenaiContext, OpenaiContextView
 from .openai_error import OpenaiErrorHandler
 from .openai_tokens_truncate import trim_excess_tokens
+from .request_scheduler import RequestPriority, request_scheduler
+from .stream_limiter import StreamSlot, stream_limiter
 from .utils.openai_api import OpenAIClient
 from .utils.tokens_num import tokens_num_for_functions_call
 
@@ -18,10 +19,80 @@ def chat_service_for_inner(
         messages_list: list, 
         context: OpenaiContext,
         openai_api_client: OpenAIClient,
+        tools_version: Hashable | None = None,
+        priority: RequestPriority = RequestPriority.USER,
+        call_site: str | None = "inner_chat",
+        stream_slot: StreamSlot | None = None,
         **kwargs,
     ) -> Iterable:
-    
-    inner_context = copy.deepcopy(context)
+    """
+    tools_version: the version of the tools schema in kwargs, e.g. 'ManagerInterface.plugins_version',
+        used to cache the tokens num of the schema.
+    priority: the priority of the request in the request scheduler, background services should use BACKGROUND.
+    call_site: the call site of the request, for the response cache and the stream timeouts.
+    stream_slot: a slot of the stream limiter already acquired for the conversation, otherwise it waits for one here.
+    """
+    inner_context, trimmed_messages, parameters = _inner_request(messages_list, context, tools_version, **kwargs)
+    try:
+        response = stream_limiter.open_stream(
+            inner_context.id,
+            lambda: request_scheduler.chat_completions_create(
+                openai_api_client,
+                priority=priority,
+                call_site=call_site,
+                tools_version=tools_version,
+                messages=trimmed_messages,
+                **parameters,
+            ),
+            slot=stream_slot,
+        )
+    except Exception as e:
+        gptui_logger.debug('----trimmed_messages----in chat inner')
+        gptui_logger.debug(trimmed_messages)
+        # The OpenAI API interface is a time-consuming synchronous interface, so it should be called in a new thread, hence there is no event loop here.
+        OpenaiErrorHandler().openai_error_handle(error=e, context=inner_context, event_loop=False)
+        raise e
+    return response
+
+async def async_chat_service_for_inner(
+        messages_list: list, 
+        context: OpenaiContext,
+        openai_api_client: AsyncOpenAI,
+        tools_version: Hashable | None = None,
+        priority: RequestPriority = RequestPriority.USER,
+        call_site: str | None = "inner_chat",
+        **kwargs,
+    ) -> AsyncIterable:
+    "The same as 'chat_service_for_inner', but it is awaited in the event loop with an AsyncOpenAI client."
+    inner_context, trimmed_messages, parameters = _inner_request(messages_list, context, tools_version, **kwargs)
+    try:
+        response = await stream_limiter.async_open_stream(
+            inner_context.id,
+            lambda: request_scheduler.async_chat_completions_create(
+                openai_api_client,
+                priority=priority,
+                call_site=call_site,
+                tools_version=tools_version,
+                messages=trimmed_messages,
+                **parameters,
+            ),
+        )
+    except Exception as e:
+        gptui_logger.debug('----trimmed_messages----in async chat inner')
+        gptui_logger.debug(trimmed_messages)
+        OpenaiErrorHandler().openai_error_handle(error=e, context=inner_context, event_loop=True)
+        raise e
+    return response
+
+def _inner_request(
+        messages_list: list,
+        context: OpenaiContext,
+        tools_version: Hashable | None = None,
+        **kwargs,
+    ) -> tuple[OpenaiContextView, list, dict]:
+    "Return the inner context, the trimmed messages and the parameters of the request."
+    # Only the appended messages and the parameters are local to the view, the history is shared.
+    inner_context = context.view()
     
     for one_message in messages_list:
         inner_context.chat_context_append(message=one_message)
@@ -32,7 +103,7 @@ def chat_service_for_inner(
     parameters.update(**kwargs)
 
     if tools_info := parameters.get("tools"):
-        offset_tokens_num = -tokens_num_for_functions_call(tools_info, model=inner_context.parameters["model"])
+        offset_tokens_num = -tokens_num_for_functions_call(tools_info, model=inner_context.parameters["model"], version=tools_version)
     else:
         offset_tokens_num = 0
     trimmed_messages = trim_excess_tokens(inner_context, offset=offset_tokens_num)
@@ -44,16 +115,4 @@ def chat_service_for_inner(
     # Therefore, if the function reply messages are not removed, it will result in an OpenAI API error.
     while trimmed_messages and trimmed_messages[0].get("role") == "tool":
         trimmed_messages.pop(0)
-
-    try:
-        response = openai_api_client.with_options(timeout=20.0).chat.completions.create(
-            messages=trimmed_messages,
-            **parameters,
-            )
-    except Exception as e:
-        gptui_logger.debug('----trimmed_messages----in chat inner')
-        gptui_logger.debug(trimmed_messages)
-        # The OpenAI API interface is a time-consuming synchronous interface, so it should be called in a new thread, hence there is no event loop here.
-        OpenaiErrorHandler().openai_error_handle(error=e, context=inner_context, event_loop=False)
-        raise e
-    return response
+    return inner_context, trimmed_messages, parameters
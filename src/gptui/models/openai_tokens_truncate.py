@@ -1,9 +1,14 @@
+import bisect
 import logging
+import math
+import threading
+from collections import OrderedDict
+from typing import Hashable, Literal
 
 from openai.types.chat import ChatCompletionMessageParam
 
-from .context import OpenaiContext
-from .utils.tokens_num import tokens_num_from_string, tokens_num_from_chat_context
+from .context import OpenaiContext, OpenaiContextView
+from .utils.tokens_num import tokenizer_registry, tokens_num_from_string, tokens_num_from_chat_context
 
 
 gptui_logger = logging.getLogger("gptui_logger")
@@ -38,24 +43,97 @@ def find_position(lst, num):
 
     return left
 
+class TruncationPolicy:
+    """How the history is truncated when it exceeds the sending window.
+
+    - "suffix": keep the longest suffix that fits. Once the history is over the window,
+      the first message sent changes on every turn.
+    - "chunked_window": drop the history in steps of 'chunk_ratio' of the window, and keep the bead pinned at the beginning.
+      The sent messages then start the same way for many turns, so that the provider's prompt prefix cache keeps hitting.
+    """
+
+    def __init__(self, strategy: Literal["suffix", "chunked_window"] = "suffix", chunk_ratio: float = 0.25):
+        self.configure(strategy=strategy, chunk_ratio=chunk_ratio)
+
+    def configure(self, strategy: Literal["suffix", "chunked_window"] = "suffix", chunk_ratio: float = 0.25, **kwargs) -> None:
+        if strategy not in ("suffix", "chunked_window"):
+            raise ValueError(f"Unknown truncation strategy: {strategy}.")
+        if not 0.0 < chunk_ratio <= 1.0:
+            raise ValueError("'chunk_ratio' have to be in range from 0.0 to 1.0.")
+        self.strategy = strategy
+        self.chunk_ratio = chunk_ratio
+
+
+truncation_policy = TruncationPolicy()
+
+
+class PrefixCacheTracker:
+    """Record the messages last sent of each conversation, to estimate the part of a request
+    the provider can serve from its prompt prefix cache, that is, its common prefix with the previous request.
+    """
+
+    def __init__(self, max_conversations: int = 256):
+        self.max_conversations = max_conversations
+        self._lock = threading.Lock()
+        self._last: OrderedDict[Hashable, tuple[list, bool, float]] = OrderedDict()
+
+    def record(self, key: Hashable, messages: list, tokens_num_list: list[int], truncated: bool) -> float:
+        "Record a request and return the fraction of its tokens shared as a prefix with the previous request."
+        with self._lock:
+            previous = self._last.get(key)
+        shared_tokens_num = 0
+        if previous is not None:
+            for previous_message, message, tokens_num in zip(previous[0], messages, tokens_num_list):
+                if previous_message is not message and previous_message != message:
+                    break
+                shared_tokens_num += tokens_num
+        total = sum(tokens_num_list)
+        fraction = shared_tokens_num / total if total else 0.0
+        with self._lock:
+            self._last[key] = (list(messages), truncated, fraction)
+            self._last.move_to_end(key)
+            while len(self._last) > self.max_conversations:
+                self._last.popitem(last=False)
+        return fraction
+
+    def cached_prefix_fraction(self, key: Hashable, truncated_only: bool = False) -> float | None:
+        """The cached prefix fraction of the last request of the conversation, None if there is none.
+        With truncated_only, None is also returned if its history was not truncated.
+        """
+        with self._lock:
+            last = self._last.get(key)
+        if last is None or (truncated_only and not last[1]):
+            return None
+        return last[2]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._last.clear()
+
+
+prefix_cache_tracker = PrefixCacheTracker()
+
+
 def trim_excess_tokens(
-    context: OpenaiContext,
+    context: OpenaiContext | OpenaiContextView,
     max_tokens_num: int | None = None,
-    offset: int = 0
+    offset: int = 0,
+    strategy: Literal["suffix", "chunked_window"] | None = None,
 ) -> list[ChatCompletionMessageParam]:
     """Truncate the given context according to max_tokens_num, only retaining the last part.
 
     It will return a new chat_context list and not change the original chat_context.
 
     Args:
-        - context (OpenaiContext): the context need to be trimmed.
+        - context (OpenaiContext | OpenaiContextView): the context need to be trimmed.
         - max_tokens_num (int): the max tokens number allowed.
         - offset (int): for positive value, increase max_tokens_num; for negative value, decrease max_tokens_num.
+        - strategy (str | None): "suffix" or "chunked_window", see TruncationPolicy. Defaults to the configured one.
 
     Retruns:
         list[dict]: truncated chat_context of context.
     """
-    tokens_num_list = context.tokens_num_list
+    tokens_num_index = context.tokens_num_index
     if max_tokens_num is None:
         max_tokens_num = context.max_sending_tokens_num
     assert max_tokens_num is not None
@@ -67,56 +145,116 @@ def trim_excess_tokens(
             "This could likely lead to a token lenght exceeding the limit error."
         )
         return context.chat_context[-1:]
-    position = find_position(lst=tokens_num_list, num=num_after_offset)
-    if position >= len(tokens_num_list):
+    position = tokens_num_index.suffix_position(num=num_after_offset)
+    if position >= len(tokens_num_index):
+        # Even the last message alone exceeds the limit, trim its content in a single pass.
         model = context.parameters["model"]
-        trim_status = True
-        new_tokens_num = num_after_offset
-        out_dict = context.chat_context[-1:][0] # Don't change the original context.
-        while trim_status:
-            new_tokens_num -= 5
-            if new_tokens_num <= 0: # The number 5 is the assumed additional tokens count in message dict compared to message content
-                out_dict["content"] = ""
-                return [out_dict]
-            out_dict_content = out_dict["content"]
-            assert isinstance(out_dict_content, str)
-            trim_string = trim_string_by_tokens(out_dict_content, max_tokens=new_tokens_num, model=model)
-            out_dict["content"] = trim_string
-            if tokens_num_from_chat_context([out_dict], model=model) < num_after_offset:
-                trim_status = False
+        out_dict = dict(context.chat_context[-1]) # Don't change the original context.
+        out_dict_content = out_dict["content"]
+        assert isinstance(out_dict_content, str)
+        overhead_tokens_num = tokens_num_from_chat_context([{**out_dict, "content": ""}], model=model)
+        # The trimmed message must be strictly less than num_after_offset.
+        content_max_tokens = num_after_offset - overhead_tokens_num - 1
+        out_dict["content"] = trim_string_by_tokens(out_dict_content, max_tokens=content_max_tokens, model=model, snap="word")
         return [out_dict]
-    return context.chat_context[position:]
+    tokens_num_list = tokens_num_index.values
+    pinned = []
+    if position > 0 and (strategy or truncation_policy.strategy) == "chunked_window":
+        chunked = _chunked_window_position(context, num_after_offset)
+        if chunked is not None:
+            position, pinned = chunked
+    messages = [context.chat_context[index] for index in pinned] + context.chat_context[position:]
+    if context.id is not None:
+        prefix_cache_tracker.record(
+            context.id,
+            messages,
+            [tokens_num_list[index] for index in pinned] + tokens_num_list[position:],
+            truncated=position > 0,
+        )
+    return messages
 
-def trim_string_by_tokens(string: str, max_tokens: int, model: str) -> str:
+def _chunked_window_position(context: OpenaiContext | OpenaiContextView, num: int) -> tuple[int, list[int]] | None:
+    """The start of the kept messages, dropped in fixed steps of tokens so that it only moves once in a while,
+    and the indexes of the bead messages pinned before it.
+    Return None if no such window fits, the suffix strategy is used then.
+    """
+    tokens_num_index = context.tokens_num_index
+    total = tokens_num_index.total
+    bead_length = len(getattr(context, "bead", None) or [])
+    bead_positions = getattr(context, "bead_positions", None) or []
+    # The bead pinned is the last one before the window, its size is estimated by the first one.
+    pinned_tokens_num = tokens_num_index.range_sum(bead_positions[0], bead_positions[0] + bead_length) if bead_positions and bead_length else 0
+    window = num - pinned_tokens_num
+    if window <= 0:
+        return None
+    step = max(math.floor(window * truncation_policy.chunk_ratio), 1)
+    # At least total - window + 1 tokens are dropped, so that the rest is less than the window, rounded up to whole steps.
+    drop = math.ceil((total - window + 1) / step) * step
+    if drop >= total:
+        return None
+    position = tokens_num_index.suffix_position(num=total - drop + 1)
+    pinned = []
+    bead_index = bisect.bisect_right(bead_positions, position) - 1
+    if bead_index >= 0 and bead_length:
+        bead_position = bead_positions[bead_index]
+        if position < bead_position + bead_length:
+            # The window starts with or inside a bead, it starts right after it with the bead pinned.
+            position = bead_position + bead_length
+        pinned = list(range(bead_position, bead_position + bead_length))
+    # A tool reply can not follow the bead, its call has been dropped.
+    while position < len(tokens_num_index) and context.chat_context[position].get("role") == "tool":
+        position += 1
+    if position >= len(tokens_num_index):
+        return None
+    if tokens_num_index.range_sum(position) + sum(tokens_num_index.range_sum(index, index + 1) for index in pinned) >= num:
+        return None
+    return position, pinned
+
+def trim_string_by_tokens(string: str, max_tokens: int, model: str, snap: Literal["word", "line"] | None = None) -> str:
     """trims the input string based on a specified maximum token count.
         - If the overall token count of the input string is less than or equal to the specified maximum token count, the function returns the original string as is.
-        - If the token count of the input string exceeds the specified maximum, the function trims words from the beginning of the string progressively until the token count does not exceed the limit.
+        - If the token count of the input string exceeds the specified maximum, the string is encoded once,
+          only the last max_tokens tokens are kept and decoded back, so the beginning of the string is trimmed.
 
     Parameters:
         - string (str): The input string to be trimmed.
         - max_tokens (int): The allowable maximum token count.
+        - model (str): The model whose encoding is used.
+        - snap (str | None): Post-pass that drops the partial leading word ("word") or line ("line") left by the token cut.
+            It only takes effect if such a boundary exists in the trimmed string.
 
     Returns:
         - str: The trimmed string where the token count does not surpass the specified maximum token count.
     """
-    words = string.split()
-    if tokens_num_from_string(string, model) <= max_tokens:
+    if max_tokens <= 0:
+        return ""
+    encoding = tokenizer_registry.encoding_for_model(model)
+    tokens = encoding.encode(string)
+    if len(tokens) <= max_tokens:
         return string
 
-    left, right = 0, len(words)
-    
-    while left < right:
-        mid = (left + right) // 2
-        current_str = ' '.join(words[mid:])
-        current_tokens = tokens_num_from_string(current_str, model)
-        
-        if current_tokens == max_tokens:
-            return current_str
-        elif current_tokens < max_tokens:
-            right = mid
-        else:
-            left = mid + 1
+    keep_num = max_tokens
+    while keep_num > 0:
+        # A token cut may fall inside a multi-byte character, drop the incomplete bytes at the beginning.
+        trimmed_string = encoding.decode_bytes(tokens[-keep_num:]).decode("utf-8", errors="ignore")
+        if snap == "word":
+            trimmed_string = _snap_to_boundary(trimmed_string, boundary=None)
+        elif snap == "line":
+            trimmed_string = _snap_to_boundary(trimmed_string, boundary="\n")
+        # Re-encoding a suffix usually gives the same tokens, but merges at the cut can differ, so it is checked.
+        if tokens_num_from_string(trimmed_string, model) <= max_tokens:
+            return trimmed_string
+        keep_num -= 1
+    return ""
 
-    if right == len(words):
-        return ""
-    return ' '.join(words[right:])
+def _snap_to_boundary(string: str, boundary: str | None) -> str:
+    "Drop the content before the first boundary, where None means any whitespace."
+    if boundary is None:
+        parts = string.split(maxsplit=1)
+        if len(parts) == 2 and not string[0].isspace():
+            return parts[1]
+        return string.lstrip()
+    position = string.find(boundary)
+    if position == -1 or position == len(string) - 1:
+        return string
+    return string[position + 1:]
@@ -0,0 +1,466 @@
+from __future__ import annotations
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import re
+import threading
+import time
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Hashable, Mapping, TypeVar
+
+import openai
+
+from .response_cache import response_cache
+from .stream_timeout import AsyncGuardedStream, GuardedStream, stream_timeout_policy
+from .utils.tokens_num import tokens_num_for_functions_call, tokens_num_from_chat_context
+
+
+gptui_logger = logging.getLogger("gptui_logger")
+
+
+T = TypeVar("T")
+
+
+class RequestPriority(IntEnum):
+    "The smaller one is served first."
+    USER = 0  # Messages from the user and their function call follow-ups.
+    NORMAL = 1  # Group talk roles.
+    BACKGROUND = 2  # AI-care, reminders, conversation titles.
+
+
+class TokenBucket:
+    """A bucket refilled continuously up to its capacity.
+    An amount larger than the capacity can be taken from a full bucket, leaving it in debt.
+    """
+
+    def __init__(self, capacity: float, per_seconds: float = 60.0):
+        self.capacity = capacity
+        self.per_seconds = per_seconds
+        self.level = capacity
+        self._last = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.per_seconds
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self._last) * self.rate)
+        self._last = now
+
+    def time_until(self, amount: float) -> float:
+        "Seconds until the amount can be taken, 0 if it can be taken now."
+        missing = min(amount, self.capacity) - self.level
+        return max(missing, 0) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self, amount: float) -> None:
+        self.level -= amount
+
+
+class ModelBudget:
+    """Requests per minute and tokens per minute of a model.
+    The requests taken and not settled yet, whose responses have not come, are counted as in flight.
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.in_flight_requests = 0
+        self.in_flight_tokens = 0
+
+    def time_until(self, tokens_num: int, now: float) -> float:
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return max(self.requests.time_until(1), self.tokens.time_until(tokens_num))
+
+    def take(self, tokens_num: int) -> None:
+        self.requests.take(1)
+        self.tokens.take(tokens_num)
+        self.in_flight_requests += 1
+        self.in_flight_tokens += tokens_num
+
+    def settle(self, tokens_num: int) -> None:
+        "A request taken before is no longer in flight."
+        self.in_flight_requests = max(self.in_flight_requests - 1, 0)
+        self.in_flight_tokens = max(self.in_flight_tokens - tokens_num, 0)
+
+    def update_from_headers(self, headers: Mapping[str, str], now: float) -> None:
+        """Adopt the limits and the remaining budget reported by the x-ratelimit-* headers.
+        The remaining budget replaces our own estimate, both ways, less what is taken by the requests in flight,
+        which the server may not have counted yet.
+        """
+        for bucket, kind, in_flight in (
+            (self.requests, "requests", self.in_flight_requests),
+            (self.tokens, "tokens", self.in_flight_tokens),
+        ):
+            limit = _int_header(headers, f"x-ratelimit-limit-{kind}")
+            remaining = _int_header(headers, f"x-ratelimit-remaining-{kind}")
+            if limit:
+                bucket.refill(now)
+                bucket.capacity = limit
+            if remaining is not None:
+                bucket.refill(now)
+                bucket.level = min(remaining, bucket.capacity) - in_flight
+
+
+class RequestScheduler:
+    """Every LLM request goes through here, so that concurrent conversations, group talk roles and AI-care
+    share the rate limits of each model instead of running into 429 errors.
+
+    - The RPM and TPM budgets of each model are token buckets, taken by our own tokens num estimate
+      and corrected by the x-ratelimit-* headers of the responses.
+    - Waiting requests of a model are served by priority, then in arrival order.
+    - Rate limit, timeout, connection and server errors are retried with exponential backoff and full jitter,
+      or after the time given by the retry-after header.
+
+    It can be used from threads (blocking) and from event loops (awaiting).
+    """
+
+    def __init__(
+        self,
+        default_rpm: int = 500,
+        default_tpm: int = 30000,
+        max_retries: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        poll_interval: float = 0.1,
+    ):
+        self._budgets: dict[str, ModelBudget] = {}
+        self._waiting: dict[str, list[tuple[int, int]]] = {}
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self.poll_interval = poll_interval
+        self.retries = 0
+        self.configure(default_rpm=default_rpm, default_tpm=default_tpm, max_retries=max_retries, base_delay=base_delay, max_delay=max_delay)
+
+    def configure(
+        self,
+        default_rpm: int = 500,
+        default_tpm: int = 30000,
+        max_retries: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        **kwargs,
+    ) -> None:
+        "Set the default budgets of models without reported limits and the retry policy."
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def _budget(self, model: str) -> ModelBudget:
+        budget = self._budgets.get(model)
+        if budget is None:
+            budget = self._budgets[model] = ModelBudget(rpm=self.default_rpm, tpm=self.default_tpm)
+        return budget
+
+    def _enqueue(self, model: str, priority: int) -> tuple[int, int]:
+        ticket = (int(priority), next(self._counter))
+        heapq.heappush(self._waiting.setdefault(model, []), ticket)
+        return ticket
+
+    def _dequeue(self, model: str, ticket: tuple[int, int]) -> None:
+        waiting = self._waiting[model]
+        if waiting and waiting[0] == ticket:
+            heapq.heappop(waiting)
+        else:
+            waiting.remove(ticket)
+            heapq.heapify(waiting)
+        self._cond.notify_all()
+
+    def _try_take(self, model: str, ticket: tuple[int, int], tokens_num: int) -> float | None:
+        "Take the budget if it is the turn of the ticket. Return None if taken, otherwise the seconds to wait."
+        if self._waiting[model][0] != ticket:
+            return self.poll_interval
+        budget = self._budget(model)
+        wait = budget.time_until(tokens_num, time.monotonic())
+        if wait > 0:
+            return wait
+        budget.take(tokens_num)
+        self._dequeue(model, ticket)
+        return None
+
+    def acquire(self, model: str, tokens_num: int, priority: int = RequestPriority.USER) -> None:
+        "Block until the request can be sent. It is in flight until it is settled."
+        with self._cond:
+            ticket = self._enqueue(model, priority)
+            try:
+                while (wait := self._try_take(model, ticket, tokens_num)) is not None:
+                    self._cond.wait(timeout=wait)
+            except BaseException:
+                self._dequeue(model, ticket)
+                raise
+
+    async def async_acquire(self, model: str, tokens_num: int, priority: int = RequestPriority.USER) -> None:
+        "Wait until the request can be sent, without blocking the event loop."
+        with self._cond:
+            ticket = self._enqueue(model, priority)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_take(model, ticket, tokens_num)
+                if wait is None:
+                    return
+                await asyncio.sleep(min(wait, self.poll_interval))
+        except BaseException:
+            with self._cond:
+                if ticket in self._waiting[model]:
+                    self._dequeue(model, ticket)
+            raise
+
+    def update_from_headers(self, model: str, headers: Mapping[str, str]) -> None:
+        with self._cond:
+            self._budget(model).update_from_headers(headers, time.monotonic())
+            self._cond.notify_all()
+
+    def settle(self, model: str, tokens_num: int, headers: Mapping[str, str] | None = None) -> None:
+        """Settle a request acquired before, once its response or error has come.
+        The headers of the response, if given, are taken into account after it is no longer in flight.
+        """
+        with self._cond:
+            budget = self._budget(model)
+            budget.settle(tokens_num)
+            if headers is not None:
+                budget.update_from_headers(headers, time.monotonic())
+            self._cond.notify_all()
+
+    def retry_delay(self, error: Exception, attempt: int, model: str) -> float | None:
+        "The seconds to wait before retrying after the error, or None if it should not be retried."
+        if attempt >= self.max_retries:
+            return None
+        if isinstance(error, openai.APIStatusError):
+            if error.status_code != 429 and error.status_code < 500:
+                return None
+            headers = error.response.headers
+            self.update_from_headers(model, headers)
+            retry_after = _retry_after(headers)
+            if retry_after is not None:
+                return min(retry_after, self.max_delay)
+        elif not isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+            return None
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(
+        self,
+        func: Callable[[], T],
+        model: str,
+        tokens_num: int = 0,
+        priority: int = RequestPriority.USER,
+        headers_of: Callable[[T], Mapping[str, str]] | None = None,
+    ) -> T:
+        """Call func once the budget allows it, retrying on transient errors. It blocks, so it should be called in a thread.
+        headers_of: get the headers of the result of func, the rate limit headers among them are taken into account.
+        """
+        attempt = 0
+        while True:
+            self.acquire(model, tokens_num, priority)
+            try:
+                result = func()
+            except BaseException as e:
+                self.settle(model, tokens_num)
+                if not isinstance(e, Exception):
+                    raise
+                delay = self.retry_delay(e, attempt, model)
+                if delay is None:
+                    raise
+                gptui_logger.warning(f"Request to {model} failed, retry in {delay:.1f}s. Error: {e}")
+                self.retries += 1
+                attempt += 1
+                time.sleep(delay)
+            else:
+                self.settle(model, tokens_num, headers_of(result) if headers_of is not None else None)
+                return result
+
+    async def async_call(
+        self,
+        coro_func: Callable[[], Awaitable[T]],
+        model: str,
+        tokens_num: int = 0,
+        priority: int = RequestPriority.USER,
+        headers_of: Callable[[T], Mapping[str, str]] | None = None,
+    ) -> T:
+        "The same as 'call', for coroutine functions."
+        attempt = 0
+        while True:
+            await self.async_acquire(model, tokens_num, priority)
+            try:
+                result = await coro_func()
+            except BaseException as e:
+                self.settle(model, tokens_num)
+                if not isinstance(e, Exception):
+                    raise
+                delay = self.retry_delay(e, attempt, model)
+                if delay is None:
+                    raise
+                gptui_logger.warning(f"Request to {model} failed, retry in {delay:.1f}s. Error: {e}")
+                self.retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+            else:
+                self.settle(model, tokens_num, headers_of(result) if headers_of is not None else None)
+                return result
+
+    def chat_completions_create(
+        self,
+        client: openai.OpenAI,
+        priority: int = RequestPriority.USER,
+        call_site: str | None = None,
+        tools_version: Hashable | None = None,
+        **kwargs,
+    ) -> Any:
+        """Scheduled 'client.chat.completions.create(**kwargs)', the rate limit headers of the response are taken into account.
+        call_site: the call site of the request, a response cached for the site is replayed without a request,
+        and the timeouts of the site are applied. A stream is guarded against stalls, see GuardedStream.
+        tools_version: the version of the tools schema in kwargs, e.g. 'ManagerInterface.plugins_version',
+            so that the tokens num of the schema is not computed again for each request.
+        """
+        if (cached := response_cache.load_chat_completion(call_site, kwargs)) is not None:
+            return cached
+        # The scheduler is the only retry layer, the retries of the client would bypass the budgets.
+        client = client.with_options(max_retries=0)
+        model = kwargs["model"]
+        timeouts = stream_timeout_policy.timeouts(call_site)
+        kwargs.setdefault("timeout", timeouts.httpx_timeout())
+
+        def open_response(request_kwargs: dict) -> tuple[Any, float]:
+            sent_at = time.monotonic()
+
+            def create():
+                nonlocal sent_at
+                sent_at = time.monotonic()
+                return client.chat.completions.with_raw_response.create(**request_kwargs)
+
+            raw_response = self.call(
+                create,
+                model=model,
+                tokens_num=estimate_tokens_num(request_kwargs, tools_version=tools_version),
+                priority=priority,
+                headers_of=lambda raw_response: raw_response.headers,
+            )
+            return raw_response.parse(), sent_at
+
+        response, sent_at = open_response(kwargs)
+        if kwargs.get("stream"):
+            response = GuardedStream(
+                response,
+                reopen=lambda messages: open_response({**kwargs, "messages": messages}),
+                messages=list(kwargs["messages"]),
+                timeouts=timeouts,
+                max_retries=stream_timeout_policy.max_stall_retries,
+                sent_at=sent_at,
+            )
+        return response_cache.record_chat_completion(call_site, kwargs, response)
+
+    async def async_chat_completions_create(
+        self,
+        client: openai.AsyncOpenAI,
+        priority: int = RequestPriority.USER,
+        call_site: str | None = None,
+        tools_version: Hashable | None = None,
+        **kwargs,
+    ) -> Any:
+        "The same as 'chat_completions_create', for AsyncOpenAI clients."
+        if (cached := response_cache.load_chat_completion(call_site, kwargs, async_stream=True)) is not None:
+            return cached
+        client = client.with_options(max_retries=0)
+        model = kwargs["model"]
+        timeouts = stream_timeout_policy.timeouts(call_site)
+        kwargs.setdefault("timeout", timeouts.httpx_timeout())
+
+        async def open_response(request_kwargs: dict) -> tuple[Any, float]:
+            sent_at = time.monotonic()
+
+            async def create():
+                nonlocal sent_at
+                sent_at = time.monotonic()
+                return await client.chat.completions.with_raw_response.create(**request_kwargs)
+
+            raw_response = await self.async_call(
+                create,
+                model=model,
+                tokens_num=estimate_tokens_num(request_kwargs, tools_version=tools_version),
+                priority=priority,
+                headers_of=lambda raw_response: raw_response.headers,
+            )
+            return raw_response.parse(), sent_at
+
+        response, sent_at = await open_response(kwargs)
+        if kwargs.get("stream"):
+            response = AsyncGuardedStream(
+                response,
+                reopen=lambda messages: open_response({**kwargs, "messages": messages}),
+                messages=list(kwargs["messages"]),
+                timeouts=timeouts,
+                max_retries=stream_timeout_policy.max_stall_retries,
+                sent_at=sent_at,
+            )
+        return response_cache.record_chat_completion(call_site, kwargs, response)
+
+    def info(self) -> dict:
+        "The budgets left and the waiting requests of each model."
+        with self._cond:
+            now = time.monotonic()
+            models = {}
+            for model, budget in self._budgets.items():
+                budget.time_until(0, now)
+                models[model] = {
+                    "requests_left": int(budget.requests.level),
+                    "tokens_left": int(budget.tokens.level),
+                    "waiting": len(self._waiting.get(model, [])),
+                }
+            return {"models": models, "retries": self.retries}
+
+
+request_scheduler = RequestScheduler()
+
+
+def estimate_tokens_num(request_kwargs: dict, tools_version: Hashable | None = None) -> int:
+    """The tokens num a chat completion request is charged for: the prompt, the tools and the max tokens of the reply.
+    tools_version: the version of the tools schema, the tokens num of the schema is cached by it.
+    """
+    model = request_kwargs["model"]
+    messages = request_kwargs.get("messages") or []
+    try:
+        tokens_num = tokens_num_from_chat_context(messages, model=model)
+        if tools := request_kwargs.get("tools"):
+            tokens_num += tokens_num_for_functions_call(tools, model=model, version=tools_version)
+    except NotImplementedError:
+        # Roughly 4 characters per token.
+        tokens_num = len(str(messages)) // 4 + len(str(request_kwargs.get("tools") or "")) // 4
+    return tokens_num + (request_kwargs.get("max_tokens") or 0)
+
+
+def _int_header(headers: Mapping[str, str], name: str) -> int | None:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def _retry_after(headers: Mapping[str, str]) -> float | None:
+    "Seconds given by the retry-after-ms, retry-after or x-ratelimit-reset-* headers."
+    if (value := headers.get("retry-after-ms")) is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    if (value := headers.get("retry-after")) is not None:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    resets = [
+        sum(float(number) * _DURATION_UNITS[unit] for number, unit in _DURATION_PATTERN.findall(value))
+        for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+        if (value := headers.get(name))
+    ]
+    return max(resets) if resets else None
@@ -0,0 +1,202 @@
+from __future__ import annotations
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, AsyncIterable, Iterable
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+
+gptui_logger = logging.getLogger("gptui_logger")
+
+
+# Request options which do not change the response.
+_NON_SEMANTIC_KEYS = {"timeout", "extra_headers", "extra_query", "extra_body", "user"}
+
+
+class ResponseCache:
+    """A content-addressed cache of LLM responses on disk, for requests whose response is worth replaying,
+    e.g. conversation titles, semantic skills and temperature 0 chats.
+
+    The key is the hash of the model, the messages, the tools and the sampling parameters.
+    Each call site has to be enabled, and the cache is bounded in size, evicting the least recently used entries.
+    A cached stream is replayed as chunks of the same type, so it goes through the same response pipeline.
+    """
+
+    def __init__(self, path: str | None = None, max_size_mb: float = 50, enable: bool = False, call_sites: dict[str, bool] | None = None):
+        self._lock = threading.Lock()
+        self._index: OrderedDict[str, int] | None = None
+        self.hits = 0
+        self.misses = 0
+        self.configure(path=path, max_size_mb=max_size_mb, enable=enable, call_sites=call_sites)
+
+    def configure(self, path: str | None = None, max_size_mb: float = 50, enable: bool = False, call_sites: dict[str, bool] | None = None, **kwargs) -> None:
+        with self._lock:
+            self.path = os.path.expanduser(path) if path else None
+            self.max_size = int(max_size_mb * 1024 * 1024)
+            self.enable = enable
+            self.call_sites = dict(call_sites or {})
+            self._index = None
+
+    def enabled(self, call_site: str | None) -> bool:
+        return bool(self.enable and self.path and call_site and self.call_sites.get(call_site))
+
+    @staticmethod
+    def key(request: dict) -> str:
+        "The hash of the parts of the request which determine the response."
+        semantic_request = {k: v for k, v in request.items() if k not in _NON_SEMANTIC_KEYS and v is not None}
+        request_str = json.dumps(semantic_request, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(request_str.encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        assert self.path is not None
+        return os.path.join(self.path, key + ".json")
+
+    def _load_index(self) -> OrderedDict[str, int]:
+        "The entries on disk with their sizes, the least recently used first. It is called with the lock held."
+        if self._index is None:
+            assert self.path is not None
+            os.makedirs(self.path, exist_ok=True)
+            entries = []
+            for entry in os.scandir(self.path):
+                if entry.name.endswith(".json") and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name[:-5], stat.st_size))
+            self._index = OrderedDict((key, size) for _, key, size in sorted(entries))
+        return self._index
+
+    def get(self, call_site: str | None, request: dict) -> tuple[str, Any] | None:
+        "Return the (kind, payload) cached for the request, or None."
+        if not self.enabled(call_site):
+            return None
+        key = self.key(request)
+        with self._lock:
+            index = self._load_index()
+            if key not in index:
+                self.misses += 1
+                return None
+            try:
+                with open(self._entry_path(key), "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+                os.utime(self._entry_path(key))
+            except (OSError, ValueError) as e:
+                gptui_logger.warning(f"Reading the response cache entry {key} failed. Error: {e}")
+                del index[key]
+                self.misses += 1
+                return None
+            index.move_to_end(key)
+            self.hits += 1
+        return entry["kind"], entry["payload"]
+
+    def put(self, call_site: str | None, request: dict, kind: str, payload: Any) -> None:
+        "Cache the payload of the request, evicting the least recently used entries beyond the size limit."
+        if not self.enabled(call_site):
+            return
+        key = self.key(request)
+        data = json.dumps({"kind": kind, "payload": payload}, ensure_ascii=False)
+        with self._lock:
+            index = self._load_index()
+            entry_path = self._entry_path(key)
+            try:
+                # Written to a temporary file first, so that a reader never sees a partial entry.
+                temp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    f.write(data)
+                os.replace(temp_path, entry_path)
+            except OSError as e:
+                gptui_logger.warning(f"Writing the response cache entry {key} failed. Error: {e}")
+                return
+            index[key] = len(data.encode("utf-8"))
+            index.move_to_end(key)
+            total_size = sum(index.values())
+            while total_size > self.max_size and len(index) > 1:
+                old_key, old_size = index.popitem(last=False)
+                total_size -= old_size
+                try:
+                    os.remove(self._entry_path(old_key))
+                except OSError:
+                    pass
+
+    @staticmethod
+    def deterministic(request: dict) -> bool:
+        "Only chat completions with temperature 0 are cached, others are expected to vary."
+        return request.get("temperature") == 0
+
+    def load_chat_completion(self, call_site: str | None, request: dict, async_stream: bool = False) -> Any | None:
+        """Return the cached response of a chat completion request in the form of a fresh response, or None.
+        A stream is replayed as an async iterable if async_stream is True.
+        """
+        if not self.deterministic(request):
+            return None
+        cached = self.get(call_site, request)
+        if cached is None:
+            return None
+        kind, payload = cached
+        if kind == "completion":
+            return _parse_model(ChatCompletion, payload)
+        chunks = [_parse_model(ChatCompletionChunk, chunk) for chunk in payload]
+        if async_stream:
+            async def replay():
+                for chunk in chunks:
+                    yield chunk
+            return replay()
+        return iter(chunks)
+
+    def record_chat_completion(self, call_site: str | None, request: dict, response: Any) -> Any:
+        "Cache the response once it has been received completely, and return it, or a stream passing it through."
+        if not self.enabled(call_site) or not self.deterministic(request):
+            return response
+        if isinstance(response, ChatCompletion):
+            self.put(call_site, request, "completion", response.model_dump(mode="json"))
+            return response
+        if isinstance(response, AsyncIterable):
+            return self._record_async_stream(call_site, request, response)
+        return self._record_stream(call_site, request, response)
+
+    def _record_stream(self, call_site: str, request: dict, response: Iterable):
+        chunks = []
+        for chunk in response:
+            chunks.append(chunk)
+            yield chunk
+        # Only a stream which has been received to its end is cached.
+        if chunks and any(choice.finish_reason for choice in chunks[-1].choices):
+            self.put(call_site, request, "stream", [chunk.model_dump(mode="json") for chunk in chunks])
+
+    async def _record_async_stream(self, call_site: str, request: dict, response: AsyncIterable):
+        chunks = []
+        async for chunk in response:
+            chunks.append(chunk)
+            yield chunk
+        if chunks and any(choice.finish_reason for choice in chunks[-1].choices):
+            self.put(call_site, request, "stream", [chunk.model_dump(mode="json") for chunk in chunks])
+
+    def info(self) -> dict:
+        with self._lock:
+            index = self._index or {}
+            return {"hits": self.hits, "misses": self.misses, "entries": len(index), "size": sum(index.values())}
+
+    def clear(self) -> None:
+        "Remove all the entries on disk."
+        with self._lock:
+            if self.path is None:
+                return
+            for key in self._load_index():
+                try:
+                    os.remove(self._entry_path(key))
+                except OSError:
+                    pass
+            self._index = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+
+
+response_cache = ResponseCache()
+
+
+def _parse_model(model_class: type, data: dict) -> Any:
+    # The openai models are pydantic v1 or v2 models, depending on the installed pydantic.
+    parse = getattr(model_class, "model_validate", None) or model_class.parse_obj
+    return parse(data)
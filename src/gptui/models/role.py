@@ -1,7 +1,6 @@
 from __future__ import annotations
-import copy
 import logging
-from typing import TYPE_CHECKING, Iterable, Generator, cast
+from typing import TYPE_CHECKING, AsyncIterable, Iterable, Generator, cast
 
 from agere.utils.llm_async_converters import LLMAsyncAdapter
 from ai_care import AICare, AICareContext
@@ -10,6 +9,8 @@ from openai.types.chat import ChatCompletionMessageParam
 from .context import BeadOpenaiContext, OpenaiContext
 from .openai_error import OpenaiErrorHandler
 from .openai_tokens_truncate import trim_excess_tokens
+from .request_scheduler import RequestPriority, request_scheduler
+from .stream_limiter import stream_limiter
 from .utils.openai_api import openai_api_client
 from ..gptui_kernel.manager import ManagerInterface
 
@@ -52,7 +53,12 @@ class Role:
             + "there is no need to ask 'Can I speak?' first."
         )
 
-    def chat(self, message: ChatCompletionMessageParam | list[ChatCompletionMessageParam]) -> Iterable:
+    @property
+    def stream_key(self) -> tuple[str, int | None]:
+        "All roles of a group talk share the stream slots of the group talk."
+        return ("group_talk", self.group_talk_manager.group_talk_manager_id)
+
+    def chat(self, message: ChatCompletionMessageParam | list[ChatCompletionMessageParam]) -> AsyncIterable:
         self.context.auto_insert_bead()
         if isinstance(message, dict):
             self.context.chat_context_append(message=message)
@@ -62,15 +68,23 @@ class Role:
         self.context.parameters = self.openai_context_parent.parameters.copy()
         self.context.parameters["stream"] = True
         trim_messages = trim_excess_tokens(self.context, offset=0)
-        try:
-            response = self.openai_api_client.with_options(timeout=20.0).chat.completions.create(
-                messages=trim_messages,
-                **self.context.parameters,
-            )
-        except Exception as e:
-            OpenaiErrorHandler().openai_error_handle(error=e, context=self.context, event_loop=True)
-            raise e
-        return response
+        parameters = self.context.parameters.copy()
+
+        def open_stream() -> Iterable:
+            try:
+                return request_scheduler.chat_completions_create(
+                    self.openai_api_client,
+                    priority=RequestPriority.NORMAL,
+                    call_site="group_talk",
+                    messages=trim_messages,
+                    **parameters,
+                )
+            except Exception as e:
+                OpenaiErrorHandler().openai_error_handle(error=e, context=self.context, event_loop=False)
+                raise e
+
+        # It is called in the loop of the commander, so the request is sent once the stream is iterated and a slot is granted.
+        return stream_limiter.lazy_stream(self.stream_key, open_stream)
 
     def to_llm_method(self, chat_context, to_llm_messages: list[AICareContext]) -> Generator[str, None, None]:
         messages_list = [
@@ -78,19 +92,24 @@ class Role:
             else {"role": "assistant", "content": message["content"]}
             for message in to_llm_messages
         ]
-        context = copy.deepcopy(self.context)
-        assert isinstance(context, BeadOpenaiContext)
+        assert isinstance(self.context, BeadOpenaiContext)
+        context = self.context.view(parameters=self.openai_context_parent.parameters.copy())
         context.auto_insert_bead()
         for one_message in messages_list:
             one_message = cast(ChatCompletionMessageParam, one_message)
             context.chat_context_append(message=one_message)
-        context.parameters = self.openai_context_parent.parameters.copy()
         context.parameters["stream"] = True
         trim_messages = trim_excess_tokens(context, offset=0)
         try:
-            openai_response = self.openai_api_client.with_options(timeout=20.0).chat.completions.create(
-                messages=trim_messages,
-                **context.parameters,
+            openai_response = stream_limiter.open_stream(
+                self.stream_key,
+                lambda: request_scheduler.chat_completions_create(
+                    self.openai_api_client,
+                    priority=RequestPriority.BACKGROUND,
+                    call_site="group_talk",
+                    messages=trim_messages,
+                    **context.parameters,
+                ),
             )
         except Exception as e:
             raise e
@@ -0,0 +1,94 @@
+from __future__ import annotations
+import asyncio
+import logging
+from typing import AsyncIterable, AsyncIterator, Callable
+
+
+gptui_logger = logging.getLogger("gptui_logger")
+
+
+SENTENCE_ENDINGS = (".", "!", "?", ";", ":", "。", "！", "？", "；", "：", "\n")
+
+
+def is_sentence_boundary(delta: str) -> bool:
+    "Whether the delta begins the end of a sentence, the way the voice stream is divided."
+    return delta.startswith(SENTENCE_ENDINGS)
+
+
+class StreamFlushPolicy:
+    """When the deltas of a response stream are passed on to the display, together.
+
+    A batch is flushed when its first delta has waited for interval_ms, when it has max_chars characters,
+    and at a sentence boundary if it is asked for, e.g. to keep the voice in step with the text.
+    With enable False, every delta is a batch of its own.
+    """
+
+    def __init__(self, enable: bool = True, interval_ms: float = 33, max_chars: int = 400, sentence_flush: bool = True):
+        self.configure(enable=enable, interval_ms=interval_ms, max_chars=max_chars, sentence_flush=sentence_flush)
+
+    def configure(self, enable: bool = True, interval_ms: float = 33, max_chars: int = 400, sentence_flush: bool = True, **kwargs) -> None:
+        self.enable = enable
+        self.interval = max(interval_ms, 0) / 1000
+        self.max_chars = max_chars
+        self.sentence_flush = sentence_flush
+
+    def coalesce(self, source: AsyncIterable[str], boundary: Callable[[str], bool] | None = None) -> AsyncIterator[list[str]]:
+        """Group the deltas of the source into batches, the lists of the deltas.
+        boundary tells the deltas after which a batch is flushed at once, it is used if sentence_flush is True.
+        """
+        if not self.enable:
+            return _one_by_one(source)
+        return _coalesce(source, self.interval, self.max_chars, boundary if self.sentence_flush else None)
+
+
+stream_flush_policy = StreamFlushPolicy()
+
+
+async def _one_by_one(source: AsyncIterable[str]) -> AsyncIterator[list[str]]:
+    async for delta in source:
+        yield [delta]
+
+
+async def _coalesce(
+    source: AsyncIterable[str],
+    interval: float,
+    max_chars: int,
+    boundary: Callable[[str], bool] | None,
+) -> AsyncIterator[list[str]]:
+    loop = asyncio.get_running_loop()
+    iterator = source.__aiter__()
+    batch: list[str] = []
+    batch_chars = 0
+    deadline = 0.0
+    next_delta: asyncio.Future | None = None
+    try:
+        while True:
+            if next_delta is None:
+                next_delta = asyncio.ensure_future(iterator.__anext__())
+            if batch:
+                # The pending delta is not cancelled at the deadline, which would end the source, it is waited for after the flush.
+                done, _ = await asyncio.wait({next_delta}, timeout=max(deadline - loop.time(), 0))
+                if not done:
+                    yield batch
+                    batch, batch_chars = [], 0
+                    continue
+            else:
+                await asyncio.wait({next_delta})
+            try:
+                delta = next_delta.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                next_delta = None
+            if not batch:
+                deadline = loop.time() + interval
+            batch.append(delta)
+            batch_chars += len(delta)
+            if batch_chars >= max_chars or loop.time() >= deadline or (boundary is not None and boundary(delta)):
+                yield batch
+                batch, batch_chars = [], 0
+        if batch:
+            yield batch
+    finally:
+        if next_delta is not None and not next_delta.done():
+            next_delta.cancel()
@@ -0,0 +1,254 @@
+from __future__ import annotations
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import AsyncIterable, Awaitable, Callable, Hashable, Iterable
+
+
+gptui_logger = logging.getLogger("gptui_logger")
+
+
+class StreamSlot:
+    """The right to run one stream, given by StreamLimiter.
+    It is released by the stream holding it, a slot which is dropped without being released is released when collected.
+    """
+
+    def __init__(self, limiter: StreamLimiter, key: Hashable):
+        self.limiter = limiter
+        self.key = key
+        self.released = False
+
+    def release(self) -> None:
+        "Give the slot back, it can be called more than once."
+        if not self.released:
+            self.released = True
+            self.limiter._release(self.key)
+
+    def __enter__(self) -> StreamSlot:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            pass
+
+
+class _Waiter:
+    def __init__(self, key: Hashable, loop: asyncio.AbstractEventLoop | None = None):
+        self.key = key
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        if loop is None:
+            self.event = threading.Event()
+            self.future = None
+        else:
+            self.event = None
+            self.loop = loop
+            self.future = loop.create_future()
+
+    def grant(self) -> None:
+        self.granted = True
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._set_future)
+
+    def _set_future(self) -> None:
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class StreamLimiter:
+    """Bound the LLM response streams running at once, globally and per conversation.
+
+    Streams waiting for a slot are queued per conversation, and the conversations take turns (round robin),
+    so a busy group talk can not starve the conversation the user is typing in.
+    A slot is held from sending the request until the response stream is exhausted or closed.
+    """
+
+    def __init__(self, max_streams: int = 4, max_streams_per_conversation: int = 2):
+        self._lock = threading.Lock()
+        self._active: dict[Hashable, int] = {}
+        self._active_total = 0
+        # The conversations with waiting streams, in the order of their turns.
+        self._queues: OrderedDict[Hashable, deque[_Waiter]] = OrderedDict()
+        self.waited = 0
+        self.average_wait = 0.0
+        self.configure(max_streams=max_streams, max_streams_per_conversation=max_streams_per_conversation)
+
+    def configure(self, max_streams: int = 4, max_streams_per_conversation: int = 2, **kwargs) -> None:
+        "Set the limits, a limit less than 1 means no limit."
+        with self._lock:
+            self.max_streams = max_streams
+            self.max_streams_per_conversation = max_streams_per_conversation
+            self._dispatch()
+
+    def _has_room(self, key: Hashable) -> bool:
+        if 0 < self.max_streams <= self._active_total:
+            return False
+        return not 0 < self.max_streams_per_conversation <= self._active.get(key, 0)
+
+    def _take(self, key: Hashable) -> None:
+        self._active[key] = self._active.get(key, 0) + 1
+        self._active_total += 1
+
+    def _release(self, key: Hashable) -> None:
+        with self._lock:
+            self._active[key] -= 1
+            if self._active[key] == 0:
+                del self._active[key]
+            self._active_total -= 1
+            self._dispatch()
+
+    def _dispatch(self) -> None:
+        "Grant the free slots to the waiting streams, one conversation at a time."
+        while self._queues and not 0 < self.max_streams <= self._active_total:
+            for key, queue in self._queues.items():
+                if self._has_room(key):
+                    break
+            else:
+                return
+            waiter = queue.popleft()
+            if queue:
+                # Its next stream waits for the other conversations' turns.
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            self._take(key)
+            wait = time.monotonic() - waiter.enqueued_at
+            self.waited += 1
+            self.average_wait += (wait - self.average_wait) * 0.2
+            waiter.grant()
+
+    def _enqueue(self, key: Hashable, loop: asyncio.AbstractEventLoop | None = None) -> StreamSlot | _Waiter:
+        with self._lock:
+            if key not in self._queues and self._has_room(key):
+                self._take(key)
+                return StreamSlot(self, key)
+            waiter = _Waiter(key, loop)
+            self._queues.setdefault(key, deque()).append(waiter)
+            return waiter
+
+    def _cancel(self, waiter: _Waiter) -> None:
+        with self._lock:
+            if not waiter.granted:
+                queue = self._queues[waiter.key]
+                queue.remove(waiter)
+                if not queue:
+                    del self._queues[waiter.key]
+                return
+        self._release(waiter.key)
+
+    def acquire(self, key: Hashable, timeout: float | None = None) -> StreamSlot:
+        """Block until a slot of the conversation is granted.
+        Raise TimeoutError if it is not granted within the timeout.
+        """
+        waiter = self._enqueue(key)
+        if isinstance(waiter, StreamSlot):
+            return waiter
+        assert waiter.event is not None
+        if not waiter.event.wait(timeout):
+            # A slot granted in the meantime is given back.
+            self._cancel(waiter)
+            raise TimeoutError(f"No stream slot for {key} within {timeout}s.")
+        return StreamSlot(self, key)
+
+    async def async_acquire(self, key: Hashable) -> StreamSlot:
+        "Wait for a slot of the conversation without blocking the event loop."
+        waiter = self._enqueue(key, loop=asyncio.get_running_loop())
+        if isinstance(waiter, StreamSlot):
+            return waiter
+        assert waiter.future is not None
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            self._cancel(waiter)
+            raise
+        return StreamSlot(self, key)
+
+    def open_stream(self, key: Hashable, open_stream: Callable[[], Iterable], slot: StreamSlot | None = None) -> LimitedStream:
+        "Acquire a slot, blocking if necessary, unless one is given, and open the stream with it."
+        slot = slot or self.acquire(key)
+        try:
+            response = open_stream()
+        except BaseException:
+            slot.release()
+            raise
+        return LimitedStream(response, slot)
+
+    async def async_open_stream(self, key: Hashable, open_stream: Callable[[], Awaitable[AsyncIterable]]) -> AsyncLimitedStream:
+        "Wait for a slot and open the async stream with it."
+        slot = await self.async_acquire(key)
+        try:
+            response = await open_stream()
+        except BaseException:
+            slot.release()
+            raise
+        return AsyncLimitedStream(response, slot)
+
+    def lazy_stream(self, key: Hashable, open_stream: Callable[[], Iterable]) -> AsyncIterable:
+        """A stream which waits for its slot and is opened only when it is iterated in the event loop.
+        It is for streams created in the loop of the commander, where waiting for a slot must not block.
+        The sync stream is opened and read in threads.
+        """
+        async def stream():
+            slot = await self.async_acquire(key)
+            try:
+                response_iter = iter(await asyncio.to_thread(open_stream))
+                while (chunk := await asyncio.to_thread(next, response_iter, None)) is not None:
+                    yield chunk
+            finally:
+                slot.release()
+        return stream()
+
+    def info(self) -> dict:
+        "The running and the waiting streams, and the wait times in seconds."
+        with self._lock:
+            now = time.monotonic()
+            waiting = [waiter for queue in self._queues.values() for waiter in queue]
+            return {
+                "active": self._active_total,
+                "waiting": len(waiting),
+                "longest_wait": max((now - waiter.enqueued_at for waiter in waiting), default=0.0),
+                "average_wait": self.average_wait,
+                "waited": self.waited,
+                "max_streams": self.max_streams,
+            }
+
+
+class LimitedStream:
+    "A sync stream which releases its slot when it is exhausted or closed."
+
+    def __init__(self, response: Iterable, slot: StreamSlot):
+        self.response = response
+        self.slot = slot
+
+    def __iter__(self):
+        try:
+            yield from self.response
+        finally:
+            self.slot.release()
+
+
+class AsyncLimitedStream:
+    "An async stream which releases its slot when it is exhausted or closed."
+
+    def __init__(self, response: AsyncIterable, slot: StreamSlot):
+        self.response = response
+        self.slot = slot
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.response:
+                yield chunk
+        finally:
+            self.slot.release()
+
+
+stream_limiter = StreamLimiter()
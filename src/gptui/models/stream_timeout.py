@@ -0,0 +1,227 @@
+from __future__ import annotations
+import asyncio
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass, fields
+from typing import Any, AsyncIterable, Awaitable, Callable, Iterable
+
+import httpx
+
+
+gptui_logger = logging.getLogger("gptui_logger")
+
+
+CONTINUE_PROMPT = "Your previous reply was interrupted. Continue it exactly where it stopped, without repeating anything."
+
+# Errors of a connection which broke in the middle of a stream, they are handled as a stall.
+_TRANSPORT_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+
+@dataclass
+class StreamTimeouts:
+    "Timeouts in seconds of the phases of a request."
+    connect: float = 5.0  # Opening the connection.
+    first_token: float = 60.0  # From sending the request to the first chunk.
+    idle: float = 20.0  # Between two chunks.
+
+    def httpx_timeout(self) -> httpx.Timeout:
+        # Waiting for the response headers is part of the time to the first token.
+        return httpx.Timeout(self.first_token, connect=self.connect)
+
+
+class StreamTimeoutPolicy:
+    "The timeouts of each call site, the default ones overridden by those of the site."
+
+    def __init__(self, default: dict | None = None, call_sites: dict[str, dict] | None = None, max_stall_retries: int = 1):
+        self.configure(default=default, call_sites=call_sites, max_stall_retries=max_stall_retries)
+
+    def configure(self, default: dict | None = None, call_sites: dict[str, dict] | None = None, max_stall_retries: int = 1, **kwargs) -> None:
+        names = {field.name for field in fields(StreamTimeouts)}
+        self.default = {k: v for k, v in (default or {}).items() if k in names}
+        self.call_sites = {site: {k: v for k, v in (timeouts or {}).items() if k in names} for site, timeouts in (call_sites or {}).items()}
+        self.max_stall_retries = max_stall_retries
+
+    def timeouts(self, call_site: str | None) -> StreamTimeouts:
+        return StreamTimeouts(**{**self.default, **self.call_sites.get(call_site or "", {})})
+
+
+stream_timeout_policy = StreamTimeoutPolicy()
+
+
+class StreamStalledError(TimeoutError):
+    "A stream which stalled and could not be continued."
+
+
+class _StallTracker:
+    "The state of a guarded stream shared by the sync and the async versions."
+
+    def __init__(self, messages: list, timeouts: StreamTimeouts, max_retries: int, sent_at: float):
+        self.messages = messages
+        self.timeouts = timeouts
+        self.max_retries = max_retries
+        self.retries = 0
+        self.content = ""
+        self.tool_calls = False
+        self.finished = False
+        self.begin(sent_at)
+
+    def begin(self, sent_at: float) -> None:
+        self.deadline = sent_at + self.timeouts.first_token
+
+    def received(self, chunk: Any, received_at: float) -> None:
+        self.deadline = received_at + self.timeouts.idle
+        for choice in getattr(chunk, "choices", None) or []:
+            delta = choice.delta
+            if delta is not None:
+                self.content += delta.content or ""
+                self.tool_calls = self.tool_calls or bool(delta.tool_calls)
+            self.finished = self.finished or choice.finish_reason is not None
+
+    def continuation(self, error: BaseException | None) -> list:
+        """The messages of the request continuing the stalled stream.
+        Raise StreamStalledError if it can not be continued.
+        """
+        if self.tool_calls or self.retries >= self.max_retries:
+            raise StreamStalledError(f"The response stream stalled after {len(self.content)} characters.") from error
+        self.retries += 1
+        gptui_logger.warning(f"The response stream stalled, continuing it ({self.retries}/{self.max_retries}). Error: {error}")
+        if not self.content:
+            return self.messages
+        return self.messages + [
+            {"role": "assistant", "content": self.content},
+            {"role": "user", "content": CONTINUE_PROMPT},
+        ]
+
+
+_END = object()
+
+
+class GuardedStream:
+    """A sync chat completion stream which is aborted when it stalls, that is, when no chunk comes within
+    the first token timeout since the request was sent, or within the idle timeout since the last chunk.
+
+    A stalled stream is continued by a new request, which gets the content received so far as an assistant message,
+    so the chunks already passed on are not repeated. A stream of tool calls is not continued, StreamStalledError is raised.
+    The stream is read in a thread, so that a hung connection does not hold the consumer.
+    """
+
+    def __init__(
+        self,
+        response: Iterable,
+        reopen: Callable[[list], tuple[Iterable, float]],
+        messages: list,
+        timeouts: StreamTimeouts,
+        max_retries: int = 1,
+        sent_at: float | None = None,
+    ):
+        self.response = response
+        self.reopen = reopen
+        self.tracker = _StallTracker(messages, timeouts, max_retries, time.monotonic() if sent_at is None else sent_at)
+
+    @staticmethod
+    def _pump(response: Iterable, chunks: queue.SimpleQueue) -> None:
+        try:
+            for chunk in response:
+                chunks.put((chunk, time.monotonic()))
+        except BaseException as e:
+            chunks.put((e, None))
+        else:
+            chunks.put((_END, None))
+
+    def __iter__(self):
+        tracker = self.tracker
+        response = self.response
+        try:
+            while True:
+                chunks: queue.SimpleQueue = queue.SimpleQueue()
+                threading.Thread(target=self._pump, args=(response, chunks), daemon=True).start()
+                error = None
+                while True:
+                    try:
+                        item, received_at = chunks.get(timeout=max(tracker.deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                    if item is _END:
+                        return
+                    if received_at is None:
+                        if not isinstance(item, _TRANSPORT_ERRORS):
+                            raise item
+                        error = item
+                        break
+                    tracker.received(item, received_at)
+                    yield item
+                if tracker.finished:
+                    return
+                messages = tracker.continuation(error)
+                _close(response)
+                response, sent_at = self.reopen(messages)
+                tracker.begin(sent_at)
+        finally:
+            # Also stops the reading thread of a stream which is abandoned or closed early.
+            _close(response)
+
+
+class AsyncGuardedStream:
+    "The same as GuardedStream, for async streams."
+
+    def __init__(
+        self,
+        response: AsyncIterable,
+        reopen: Callable[[list], Awaitable[tuple[AsyncIterable, float]]],
+        messages: list,
+        timeouts: StreamTimeouts,
+        max_retries: int = 1,
+        sent_at: float | None = None,
+    ):
+        self.response = response
+        self.reopen = reopen
+        self.tracker = _StallTracker(messages, timeouts, max_retries, time.monotonic() if sent_at is None else sent_at)
+
+    async def __aiter__(self):
+        tracker = self.tracker
+        response = self.response
+        try:
+            while True:
+                iterator = response.__aiter__()
+                error = None
+                try:
+                    while True:
+                        chunk = await asyncio.wait_for(iterator.__anext__(), timeout=max(tracker.deadline - time.monotonic(), 0))
+                        tracker.received(chunk, time.monotonic())
+                        yield chunk
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    pass
+                except _TRANSPORT_ERRORS as e:
+                    error = e
+                if tracker.finished:
+                    return
+                messages = tracker.continuation(error)
+                await _aclose(response)
+                response, sent_at = await self.reopen(messages)
+                tracker.begin(sent_at)
+        finally:
+            await _aclose(response)
+
+
+def _close(response: Any) -> None:
+    try:
+        close = getattr(response, "close", None)
+        if close is not None:
+            close()
+    except Exception as e:
+        gptui_logger.warning(f"Closing a stalled stream failed. Error: {e}")
+
+
+async def _aclose(response: Any) -> None:
+    try:
+        close = getattr(response, "close", None) or getattr(response, "aclose", None)
+        if close is not None:
+            result = close()
+            if asyncio.iscoroutine(result):
+                await result
+    except Exception as e:
+        gptui_logger.warning(f"Closing a stalled stream failed. Error: {e}")
@@ -1,23 +1,154 @@
+import logging
+import os
+import threading
+
+import httpx
 import openai
 from openai import OpenAI, AsyncOpenAI
 
 from .openai_settings_from_dot_env import openai_settings_from_dot_env
 
 
+gptui_logger = logging.getLogger("gptui_logger")
+
+
 OpenAIClient = OpenAI | AsyncOpenAI
 
 
+class OpenAIClientRegistry:
+    """Process-wide OpenAI clients keyed by (api key, organization, base url, sync/async).
+
+    All sync clients share one httpx connection pool with keep-alive, so a new chat, handler or role
+    reuses the open TLS connections instead of paying a fresh handshake.
+    Async clients get a pool with the same limits per key, they should be used from the same event loop.
+    The settings of a dot env file are parsed again only when the file changes.
+    """
+
+    def __init__(self, max_connections: int = 20, max_keepalive_connections: int = 10, keepalive_expiry: float = 60.0):
+        self._clients: dict[tuple, OpenAIClient] = {}
+        self._settings: dict[str, tuple[float, tuple[str, str | None]]] = {}
+        self._http_client: httpx.Client | None = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.configure(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+
+    def configure(self, max_connections: int = 20, max_keepalive_connections: int = 10, keepalive_expiry: float = 60.0, **kwargs) -> None:
+        """Set the connection pool limits. It takes effect on pools created afterwards, so it should be called at startup.
+        Unknown keys, such as 'preconnect', are ignored so that the config section can be passed as is.
+        """
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+
+    def settings(self, dot_env_path: str) -> tuple[str, str | None]:
+        "The OpenAI API key and organization ID in the dot env file."
+        try:
+            mtime = os.path.getmtime(dot_env_path)
+        except OSError:
+            return openai_settings_from_dot_env(dot_env_path)
+        with self._lock:
+            cached = self._settings.get(dot_env_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        settings = openai_settings_from_dot_env(dot_env_path)
+        with self._lock:
+            self._settings[dot_env_path] = (mtime, settings)
+        return settings
+
+    def client(self, dot_env_path: str, async_client: bool = False, **kwargs) -> OpenAIClient:
+        "Return the shared client of the settings in the dot env file, creating it at the first time."
+        api_key, org_id = self.settings(dot_env_path)
+        base_url = kwargs.get("base_url")
+        key = (
+            api_key,
+            org_id,
+            str(base_url) if base_url is not None else None,
+            async_client,
+            tuple(sorted((k, v) for k, v in kwargs.items() if k != "base_url")),
+        )
+        try:
+            hash(key)
+        except TypeError:
+            # Options such as a custom http_client can not be shared safely.
+            return self._make_client(api_key, org_id, async_client, **kwargs)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self.hits += 1
+                return client
+            self.misses += 1
+            client = self._make_client(api_key, org_id, async_client, **kwargs)
+            self._clients[key] = client
+        return client
+
+    def _make_client(self, api_key: str, org_id: str | None, async_client: bool, **kwargs) -> OpenAIClient:
+        if async_client is True:
+            kwargs.setdefault("http_client", httpx.AsyncClient(limits=self._limits, timeout=httpx.Timeout(600.0, connect=5.0), follow_redirects=True))
+            return AsyncOpenAI(api_key=api_key, organization=org_id, **kwargs)
+        kwargs.setdefault("http_client", self._shared_http_client())
+        return OpenAI(api_key=api_key, organization=org_id, **kwargs)
+
+    def _shared_http_client(self) -> httpx.Client:
+        if self._http_client is None:
+            # The same defaults as the openai client, apart from the limits.
+            self._http_client = httpx.Client(limits=self._limits, timeout=httpx.Timeout(600.0, connect=5.0), follow_redirects=True)
+        return self._http_client
+
+    def preconnect(self, dot_env_path: str, **kwargs) -> threading.Thread:
+        """Open a keep-alive connection to the API host in a background thread,
+        so that the first request does not pay the TCP and TLS handshake.
+        """
+        def connect():
+            try:
+                client = self.client(dot_env_path, **kwargs)
+                # Any response is fine, the connection stays in the pool.
+                self._shared_http_client().head(str(client.base_url), timeout=5.0)
+            except Exception as e:
+                gptui_logger.warning(f"Pre-connecting to OpenAI failed. Error: {e}")
+
+        thread = threading.Thread(target=connect, daemon=True)
+        thread.start()
+        return thread
+
+    def info(self) -> dict:
+        "Statistics of the clients and of the shared connection pool."
+        with self._lock:
+            info = {"clients": len(self._clients), "hits": self.hits, "misses": self.misses}
+        # httpx does not expose its pool publicly, the connection counts are best effort.
+        pool = getattr(getattr(self._http_client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None)
+        if connections is not None:
+            info["connections"] = len(connections)
+            info["idle_connections"] = sum(1 for connection in connections if connection.is_idle())
+        return info
+
+    def clear(self) -> None:
+        "Forget the clients and the settings. Clients already handed out keep working with their pool."
+        with self._lock:
+            self._clients.clear()
+            self._settings.clear()
+            self._http_client = None
+            self.hits = 0
+            self.misses = 0
+
+
+openai_client_registry = OpenAIClientRegistry()
+
+
 def openai_api(dot_env_path: str | None):
     assert dot_env_path, "'dot_env_path' can not be None or empty."
-    openai_key, org_id = openai_settings_from_dot_env(dot_env_path)
+    openai_key, org_id = openai_client_registry.settings(dot_env_path)
     openai.api_key = openai_key
     return openai
 
 def openai_api_client(dot_env_path: str | None, async_client: bool = False, **kwargs) -> OpenAIClient:
+    "Return the shared OpenAI client of the settings in the dot env file."
     assert dot_env_path, "'dot_env_path' can not be None or empty."
-    openai_key, org_id = openai_settings_from_dot_env(dot_env_path)
-    if async_client is True:
-        client = AsyncOpenAI(api_key=openai_key, organization=org_id, **kwargs)
-    else:
-        client = OpenAI(api_key=openai_key, organization=org_id, **kwargs)
-    return client
+    return openai_client_registry.client(dot_env_path, async_client=async_client, **kwargs)
@@ -1,31 +1,134 @@
 import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Hashable
+
 import tiktoken
 
 
 gptui_logger = logging.getLogger("gptui_logger")
 
 
+class TokenizerRegistry:
+    """Resolve the tiktoken encoding of each model only once per process."""
+
+    def __init__(self, default_encoding_name: str = "cl100k_base"):
+        self.default_encoding_name = default_encoding_name
+        self._encodings: dict[str, tiktoken.Encoding] = {}
+        self._lock = threading.Lock()
+
+    def encoding_for_model(self, model: str) -> tiktoken.Encoding:
+        encoding = self._encodings.get(model)
+        if encoding is not None:
+            return encoding
+        with self._lock:
+            encoding = self._encodings.get(model)
+            if encoding is None:
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    gptui_logger.warning(
+                        f"Warning when caculate tokens num: model {model} not found. Using {self.default_encoding_name} encoding."
+                    )
+                    encoding = tiktoken.get_encoding(self.default_encoding_name)
+                self._encodings[model] = encoding
+        return encoding
+
+    def clear(self) -> None:
+        with self._lock:
+            self._encodings.clear()
+
+
+class TokensNumCache:
+    """A bounded LRU cache of token counts keyed by (encoding name, content hash).
+
+    Only the hash of the content is kept as key, so caching a large pasted file does not keep the file alive.
+    """
+
+    def __init__(self, maxsize: int = 8192):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[tuple[str, int, int], int] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def tokens_num(self, string: str, encoding: tiktoken.Encoding) -> int:
+        "Return the tokens num of the string, encoding it only if it has not been counted before."
+        key = (encoding.name, len(string), hash(string))
+        with self._lock:
+            tokens_num = self._cache.get(key)
+            if tokens_num is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return tokens_num
+        # Encode outside the lock, tiktoken releases the GIL while encoding.
+        tokens_num = len(encoding.encode(string))
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = tokens_num
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return tokens_num
+
+    def tokens_num_batch(self, strings: list[str], encoding: tiktoken.Encoding, num_threads: int = 8) -> list[int]:
+        """Return the tokens num of each string, encoding all the uncounted ones at once with tiktoken's threaded batch encoding.
+
+        The result does not rely on the cache retaining the entries, so it works for more strings than maxsize.
+        """
+        keys = [(encoding.name, len(string), hash(string)) for string in strings]
+        result: list[int | None] = []
+        with self._lock:
+            for key in keys:
+                tokens_num = self._cache.get(key)
+                if tokens_num is not None:
+                    self.hits += 1
+                result.append(tokens_num)
+        missing_positions = [position for position, tokens_num in enumerate(result) if tokens_num is None]
+        if missing_positions:
+            encoded_list = encoding.encode_batch([strings[position] for position in missing_positions], num_threads=num_threads)
+            with self._lock:
+                for position, tokens in zip(missing_positions, encoded_list):
+                    self.misses += 1
+                    result[position] = len(tokens)
+                    self._cache[keys[position]] = len(tokens)
+                    self._cache.move_to_end(keys[position])
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+        return result  # type: ignore
+
+    def info(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._cache), "maxsize": self.maxsize}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+tokenizer_registry = TokenizerRegistry()
+tokens_num_cache = TokensNumCache()
+
+
 def tokens_num_from_string(string: str, model: str) -> int:
     """
     caculate the tokens num of given string
     """
-    encoding = tiktoken.encoding_for_model(model)
-    tokens_num = len(encoding.encode(string))
-    return tokens_num
+    encoding = tokenizer_registry.encoding_for_model(model)
+    return tokens_num_cache.tokens_num(string, encoding)
 
-def tokens_num_from_chat_context(chat_context: list, model: str) -> int:
-    """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        gptui_logger.warning("Warning when caculate tokens num: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+@lru_cache(maxsize=None)
+def message_tokens_overhead(model: str) -> tuple[str, int, int]:
+    """Returns the model actually used for counting, the tokens per message and the tokens per name."""
     if model == "gpt-3.5-turbo":
         gptui_logger.warning("Warning when caculate tokens num: gpt-3.5-turbo may change over time. Returning num tokens assuming gpt-3.5-turbo-1106.")
-        return tokens_num_from_chat_context(chat_context, model="gpt-3.5-turbo-1106")
+        return message_tokens_overhead(model="gpt-3.5-turbo-1106")
     elif model == "gpt-4":
         gptui_logger.warning("Warning when caculate tokens num: gpt-4 may change over time. Returning tokens num assuming gpt-4-0613.")
-        return tokens_num_from_chat_context(chat_context, model="gpt-4-0613")
+        return message_tokens_overhead(model="gpt-4-0613")
     elif model == "gpt-3.5-turbo-0301":
         tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
         tokens_per_name = -1  # if there's a name, the role is omitted
@@ -44,15 +147,55 @@ def tokens_num_from_chat_context(chat_context: list, model: str) -> int:
     else:
         gptui_logger.error(f"""tokens_num_from_chat_context() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
         raise NotImplementedError(f"""tokens_num_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
+    return model, tokens_per_message, tokens_per_name
+
+def message_content_tokens_num(message: dict, encoding: tiktoken.Encoding) -> int:
+    "The encoding-dependent part of the tokens num of a message."
+    return sum(tokens_num_cache.tokens_num(str(value), encoding) for value in message.values() if value)
+
+def message_overhead_tokens_num(message: dict, tokens_per_message: int, tokens_per_name: int) -> int:
+    "The model-dependent part of the tokens num of a message, including the reply priming."
+    return tokens_per_message + (tokens_per_name if "name" in message else 0) + 3
+
+def tokens_num_from_chat_context(chat_context: list, model: str) -> int:
+    """Returns the number of tokens used by a list of messages."""
+    model, tokens_per_message, tokens_per_name = message_tokens_overhead(model)
+    encoding = tokenizer_registry.encoding_for_model(model)
     tokens_num = 0
     for message in chat_context:
         tokens_num += tokens_per_message
-        for key, value in message.items():
-            tokens_num += len(encoding.encode(str(value)) if value else [])
-            if key == "name":
-                tokens_num += tokens_per_name
+        tokens_num += message_content_tokens_num(message, encoding)
+        if "name" in message:
+            tokens_num += tokens_per_name
     tokens_num += 3  # every reply is primed with <|start|>assistant<|message|>
     return tokens_num
 
-def tokens_num_for_functions_call(functions_info: list[dict], model: str) -> int:
-    return tokens_num_from_string(repr(functions_info), model=model)
+_functions_tokens_num: OrderedDict[tuple[Hashable, str], int] = OrderedDict()
+_functions_tokens_num_lock = threading.Lock()
+_FUNCTIONS_TOKENS_NUM_MAXSIZE = 32
+
+def tokens_num_for_functions_call(functions_info: list[dict], model: str, version: Hashable | None = None) -> int:
+    """
+    caculate the tokens num of the functions (tools) schema.
+    If the version of the schema is given, e.g. 'ManagerInterface.plugins_version',
+    the result is cached per (version, encoding) and an unchanged schema is not serialized and encoded again.
+    """
+    if version is None:
+        return tokens_num_from_string(repr(functions_info), model=model)
+    encoding = tokenizer_registry.encoding_for_model(model)
+    key = (version, encoding.name)
+    with _functions_tokens_num_lock:
+        tokens_num = _functions_tokens_num.get(key)
+        if tokens_num is not None:
+            _functions_tokens_num.move_to_end(key)
+            return tokens_num
+    tokens_num = tokens_num_cache.tokens_num(repr(functions_info), encoding)
+    with _functions_tokens_num_lock:
+        _functions_tokens_num[key] = tokens_num
+        while len(_functions_tokens_num) > _FUNCTIONS_TOKENS_NUM_MAXSIZE:
+            _functions_tokens_num.popitem(last=False)
+    return tokens_num
+
+def clear_functions_tokens_num_cache() -> None:
+    with _functions_tokens_num_lock:
+        _functions_tokens_num.clear()
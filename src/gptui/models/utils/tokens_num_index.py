@@ -0,0 +1,129 @@
+import bisect
+from itertools import accumulate
+
+
+class TokensNumIndex:
+    """Per-message tokens num together with a maintained cumulative sum.
+
+    'values[i]' is the tokens num of the i-th message and 'prefix[i]' is the sum of 'values[:i]',
+    so the total, any range sum and the truncation position are answered without summing lists.
+    Appending and popping at the end are O(1); inserting or popping in the middle re-accumulates the tail only.
+    """
+
+    def __init__(self, values: list[int] | None = None):
+        self.values: list[int] = []
+        self._prefix: list[int] = [0]
+        if values:
+            self.extend(values)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    @property
+    def total(self) -> int:
+        return self._prefix[-1]
+
+    def append(self, tokens_num: int) -> None:
+        self.values.append(tokens_num)
+        self._prefix.append(self._prefix[-1] + tokens_num)
+
+    def extend(self, tokens_num_list: list[int]) -> None:
+        self.values.extend(tokens_num_list)
+        sums = accumulate(tokens_num_list, initial=self._prefix[-1])
+        # The initial value is already the last element of the prefix.
+        next(sums)
+        self._prefix.extend(sums)
+
+    def insert(self, index: int, tokens_num: int) -> None:
+        index = self._normalize_index(index, insert=True)
+        self.values.insert(index, tokens_num)
+        self._prefix[index:] = accumulate(self.values[index:], initial=self._prefix[index])
+
+    def pop(self, index: int = -1) -> int:
+        index = self._normalize_index(index)
+        tokens_num = self.values.pop(index)
+        if index == len(self.values):
+            self._prefix.pop()
+        else:
+            self._prefix[index:] = accumulate(self.values[index:], initial=self._prefix[index])
+        return tokens_num
+
+    def clear(self) -> None:
+        self.values = []
+        self._prefix = [0]
+
+    def prefix_sum(self, index: int) -> int:
+        "Sum of the tokens num of the messages before index."
+        return self._prefix[index]
+
+    def range_sum(self, start: int, end: int | None = None) -> int:
+        "Sum of the tokens num of the messages in [start, end)."
+        if end is None:
+            end = len(self.values)
+        return self._prefix[end] - self._prefix[start]
+
+    def suffix_position(self, num: int) -> int:
+        """Find the farthest left position where the sum of all tokens num after that position is less than num.
+
+        It has the same semantics as 'openai_tokens_truncate.find_position':
+        return 0 if the total is less than num, and return the length if the last tokens num is not less than num.
+        """
+        position = bisect.bisect_right(self._prefix, self._prefix[-1] - num)
+        return min(position, len(self.values))
+
+    def _normalize_index(self, index: int, insert: bool = False) -> int:
+        length = len(self.values)
+        if insert:
+            if index < 0:
+                index = max(length + index, 0)
+            return min(index, length)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("pop index out of range")
+        return index
+
+
+class ChainedTokensNumIndex:
+    """The first 'base_length' entries of a shared TokensNumIndex followed by a local one.
+
+    It answers the same queries as TokensNumIndex without copying the base, the base is only read.
+    """
+
+    def __init__(self, base: TokensNumIndex, base_length: int, tail: TokensNumIndex):
+        self.base = base
+        self.base_length = base_length
+        self.tail = tail
+
+    def __len__(self) -> int:
+        return self.base_length + len(self.tail)
+
+    @property
+    def values(self) -> list[int]:
+        return self.base.values[:self.base_length] + self.tail.values
+
+    @property
+    def total(self) -> int:
+        return self.base.prefix_sum(self.base_length) + self.tail.total
+
+    def prefix_sum(self, index: int) -> int:
+        "Sum of the tokens num of the messages before index."
+        if index <= self.base_length:
+            return self.base.prefix_sum(index)
+        return self.base.prefix_sum(self.base_length) + self.tail.prefix_sum(index - self.base_length)
+
+    def range_sum(self, start: int, end: int | None = None) -> int:
+        "Sum of the tokens num of the messages in [start, end)."
+        if end is None:
+            end = len(self)
+        return self.prefix_sum(end) - self.prefix_sum(start)
+
+    def suffix_position(self, num: int) -> int:
+        "The same as 'TokensNumIndex.suffix_position' on the chained values."
+        base_total = self.base.prefix_sum(self.base_length)
+        target = self.total - num
+        if target < base_total:
+            position = bisect.bisect_right(self.base._prefix, target, 0, self.base_length)
+        else:
+            position = self.base_length + bisect.bisect_right(self.tail._prefix, target - base_total)
+        return min(position, len(self))
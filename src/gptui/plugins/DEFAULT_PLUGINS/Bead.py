@@ -1,10 +1,10 @@
-import json
 import logging
 
 from semantic_kernel.orchestration.sk_context import SKContext
 from semantic_kernel.skill_definition import sk_function, sk_function_context_parameter
 
 from gptui.gptui_kernel.manager import auto_init_params
+from gptui.models.context_handle import OpenaiContextHandle
 
 
 gptui_logger = logging.getLogger("gptui_logger")
@@ -30,7 +30,7 @@ class Memo:
     @sk_function_context_parameter(
         name="openai_context",
         description=(
-            "The dictionary string version of the OpenaiContext instance. "
+            "The handle string of the OpenaiContext instance. "
             "This is a special parameter that typically doesn't require manual intervention, as it is usually automatically managed."
             "Unless there's a clear intention, please keep its default value."
         ),
@@ -39,12 +39,11 @@ class Memo:
     def write_memo(self, context: SKContext) -> str:
         content = context["content"]
         try:
-            openai_context_dict = json.loads(str(context["openai_context"]))
-        except json.JSONDecodeError:
+            conversation_id = int(OpenaiContextHandle.from_json(str(context["openai_context"])).id)
+        except (ValueError, TypeError):
             return ("An error occurred while parsing the openai_context content. "
                 "You should not provide the 'openai_context' parameter as the system automatically supplies it."
             )
-        conversation_id = int(openai_context_dict["id"])
         try:
             conversation = self.app.openai.conversation_dict[conversation_id]
         except KeyError:
@@ -1,10 +1,10 @@
-import json
 import logging
 
 from semantic_kernel.orchestration.sk_context import SKContext
 from semantic_kernel.skill_definition import sk_function, sk_function_context_parameter
 
 from gptui.gptui_kernel.manager import auto_init_params
+from gptui.models.context_handle import OpenaiContextHandle
 
 
 gptui_logger = logging.getLogger("gptui_logger")
@@ -35,7 +35,7 @@ class MemoryRecall:
     @sk_function_context_parameter(
         name="openai_context",
         description=(
-            "The dictionary string version of the OpenaiContext instance. "
+            "The handle string of the OpenaiContext instance. "
             "This is a special parameter that typically doesn't require manual intervention, as it is usually automatically managed."
             "Unless there's a clear intention, please keep its default value."
         ),
@@ -44,8 +44,10 @@ class MemoryRecall:
     async def recall_memory(self, context: SKContext) -> str:
         query = context["query"]
         max_recallable_entries = int(context["max_recallable_entries"])
-        openai_context_dict = json.loads(str(context["openai_context"]))
-        conversation_id = openai_context_dict["id"]
+        try:
+            conversation_id = OpenaiContextHandle.from_json(str(context["openai_context"])).id
+        except ValueError:
+            return "The 'openai_context' parameter is not valid, it should keep its default value."
         semantic_memory = self.manager.services.sk_kernel.memory
         try:
             result = await semantic_memory.search_async(str(conversation_id), query, limit=max_recallable_entries, min_relevance_score=0.7)
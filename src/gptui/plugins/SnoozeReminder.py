@@ -1,5 +1,4 @@
 import logging
-import json
 import threading
 import time
 
@@ -9,6 +8,7 @@ from semantic_kernel.skill_definition import sk_function, sk_function_context_pa
 
 from gptui.gptui_kernel.manager import ManagerInterface, auto_init_params
 from gptui.models.blinker_wrapper import async_wrapper_with_loop, sync_wrapper
+from gptui.models.context_handle import OpenaiContextHandle
 from gptui.models.openai_chat_inner_service import chat_service_for_inner
 from gptui.models.openai_error import OpenaiErrorHandler
 from gptui.models.signals import response_auxiliary_message_signal, notification_signal
@@ -43,7 +43,7 @@ class SnoozeReminder:
     @sk_function_context_parameter(
         name="openai_context",
         description=(
-            "The dictionary string version of the OpenaiContext instance. "
+            "The handle string of the OpenaiContext instance. "
             "This is a special parameter that typically doesn't require manual intervention, as it is usually automatically managed."
             "Unless there's a clear intention, please keep its default value."
         ),
@@ -58,8 +58,10 @@ class SnoozeReminder:
             return "The parameter 'delay' cannot be parsed into integer seconds."
 
         content = context["reminder_content"]
-        openai_context_dict = json.loads(str(context["openai_context"]))
-        conversation_id = openai_context_dict["id"]
+        try:
+            conversation_id = OpenaiContextHandle.from_json(str(context["openai_context"])).id
+        except ValueError:
+            return "The 'openai_context' parameter is not valid, it should keep its default value."
         
         reminder = threading.Timer(delay, self.reminder_after, args=(content, conversation_id, delay))
         reminder.start()
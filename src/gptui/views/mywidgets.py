@@ -1,9 +1,12 @@
 from __future__ import annotations
 import asyncio
+import bisect
 import inspect
+import itertools
 import logging
 import os
 import textwrap
+from collections import OrderedDict
 from typing import NamedTuple, Callable, Awaitable, Coroutine, TypeVar, Generic
 
 from rich.console import RenderResult, Console
@@ -323,6 +326,17 @@ class MyMultiInput(Input, MyScrollSupportMixin):
         self.value = ""
 
 
+class ChatWindowMessage:
+    "A message of the history in MyChatWindow, which is decorated into lines only when it comes into view."
+    __slots__ = ("piece", "estimated_height", "height", "lines")
+
+    def __init__(self, piece: dict, estimated_height: int):
+        self.piece = piece
+        self.estimated_height = estimated_height
+        self.height: int | None = None  # Measured when it is decorated, it is kept when the lines are dropped.
+        self.lines: Lines | None = None
+
+
 class MyChatWindow(MyScrollSupportMixin):
     """
     supplied two write content method:
@@ -330,7 +344,16 @@ class MyChatWindow(MyScrollSupportMixin):
     2. update_lines, write_lines, right_pop_lines
     methods with line is recomended
     Important: always use only one serial methods, mix use will cause error
+
+    The history of a conversation is set with update_messages, before the lines written.
+    It is virtualized: only the messages in view, with a margin, are decorated,
+    the heights of the others are estimated until they are measured, and only the last decorated messages keep their lines.
     """
+    # Lines above and below the view which are laid out as well.
+    VIRTUAL_MARGIN = 50
+    # Messages of the history keeping their decorated lines.
+    MAX_LAID_OUT_MESSAGES = 200
+
     def on_mount(self):
         MyScrollSupportMixin.init(self)
         #self.capture_mouse()
@@ -341,16 +364,121 @@ class MyChatWindow(MyScrollSupportMixin):
         self.refresh_content_wrap_request = False
         self.right_crop_request = 0
         self.right_crop_request = 0
+        self.my_messages: list[ChatWindowMessage] = []
+        self.my_message_renderer: Callable[[dict], Lines] | None = None
+        self._my_message_tops: list[int] = [0]
+        self._my_message_tops_dirty = False
+        self._my_laid_out_messages: OrderedDict[int, None] = OrderedDict()
 
     def virtual_size_send(self):
         width = self.content_size.width
-        height = len(self.my_content_wrap)
+        height = self.my_messages_height() + len(self.my_content_wrap)
         return Size(width, height)
     
     def display_size_send(self):
         return self.content_size
 
+    def update_messages(self, pieces: list[dict], renderer: Callable[[dict], Lines], scroll_to_end: bool = True) -> None:
+        """Show the messages as the history, in place of all the content.
+        renderer decorates a message into its lines, it is called only for the messages which come into view.
+        """
+        self.clear(refresh=False)
+        width = max(self.content_size.width - 8, 1)
+        self.my_messages = [ChatWindowMessage(piece, self._estimate_height(piece, width)) for piece in pieces]
+        self.my_message_renderer = renderer
+        self._my_message_tops_dirty = True
+        if scroll_to_end:
+            self.scroll_to_end()
+        self.refresh()
+
+    @staticmethod
+    def _estimate_height(piece: dict, width: int) -> int:
+        content = piece["content"] or ""
+        # The content wrapped in the width, the frame, the name and the blank line after the message.
+        return content.count("\n") + len(content) // width + 1 + 3 + (2 if piece.get("name") else 0)
+
+    def my_messages_height(self) -> int:
+        return self._my_tops()[-1]
+
+    def _my_tops(self) -> list[int]:
+        "The first line of each message of the history, and the line after the last one."
+        if self._my_message_tops_dirty:
+            heights = (message.estimated_height if message.height is None else message.height for message in self.my_messages)
+            self._my_message_tops = [0, *itertools.accumulate(heights)]
+            self._my_message_tops_dirty = False
+        return self._my_message_tops
+
+    def _my_lay_out(self, index: int) -> Lines:
+        "Decorate the message, if it is not, and return its lines."
+        message = self.my_messages[index]
+        if message.lines is None:
+            assert self.my_message_renderer is not None
+            message.lines = self.my_message_renderer(message.piece)
+            if message.height != len(message.lines):
+                message.height = len(message.lines)
+                self._my_message_tops_dirty = True
+        self._my_laid_out_messages[index] = None
+        self._my_laid_out_messages.move_to_end(index)
+        while len(self._my_laid_out_messages) > self.MAX_LAID_OUT_MESSAGES:
+            evicted, _ = self._my_laid_out_messages.popitem(last=False)
+            self.my_messages[evicted].lines = None
+        return message.lines
+
+    def _my_lay_out_view(self, y: int, height: int) -> int:
+        """Decorate the messages in the view starting at line y, with the margin.
+        Return y moved by the change of the heights of the messages above it, so that the view stays on the same lines.
+        """
+        for _ in range(3):
+            tops = self._my_tops()
+            start = max(bisect.bisect_right(tops, max(y - self.VIRTUAL_MARGIN, 0)) - 1, 0)
+            end = min(bisect.bisect_left(tops, y + height + self.VIRTUAL_MARGIN), len(self.my_messages))
+            shift = 0
+            laid_out = False
+            for index in range(start, end):
+                message = self.my_messages[index]
+                if message.lines is not None:
+                    continue
+                laid_out = True
+                before = tops[index + 1] - tops[index]
+                self._my_lay_out(index)
+                if tops[index + 1] <= y:
+                    shift += len(message.lines) - before
+            y += shift
+            if not laid_out:
+                break
+        return y
+
+    def watch_my_scroll_offset(self, new_value) -> None:
+        if getattr(self, "my_messages", None) and self.content_size.height:
+            y = self._my_lay_out_view(new_value.y, self.content_size.height)
+            y = max(min(y, self.my_scroll_virtual_size.height - self.my_scroll_display_size.height), 0)
+            if y != new_value.y:
+                # Watched again with the corrected offset.
+                self.my_scroll_offset = Offset(new_value.x, y)
+                return
+        super().watch_my_scroll_offset(new_value)
+
+    def _my_view_lines(self, y: int, height: int) -> Lines:
+        "The lines from line y, of the history and then of the content written."
+        out = Lines()
+        tops = self._my_tops()
+        index = max(bisect.bisect_right(tops, y) - 1, 0)
+        position = tops[index] if self.my_messages else 0
+        while index < len(self.my_messages) and position < y + height:
+            lines = self._my_lay_out(index)
+            out.extend(lines[max(y - position, 0):y + height - position])
+            position += len(lines)
+            index += 1
+        if index == len(self.my_messages) and position < y + height:
+            out.extend(self.my_content_wrap[max(y - position, 0):y + height - position])
+        return out
+
     def clear(self, refresh: bool = True):
+        self.my_messages = []
+        self.my_message_renderer = None
+        self._my_message_tops = [0]
+        self._my_message_tops_dirty = False
+        self._my_laid_out_messages = OrderedDict()
         self.my_content = Text()
         self.my_content_wrap = Lines()
         self.right_crop_request = 0
@@ -360,6 +488,8 @@ class MyChatWindow(MyScrollSupportMixin):
             self.refresh()
 
     def update(self, content: Text, scroll_to_end: bool = True) -> None:
+        if self.my_messages:
+            self.clear(refresh=False)
         self.my_content = content
         self.my_content_wrap = self.my_content.wrap(console=Console(), width=self.content_size.width, overflow="fold", no_wrap=False)
         if scroll_to_end:
@@ -397,6 +527,12 @@ class MyChatWindow(MyScrollSupportMixin):
         if self.refresh_content_wrap_request is True:
             self.refresh_content_wrap()
             self.refresh_content_wrap_request = False
+        # Measure the last messages filling the view, so that the end is where it is estimated to be.
+        remaining = self.my_scroll_display_size.height + self.VIRTUAL_MARGIN - len(self.my_content_wrap)
+        index = len(self.my_messages) - 1
+        while remaining > 0 and index >= 0:
+            remaining -= len(self._my_lay_out(index))
+            index -= 1
         offset_y = self.my_scroll_virtual_size.height - self.my_scroll_display_size.height
         self.my_scroll_offset = Offset(self.my_scroll_offset.x, offset_y if offset_y > 0 else 0)
         if refresh is True:
@@ -432,6 +568,8 @@ class MyChatWindow(MyScrollSupportMixin):
             self.my_content_wrap = Lines()
 
     def update_lines(self, content_lines: Lines, scroll_to_end: bool = True) -> None:
+        if self.my_messages:
+            self.clear(refresh=False)
         self.my_content_wrap = content_lines
         if scroll_to_end:
             self.scroll_to_end()
@@ -467,6 +605,9 @@ class MyChatWindow(MyScrollSupportMixin):
     @property
     def my_render_content(self) -> Text:
         scroll_x, scroll_y = self.my_scroll_offset
+        if self.my_messages:
+            height = self.my_scroll_display_size.height
+            return self.my_scroll_content_to_render(self._my_view_lines(scroll_y, height), y = 0, h = height)
         return self.my_scroll_content_to_render(self.my_content_wrap, y = scroll_y, h = self.my_scroll_display_size.height)
 
     def render(self) -> RenderResult:
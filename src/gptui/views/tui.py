@@ -62,7 +62,7 @@ from ..controllers.assistant_tube_control import AssistantTube
 from ..controllers.chat_context_control import ChatContextControl
 from ..controllers.chat_response_control import ChatResponse
 from ..controllers.dash_board_control import DashBoard
-from ..controllers.decorate_display_control import DecorateDisplay
+from ..controllers.decorate_display_control import DecorateDisplay, IncrementalDecorator, rendered_lines_cache
 from ..controllers.group_talk_control import GroupTalkControl
 from ..controllers.notification_control import Notification
 from ..controllers.openai_chat_manage import OpenaiChatManage
@@ -74,8 +74,14 @@ from ..models.context import OpenaiContext
 from ..models.doc import Doc, document_loader
 from ..models.gptui_basic_services.plugins.conversation_service import ConversationService
 from ..models.jobs import GroupTalkManager
-from ..models.openai_chat import OpenaiChat
-from ..models.utils.openai_api import openai_api_client
+from ..models.openai_chat import AsyncOpenaiChat, OpenaiChat
+from ..models.openai_tokens_truncate import truncation_policy
+from ..models.request_scheduler import RequestPriority, request_scheduler
+from ..models.response_cache import response_cache
+from ..models.stream_coalescer import stream_flush_policy
+from ..models.stream_limiter import stream_limiter
+from ..models.stream_timeout import stream_timeout_policy
+from ..models.utils.openai_api import openai_api_client, openai_client_registry
 from ..gptui_kernel.manager import Manager
 from ..utils.my_text import MyText as Text
 from ..utils.my_text import MyLines as Lines
@@ -234,6 +240,13 @@ class MainApp(App[str]):
         self.config = preprocess_config_path(self.config)
 
         self.workpath = self.config["workpath"]
+        openai_client_registry.configure(**self.config["openai_client_config"])
+        request_scheduler.configure(**self.config["request_scheduler_config"])
+        stream_limiter.configure(**self.config["stream_limiter_config"])
+        stream_timeout_policy.configure(**self.config["stream_timeout_config"])
+        stream_flush_policy.configure(**self.config["stream_flush_config"])
+        response_cache.configure(**self.config["response_cache_config"])
+        truncation_policy.configure(**self.config["truncation_config"])
 
         self.manager = Manager(self, dot_env_config_path=self.config["dot_env_path"], logger=gptui_logger)
         self.manager_init(self.manager)
@@ -269,6 +282,8 @@ class MainApp(App[str]):
         status = await self.app_init()
         if status is False:
             return
+        if self.config["openai_client_config"].get("preconnect"):
+            openai_client_registry.preconnect(self.config["dot_env_path"])
         message_region = self.main_screen.query_one("#message_region")
         message_region.border_title = u'\u2500' * self.main_screen.query_one("#message_region").content_size.width
         message_region.border_subtitle = u'\u2500' * self.main_screen.query_one("#message_region").content_size.width
@@ -280,6 +295,7 @@ class MainApp(App[str]):
         # rebuild conversations in last running.
         self.run_worker(self.conversations_display_init(conversation_active=self.openai.conversation_active))
         self.service_init()
+        self.set_interval(1, self.dash_board.queue_refresh)
         self.main_screen.query_one("#conversation_tree").conversation_refresh()
     
     async def on_button_pressed(self, event) -> None:
@@ -496,10 +512,10 @@ class MainApp(App[str]):
             if id > 0:
                 self.openai.conversation_active = id
                 conversation_chat_context = self.openai.conversation_dict[id]["openai_context"].chat_context
-                self.context_to_chat_window(conversation_chat_context)
+                self.context_to_chat_window(conversation_chat_context, conversation_key=tab_id)
             else:
                 self.no_context_manager.no_context_chat_active = id
-                self.context_to_chat_window(self.no_context_manager.no_context_chat_dict[self.no_context_manager.no_context_chat_active])
+                self.context_to_chat_window(self.no_context_manager.no_context_chat_dict[self.no_context_manager.no_context_chat_active], conversation_key=tab_id)
 
     def on_tabs_tab_activated(self, event: Tabs.TabActivated) -> None:
         tab_id = event.tab.id
@@ -533,7 +549,7 @@ class MainApp(App[str]):
             )
 
             self.chat_display.tab_not_switching.clear()
-            self.context_to_chat_window(first_view_context)
+            self.context_to_chat_window(first_view_context, conversation_key=tab_id)
             self.chat_display.tab_not_switching.set()
             tokens_window = self.get_tokens_window(first_role.context.parameters.get("model"))
             self.dash_board.group_talk_dash_board_display(tokens_window, conversation_id=id)
@@ -555,7 +571,7 @@ class MainApp(App[str]):
             self.openai.conversation_active = id
             openai_context = self.openai.conversation_dict[id]["openai_context"]
             self.chat_display.tab_not_switching.clear()
-            self.context_to_chat_window(openai_context.chat_context)
+            self.context_to_chat_window(openai_context.chat_context, conversation_key=tab_id)
             self.chat_display.tab_not_switching.set()
             tokens_window = self.get_tokens_window(openai_context.parameters.get("model"))
             self.dash_board.dash_board_display(tokens_window, conversation_id=id)
@@ -568,7 +584,7 @@ class MainApp(App[str]):
         elif tab_mode == "ncc":
             # ncc: No chat context
             self.no_context_manager.no_context_chat_active = id
-            self.context_to_chat_window(self.no_context_manager.no_context_chat_dict[self.no_context_manager.no_context_chat_active])
+            self.context_to_chat_window(self.no_context_manager.no_context_chat_dict[self.no_context_manager.no_context_chat_active], conversation_key=tab_id)
             dashboard = self.main_screen.query_one("#dash_board")
             height = dashboard.content_size.height
             dashboard.update(Text(" X \n" * height, tc("red") or "red"))
@@ -637,7 +653,9 @@ class MainApp(App[str]):
         if id == 0:
             return
         openai_context = self.openai.conversation_dict[id]["openai_context"]
-        self.context_to_chat_window(openai_context.chat_context)
+        # The messages decorated for the former width are not shown again until it is back.
+        rendered_lines_cache.invalidate_width(keep=self.main_screen.query_one("#chat_region").content_size.width)
+        self.context_to_chat_window(openai_context.chat_context, conversation_key="lqt" + str(id))
         self.run_worker(self.message_region_border_reset())
 
     async def on_common_message(self, message) -> None:
@@ -717,6 +735,8 @@ class MainApp(App[str]):
                     conversation_plugins_dict[id] = [plugin[1] if len(plugin)==2 else plugin[2] for plugin in openai_context_original.plugins]
                     # Clear plugin information to avoid serialization errors; the plugin information has been saved in conversation_plugins_dict
                     openai_context_original.plugins = []
+                    # Save the tokens num tagged with the encoding name, so that recovering does not need to re-tokenize.
+                    conversation_dict[id]["tokens_num"] = openai_context_original.tokens_num_state()
                     openai_context = asdict(openai_context_original)
                     conversation_dict[id]["openai_context"] = openai_context
                 content = {"conversation_active": self.openai.conversation_active, "conversation_dict": conversation_dict, "conversation_plugins_dict": conversation_plugins_dict}
@@ -777,7 +797,10 @@ class MainApp(App[str]):
         await asyncio.sleep(0.2)
         chat_tabs.active = tab_id
         chat_tabs._scroll_active_tab()
-        self.context_to_chat_window(self.openai.conversation_dict[self.openai.conversation_active]["openai_context"].chat_context)
+        self.context_to_chat_window(
+            self.openai.conversation_dict[self.openai.conversation_active]["openai_context"].chat_context,
+            conversation_key="lqt" + str(self.openai.conversation_active),
+        )
 
     async def action_save_conversation(self):
         conversation_id = self.openai.conversation_active
@@ -834,7 +857,10 @@ class MainApp(App[str]):
                     return
                 else:
                     return
-            self.context_to_chat_window(self.openai.conversation_dict[self.openai.conversation_active]["openai_context"].chat_context)
+            self.context_to_chat_window(
+                self.openai.conversation_dict[self.openai.conversation_active]["openai_context"].chat_context,
+                conversation_key="lqt" + str(self.openai.conversation_active),
+            )
             tab_name = self.openai.conversation_dict[self.openai.conversation_active]["tab_name"]
             tab_id = str(self.openai.conversation_active)
             tab_id = "lqt" + tab_id
@@ -1128,12 +1154,38 @@ class MainApp(App[str]):
 
     # context to chat window
     ############################################################################## context to chat window
-    def context_to_chat_window(self, context: list[dict], change_line: bool = True) -> None:
-        self.main_screen.query_one("#chat_region").clear()
-        self.decorate_display.clear_code_block() # clear code_block DecorateDisplay
-        for piece in context:
-            piece_content = {"role": piece["role"], "name": piece.get("name", None), "content": piece["content"]}
-            self.context_piece_to_chat_window(piece=piece_content, change_line=change_line, decorator_switch=True)
+    def context_to_chat_window(self, context: list[dict], change_line: bool = True, conversation_key: str | None = None) -> None:
+        """Show the conversation in the chat window.
+        With conversation_key, the tab id of the conversation, the decorated messages are kept in rendered_lines_cache.
+        The code blocks referred to by the cached lines are kept when the others are cleared.
+        """
+        chat_region = self.main_screen.query_one("#chat_region")
+        self.decorate_display.clear_code_block(keep=rendered_lines_cache.code_blocks())
+        pieces = []
+        for index, piece in enumerate(context):
+            piece_content = self.filter({"role": piece["role"], "name": piece.get("name", None), "content": piece["content"]})
+            if piece_content:
+                piece_content["index"] = index
+                pieces.append(piece_content)
+        wrap_file = self.main_screen.query_one("#file_wrap_display").value
+
+        def renderer(piece: dict) -> Lines:
+            if conversation_key is not None:
+                key = (conversation_key, piece["index"], chat_region.content_size.width, ThemeColor._theme, wrap_file)
+                rendered = rendered_lines_cache.get(key, piece)
+                if rendered is not None:
+                    self.decorate_display.pin_code_blocks(rendered.code_blocks)
+                    return rendered.lines
+            code_blocks = []
+            out = self.decorator(piece, code_blocks=code_blocks)
+            if change_line:
+                out.append(Text())
+            if conversation_key is not None:
+                rendered_lines_cache.put(key, piece, out, code_blocks=code_blocks)
+            return out
+
+        # The messages are decorated only when they come into view.
+        chat_region.update_messages(pieces, renderer)
 
     def context_piece_to_chat_window(self, piece: dict, change_line: bool = False, decorator_switch: bool = False) -> None:
         chat_region = self.main_screen.query_one("#chat_region")
@@ -1207,7 +1259,8 @@ class MainApp(App[str]):
         piece: dict,
         stream: bool = False,
         copy_code: bool = True,
-        emoji: bool = True
+        emoji: bool = True,
+        code_blocks: list[int] | None = None,
     ) -> Lines:
         content = piece["content"]
         role = piece["role"]
@@ -1215,19 +1268,41 @@ class MainApp(App[str]):
 
         displayer = self.main_screen.query_one("#chat_region")
         width = displayer.content_size.width
+        out = self.decorate_content(content, stream=stream, copy_code=copy_code, emoji=emoji, code_blocks=code_blocks)
+
+        chain = self.decorate_display.background_chain(out, width-5)
+        color, role_display = self.message_frame(role, name)
+        if name is None:
+            chain.panel_chain(panel_color=color).indicator_chain(indicator_color=color)
+            return chain.chain_lines
+        else:
+            chain.panel_chain(panel_color=color)
+            role_display.extend(chain.chain_lines)
+            chain.chain_lines = role_display
+            chain.indicator_chain(indicator_color=color)
+            return chain.chain_lines
+
+    def decorate_content(
+        self,
+        content: str,
+        stream: bool = False,
+        copy_code: bool = True,
+        emoji: bool = True,
+        code_blocks: list[int] | None = None,
+    ) -> Text:
+        "The content of a message with its emojis, files and code blocks decorated, before it is put in its frame."
         if emoji:
             content = Emoji.replace(content)
         wrap_file = self.main_screen.query_one("#file_wrap_display").value
-        out = self.decorate_display.pre_wrap_and_highlight(
+        return self.decorate_display.pre_wrap_and_highlight(
             inp_string=content,
             stream=stream,
             copy_code=copy_code,
-            wrap={"file_wrap":{"wrap": wrap_file, "wrap_num": 4}})
-        
-        # Reset the decorate_display chain
-        self.decorate_display.get_and_reset_chain()
-        chain = self.decorate_display.background_chain(out, width-5)
-        
+            wrap={"file_wrap":{"wrap": wrap_file, "wrap_num": 4}},
+            code_blocks=code_blocks)
+
+    def message_frame(self, role: str, name: str | None = None) -> tuple[str, Lines]:
+        "The color of the frame of a message and the lines of the name above it."
         def string_to_color(s) -> str:
             # Translate a string to a color
             m = hashlib.md5()
@@ -1247,8 +1322,7 @@ class MainApp(App[str]):
                 color = tc("system_message") or "yellow"
             else:
                 color = tc("white") or "white"
-            chain.panel_chain(panel_color=color).indicator_chain(indicator_color=color)
-            return chain.chain_lines
+            return color, Lines()
         else:
             color = string_to_color(name)
             if role in {"user", "group_talk_user"}:
@@ -1264,11 +1338,7 @@ class MainApp(App[str]):
                     Text(u'\u2502' + role_icon + name + u'\u2502'),
                 ]
             )
-            chain.panel_chain(panel_color=color)
-            role_display.extend(chain.chain_lines)
-            chain.chain_lines = role_display
-            chain.indicator_chain(indicator_color=color)
-            return chain.chain_lines
+            return color, role_display
     
     def get_tokens_window(self, model: str) -> int:
         """Query tokens window for openai model from config.
@@ -1286,6 +1356,7 @@ class MainApp(App[str]):
         if int(old_tab_id[3:]) < 0:
             tabs.remove_tab(old_tab_id)
             self.no_context_manager.no_context_chat_delete(int(old_tab_id[3:]))
+            rendered_lines_cache.invalidate_conversation(old_tab_id)
             return
 
         conversation_id = int(old_tab_id[3:])
@@ -1298,6 +1369,7 @@ class MainApp(App[str]):
                 elif tab_mode == "lxt":
                     self.openai.delete_group_talk_conversation(group_talk_conversation_id=int(old_tab_id[3:]))
                 self.chat_display.delete_buffer_id(id=int(old_tab_id[3:]))
+                rendered_lines_cache.invalidate_conversation(old_tab_id)
                 self.post_message(AnimationRequest(ani_id=conversation_id, action="end"))
             else:
                 return
@@ -1417,13 +1489,14 @@ class MainApp(App[str]):
             ani_end_display=self.status_region_default,
         )
         self.decorate_display = DecorateDisplay(self)
+        rendered_lines_cache.on_release = self.decorate_display.release_code_blocks
         self.drivers = DriverManager(self)
         self.chat_display = ChatResponse(self)
         self.voice_service = VoiceService(self, self.main_screen.query_one("#speak_switch").value)
         self.notification = Notification(self)
+        self.dash_board = DashBoard(self)
         self.chat_context = ChatContextControl(self)
         self.assistant_tube = AssistantTube(self)
-        self.dash_board = DashBoard(self)
         self.group_talk = GroupTalkControl(self)
         self.horse = Horse()
 
@@ -1482,7 +1555,7 @@ class MainApp(App[str]):
             self.openai = OpenaiChatManage(
                 app=self,
                 manager=self.manager,
-                openai_chat=OpenaiChat(self.manager),
+                openai_chat=AsyncOpenaiChat(self.manager) if self.config["openai_client_config"].get("native_async") else OpenaiChat(self.manager),
                 workpath=self.config["conversation_path"],
                 conversations_recover=self.main_screen.query_one("#conversations_recover").value,
             )
@@ -1717,6 +1790,8 @@ class MainApp(App[str]):
 
     def action_toggle_monochrome(self):
         self.toggle_class("monochrome")
+        # The messages are decorated with the colors of the theme.
+        rendered_lines_cache.invalidate_theme(ThemeColor._theme)
         if ThemeColor._theme == "monochrome":
             ThemeColor.set_theme(self.color_theme)
             try:
@@ -1780,7 +1855,7 @@ class NoContextChat:
         self.no_context_chat_active = 0
         self.no_context_chat_dict = {}
         self.chat_stream_content = {"role":"assistant", "content":''}
-        self.decorate_chat_stream_content_lines = Lines()
+        self.decorate_chat_stream_content_lines = IncrementalDecorator(app)
 
     def open_no_context_chat(self) -> int:
         self.count -= 1
@@ -1799,13 +1874,19 @@ class NoContextChat:
         self.no_context_chat_dict[self.no_context_chat_active].append(message)
         ani_id = str(uuid.uuid4())
         app.post_message(AnimationRequest(ani_id=ani_id, action="start"))
+        # It is held until the response has been received, a slot left by an exception is released when collected.
+        stream_slot = stream_limiter.acquire(("no_context_chat", self.no_context_chat_active))
         try:
-            response = self.openai_api_client.with_options(timeout=20.0).chat.completions.create(
-                model = app.config["default_openai_parameters"]["model"] or "gpt-4",
-                messages = [message],
-                stream = app.config["default_openai_parameters"]["stream"],
-                )
+            response = request_scheduler.chat_completions_create(
+                self.openai_api_client,
+                priority=RequestPriority.USER,
+                call_site="no_context_chat",
+                model=app.config["default_openai_parameters"]["model"] or "gpt-4",
+                messages=[message],
+                stream=app.config["default_openai_parameters"]["stream"],
+            )
         except Exception as e:
+            stream_slot.release()
             app.post_message(AnimationRequest(ani_id=ani_id, action="end"))
             self.app.main_screen.query_one("#status_region").update(Text(f"An error occurred during communication with OpenAI. Error: {e}"))
             return
@@ -1828,10 +1909,12 @@ class NoContextChat:
                 chunk_message = chunk.choices[0].delta.content
                 collected_messages += chunk_message
                 self.chat_stream_display({"message":chunk_message, "status":"content"})
+            stream_slot.release()
             self.chat_stream_display({"message":'', "status":"end"})
             self.voice_speak(collected_messages)
             self.no_context_chat_dict[self.no_context_chat_active].append({"role":"assistant", "content":collected_messages})
         else:
+            stream_slot.release()
             app.post_message(AnimationRequest(ani_id = ani_id, action = "end"))
             reply_content = response.choices[0].message.content
             self.voice_speak(reply_content)
@@ -1844,16 +1927,13 @@ class NoContextChat:
         chat_region = self.app.main_screen.query_one("#chat_region")
         char = message["message"]
         if message['status'] == "content":
-            length = len(self.decorate_chat_stream_content_lines)
-            chat_region.right_pop_lines(length, refresh=False)
             self.chat_stream_content["content"] += char
-            self.decorate_chat_stream_content_lines = self.app.decorator(self.chat_stream_content, stream, copy_code)
-            chat_region.write_lines(self.decorate_chat_stream_content_lines)
+            self.app.chat_display.write_stream_lines(self.decorate_chat_stream_content_lines, self.chat_stream_content, True, stream, copy_code)
         elif message['status'] == "end":
             self.chat_stream_display({"message":'', "status":"content"}, stream=False, copy_code=True)
             chat_region.write_lines([Text()])
             self.chat_stream_content = {"role":"assistant", "content":''}
-            self.decorate_chat_stream_content_lines = Lines()
+            self.decorate_chat_stream_content_lines.reset()
 
     def voice_speak(self, speak_text: str):
         if self.app.main_screen.query_one("#speak_switch").value:
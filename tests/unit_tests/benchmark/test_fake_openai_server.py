@@ -0,0 +1,74 @@
+import time
+
+import pytest
+from openai import OpenAI
+
+from gptui.benchmark.fake_openai_server import FakeOpenAIServer, FakeServerOptions
+from gptui.benchmark.harness import RunResult, content_chunks, summarize
+
+
+@pytest.fixture
+def server():
+    with FakeOpenAIServer(FakeServerOptions(completion_tokens=20, chunk_tokens=2)) as server:
+        yield server
+
+
+def test_fake_server_chat_completions(server):
+    client = OpenAI(api_key="fake", base_url=server.base_url)
+    messages = [{"role": "user", "content": "Hi!"}]
+    chunks = list(client.chat.completions.create(model="gpt-4", messages=messages, stream=True))
+    content = "".join(chunk.choices[0].delta.content or "" for chunk in chunks)
+    assert len(chunks) == 1 + 10 + 1 == 1 + content_chunks(server.options) + 1
+    assert chunks[-1].choices[0].finish_reason == "stop"
+
+    completion = client.chat.completions.create(model="gpt-4", messages=messages)
+    assert completion.choices[0].message.content == content
+    assert completion.usage.completion_tokens == 20
+    assert server.requests[0]["body"]["messages"] == messages
+
+
+def test_fake_server_tool_calls(server):
+    server.options.tool_calls = True
+    server.options.tool_arguments = '{"city": "Paris"}'
+    client = OpenAI(api_key="fake", base_url=server.base_url)
+    tools = [{"type": "function", "function": {"name": "weather", "parameters": {"type": "object", "properties": {}}}}]
+    messages = [{"role": "user", "content": "Weather?"}]
+    chunks = list(client.chat.completions.create(model="gpt-4", messages=messages, tools=tools, stream=True))
+    arguments = "".join(chunk.choices[0].delta.tool_calls[0].function.arguments for chunk in chunks[:-1])
+    assert chunks[0].choices[0].delta.tool_calls[0].function.name == "weather"
+    assert arguments == '{"city": "Paris"}'
+    assert chunks[-1].choices[0].finish_reason == "tool_calls"
+
+    # The reply to a tool result is a message.
+    messages += [
+        {"role": "assistant", "content": None, "tool_calls": [{"id": "call_0", "type": "function", "function": {"name": "weather", "arguments": arguments}}]},
+        {"role": "tool", "tool_call_id": "call_0", "content": "Sunny"},
+    ]
+    completion = client.chat.completions.create(model="gpt-4", messages=messages, tools=tools)
+    assert completion.choices[0].finish_reason == "stop"
+    assert completion.choices[0].message.content
+
+
+def test_fake_server_embeddings_and_pacing(server):
+    client = OpenAI(api_key="fake", base_url=server.base_url)
+    embeddings = client.embeddings.create(model="text-embedding-ada-002", input=["a", "b", "a"])
+    vectors = [item.embedding for item in embeddings.data]
+    assert len(vectors[0]) == 1536
+    assert vectors[0] == vectors[2] != vectors[1]
+    assert client.audio.speech.create(model="tts-1", voice="alloy", input="Hi!").content[:4] == b"RIFF"
+
+    server.options.first_token_delay = 0.1
+    server.options.tokens_per_second = 200
+    start = time.monotonic()
+    stream = client.chat.completions.create(model="gpt-4", messages=[{"role": "user", "content": "Hi!"}], stream=True)
+    next(iter(stream))
+    assert time.monotonic() - start >= 0.1
+    list(stream)
+    # 10 chunks of 2 tokens at 200 tokens per second.
+    assert time.monotonic() - start >= 0.1 + 0.09
+
+
+@pytest.mark.parametrize("n, p95", [(1, 1), (10, 10), (19, 19), (20, 19), (21, 20), (100, 95)])
+def test_summarize_display_p95(n, p95):
+    results = [RunResult(display_times=[i / 1000 for i in range(1, n + 1)])]
+    assert summarize(results)["display_p95_ms"] == pytest.approx(p95)
@@ -1,6 +1,25 @@
+import io
 import textwrap
-from gptui.controllers.decorate_display_control import extract_files_from_string
+from types import SimpleNamespace
+
+import pytest
+from pygments import highlight
+from pygments.formatters import TerminalTrueColorFormatter
 from rich import print
+from rich.console import Console
+from rich.emoji import Emoji
+
+from gptui.controllers.decorate_display_control import (
+    DecorateDisplay,
+    IncrementalDecorator,
+    RenderedLinesCache,
+    extract_files_from_string,
+    highlight_cache,
+    highlight_to_text,
+    lexer_by_name,
+)
+from gptui.utils.my_text import MyLines as Lines
+from gptui.utils.my_text import MyText as Text
 
 
 def test_extract_files_from_string():
@@ -61,3 +80,163 @@ def test_wrap_files_in_string():
     out = wrap_files_in_string(input)
     print(out)
 '''
+
+
+class FakeApp:
+    "The parts of MainApp used to decorate a message, in a chat window of width 40."
+
+    def __init__(self, wrap_file: bool):
+        widgets = {
+            "#chat_region": SimpleNamespace(content_size=SimpleNamespace(width=40)),
+            "#file_wrap_display": SimpleNamespace(value=wrap_file),
+        }
+        self.main_screen = SimpleNamespace(query_one=widgets.get)
+        self.decorate_display = DecorateDisplay(self)
+
+    def decorate_content(self, content, stream=False, copy_code=True, emoji=True, code_blocks=None):
+        return self.decorate_display.pre_wrap_and_highlight(
+            inp_string=Emoji.replace(content) if emoji else content,
+            stream=stream,
+            copy_code=copy_code,
+            wrap={"file_wrap": {"wrap": self.main_screen.query_one("#file_wrap_display").value, "wrap_num": 4}},
+            code_blocks=code_blocks,
+        )
+
+    def message_frame(self, role, name=None):
+        return "red", Lines([Text(name)] if name else [])
+
+    def decorator(self, piece, stream=False, copy_code=True, code_blocks=None):
+        color, role_display = self.message_frame(piece["role"], piece.get("name"))
+        width = self.main_screen.query_one("#chat_region").content_size.width
+        chain = self.decorate_display.background_chain(self.decorate_content(piece["content"], stream, copy_code, code_blocks=code_blocks), width - 5).panel_chain(panel_color=color)
+        role_display.extend(chain.chain_lines)
+        chain.chain_lines = role_display
+        return chain.indicator_chain(indicator_color=color).chain_lines
+
+
+@pytest.mark.parametrize("wrap_file", [False, True])
+def test_incremental_decorator(wrap_file):
+    content = textwrap.dedent(
+    """\
+    Hello :smile:, here is a file and some code.
+    ******************** FILE CONTENT BEGIN ********************
+    ===== Document #1 text.txt =====
+
+    This is the content of the document #1.
+    ******************** FILE CONTENT FINISH *******************
+    A line long enough to be wrapped in the chat window, and then some more words.
+    ```python
+    def add(a, b):
+        return a + b
+    ```
+    The end.
+    """
+    )
+    app = FakeApp(wrap_file)
+    decoration = IncrementalDecorator(app)
+    displayed = []
+    for end in range(1, len(content) + 1):
+        piece = {"role": "assistant", "name": "bot", "content": content[:end]}
+        remove_num, new_lines = decoration.update(piece)
+        del displayed[len(displayed) - remove_num:]
+        displayed.extend(new_lines)
+        # The lines displayed are always the same as those of decorating the whole message.
+        assert [line.markup for line in displayed] == [line.markup for line in app.decorator(piece, stream=True, copy_code=False)]
+    assert decoration.settled > 0
+
+
+
+def test_decorate_chain_is_not_shared():
+    decorate_display = FakeApp(wrap_file=False).decorate_display
+    chain = decorate_display.background_chain(Text("a long message"), 20)
+    # Another message is decorated in the middle of the chain, e.g. on the other thread.
+    other = decorate_display.background_chain(Text("hi"), 20).panel_chain(panel_color="red")
+    lines = chain.panel_chain(panel_color="red").indicator_chain(indicator_color="red").chain_lines
+    assert [line.plain for line in lines] == ["├─ ╭--------------╮", "│  ┆a long message┆", "│  ╰--------------╯"]
+    assert [line.plain for line in other.chain_lines] == ["╭--╮", "┆hi┆", "╰--╯"]
+
+def test_highlight_cache():
+    highlight_cache.clear()
+    app = FakeApp(wrap_file=False)
+    content = "".join(f"Block {i}:\n```python\nprint({i})\n```\n" for i in range(50))
+    app.decorator({"role": "assistant", "content": content})
+    assert highlight_cache.misses == 50
+    # Displayed again, at another width, none of the code blocks is highlighted again.
+    app.main_screen.query_one("#chat_region").content_size.width = 60
+    app.decorator({"role": "assistant", "content": content})
+    assert highlight_cache.misses == 50 and highlight_cache.hits == 50
+    assert lexer_by_name("python") is lexer_by_name("python")
+    assert lexer_by_name("no-such-language") is None
+
+
+@pytest.mark.parametrize(
+    "lang, code",
+    [
+        ("python", 'def f(a: int) -> str:\n    """Doc."""\n    return f"{a!r}"  # comment'),
+        ("javascript", "let s = `multi\nline`;\nconsole.log(s);"),
+        ("c", "int main() {\n\treturn 0;\n}\n\n"),
+    ],
+)
+@pytest.mark.parametrize("style", ["material", "default", "emacs", "monokai", "xcode"])
+def test_highlight_to_text(lang, code, style):
+    lexer = lexer_by_name(lang)
+    expected = Text.from_ansi(highlight(code, lexer, TerminalTrueColorFormatter(style=style)))
+    out = highlight_to_text(code, lexer, style)
+    assert out.plain == expected.plain
+
+    def render(text):
+        console = Console(color_system="truecolor", width=80, record=True, file=io.StringIO())
+        console.print(text, soft_wrap=True)
+        return console.export_text(styles=True)
+    assert render(out) == render(expected)
+
+
+def test_rendered_lines_cache():
+    cache = RenderedLinesCache(max_lines=10)
+    piece = {"role": "user", "name": None, "content": "hello"}
+    lines = Lines([Text("hello"), Text()])
+    cache.put(("lqt1", 0, 40, "default", False), piece, lines)
+    assert cache.get(("lqt1", 0, 40, "default", False), dict(piece)).lines is lines
+    assert cache.get(("lqt1", 0, 60, "default", False), piece) is None
+    # The message was edited.
+    assert cache.get(("lqt1", 0, 40, "default", False), {**piece, "content": "hi"}) is None
+    assert cache.get(("lqt1", 0, 40, "default", False), piece) is None
+
+    for index in range(4):
+        cache.put(("lqt1", index, 40, "default", False), piece, Lines([Text()] * 3))
+    # Bounded by the number of lines, the least recently used is dropped.
+    assert cache.lines_num == 9
+    assert cache.get(("lqt1", 0, 40, "default", False), piece) is None
+
+    cache.put(("lqt2", 0, 60, "monochrome", False), piece, Lines([Text()]))
+    cache.invalidate_theme("monochrome")
+    assert cache.get(("lqt2", 0, 60, "monochrome", False), piece) is None
+    cache.put(("lqt2", 0, 60, "default", False), piece, Lines([Text()]))
+    cache.invalidate_width(keep=60)
+    assert cache.lines_num == 1
+    cache.invalidate_conversation("lqt2")
+    assert cache.lines_num == 0
+
+
+def test_rendered_lines_cache_code_blocks():
+    app = FakeApp(wrap_file=False)
+    decorate_display = app.decorate_display
+    cache = RenderedLinesCache(max_lines=100, on_release=decorate_display.release_code_blocks)
+    piece = {"role": "assistant", "content": "```python\nprint(1)\n```\n```python\nprint(2)\n```"}
+    code_blocks = []
+    lines = app.decorator(piece, code_blocks=code_blocks)
+    assert [decorate_display.code_blocks[index] for index in code_blocks] == ["print(1)", "print(2)"]
+    cache.put(("lqt1", 0, 40, "default", False), piece, lines, code_blocks=code_blocks)
+    # A code block decorated again gets the same index.
+    assert decorate_display.code_block_index("print(1)") == code_blocks[0]
+
+    # Kept for the cached lines when the chat window is cleared, with the index of the code blocks.
+    decorate_display.code_block_index("print(3)")
+    decorate_display.clear_code_block(keep=cache.code_blocks())
+    assert sorted(decorate_display.code_blocks.values()) == ["print(1)", "print(2)"]
+    # Released with the last cached lines referring to them, unless they are shown.
+    decorate_display.pin_code_blocks(code_blocks[:1])
+    cache.invalidate_conversation("lqt1")
+    assert list(decorate_display.code_blocks.values()) == ["print(1)"]
+    decorate_display.clear_code_block(keep=cache.code_blocks())
+    assert decorate_display.code_blocks == {} and decorate_display.code_block_index_dict == {}
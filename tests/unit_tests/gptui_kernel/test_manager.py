@@ -20,3 +20,17 @@ def test_scan_plugin():
         native_plugins_name_list = [plugin_meta.name for plugin_meta in native_plugins]
         assert set(semantic_plugins_name_list) == {"FunSkill"}
         assert set(native_plugins_name_list) == {"WebServe", "MathPlugin", "WriteFile"}
+
+
+def test_plugins_version():
+    with patch('gptui.gptui_kernel.kernel.dotenv_values', return_value=mocked_dotenv_values):
+        app = App()
+        manager = Manager(app, dot_env_config_path=os.path.expanduser("~/.gptui/.env_gptui"))
+        version = manager.plugins_version
+        assert manager.plugins_version == version
+        manager.add_plugins(("./tests/unit_tests/gptui_kernel/plugins_test_data", "math_plugin", "MathPlugin"))
+        added_version = manager.plugins_version
+        assert added_version != version
+        manager.overwrite_plugins([])
+        assert manager.plugins_version not in {version, added_version}
+        assert manager.services.plugins_version != manager.plugins_version
@@ -0,0 +1,24 @@
+import pytest
+import tiktoken
+
+from gptui.models.utils.tokens_num import clear_functions_tokens_num_cache, tokenizer_registry, tokens_num_cache
+
+
+@pytest.fixture
+def byte_encoding(monkeypatch):
+    """An offline encoding that maps every byte to one token."""
+    encoding = tiktoken.Encoding(
+        name="test_bytes",
+        pat_str=r"\S+|\s+",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={},
+    )
+    monkeypatch.setattr(tiktoken, "encoding_for_model", lambda model: encoding)
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: encoding)
+    tokenizer_registry.clear()
+    tokens_num_cache.clear()
+    clear_functions_tokens_num_cache()
+    yield encoding
+    tokenizer_registry.clear()
+    tokens_num_cache.clear()
+    clear_functions_tokens_num_cache()
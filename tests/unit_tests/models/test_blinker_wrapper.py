@@ -0,0 +1,45 @@
+import asyncio
+import concurrent.futures
+import threading
+
+from blinker import Signal
+
+from gptui.models.blinker_wrapper import async_wrapper_deferred, async_wrapper_without_loop, event_loop_bridge
+
+
+def test_async_wrapper_without_loop_reuses_one_loop():
+    signal = Signal()
+    loops = []
+    threads = []
+
+    async def receiver(sender, **kwargs):
+        loops.append(asyncio.get_running_loop())
+        threads.append(threading.current_thread())
+        return kwargs["message"] * 2
+
+    signal.connect(receiver)
+    results = [signal.send("sender", _async_wrapper=async_wrapper_without_loop, message=i)[0][1] for i in range(3)]
+    assert results == [0, 2, 4]
+    assert len(set(loops)) == 1
+    assert threads[0] is not threading.current_thread()
+
+
+def test_async_wrapper_deferred_keeps_order():
+    signal = Signal()
+    received = []
+
+    async def receiver(sender, **kwargs):
+        received.append(kwargs["message"])
+        return kwargs["message"]
+
+    signal.connect(receiver)
+    futures = []
+    for i in range(100):
+        futures += [result for _, result in signal.send("sender", _async_wrapper=async_wrapper_deferred, message=i)]
+    assert all(isinstance(future, concurrent.futures.Future) for future in futures)
+    assert event_loop_bridge.wait(futures) == list(range(100))
+    assert received == list(range(100))
+
+    async def double(i):
+        return i * 2
+    assert event_loop_bridge.run_batch(double(i) for i in range(3)) == [0, 2, 4]
@@ -1,6 +1,9 @@
 import json
 import copy
 from dataclasses import asdict
+
+import pytest
+
 from gptui.models.context import OpenaiContext
 
 def test_openai_context_serialization_deserialization():
@@ -21,3 +24,161 @@ def test_openai_context_deepcopy():
     assert id(openai_context_deepcopy.chat_context) != id(openai_context_original.chat_context)
     assert set(map(id, openai_context_original.plugins)) == set(map(id, openai_context_deepcopy.plugins))
 
+
+def test_openai_context_model_switch_keeps_content_tokens_num(byte_encoding):
+    from gptui.models.utils.tokens_num import tokens_num_cache
+    openai_context = OpenaiContext(chat_context=[], parameters={"model": "gpt-4"})
+    openai_context.chat_context_append({"role": "user", "content": "Hi!"})
+    openai_context.chat_context_append({"role": "user", "name": "abc", "content": "Hi!"})
+    assert openai_context.tokens_num_list == [13, 17]
+    misses = tokens_num_cache.info()["misses"]
+    openai_context.parameters["model"] = "gpt-3.5-turbo-0301"
+    assert openai_context.tokens_num_list == [14, 16]
+    openai_context.parameters["model"] = "gpt-4"
+    assert openai_context.tokens_num_list == [13, 17]
+    assert tokens_num_cache.info()["misses"] == misses
+
+def test_prefill_tokens_num(byte_encoding):
+    from gptui.models.context import prefill_tokens_num
+    from gptui.models.utils.tokens_num import tokens_num_cache
+    messages = [{"role": "user", "content": "Hi!"}, {"role": "user", "name": "abc", "content": "Hi!"}, {"role": "assistant", "content": None}]
+    context1 = OpenaiContext(chat_context=list(messages), parameters={"model": "gpt-4"})
+    context2 = OpenaiContext(chat_context=list(messages), parameters={"model": "gpt-4"})
+    context2.chat_context_append({"role": "user", "content": "new"})
+    prefill_tokens_num([context1, context2], num_threads=2)
+    hits = tokens_num_cache.info()["hits"]
+    assert context1.tokens_num_list == [13, 17, 15]
+    assert context2.tokens_num_list == [13, 17, 15, 13]
+    # Already counted by the prefill, nothing is looked up again.
+    assert tokens_num_cache.info()["hits"] == hits
+
+def test_prefill_tokens_num_concurrent_sync(byte_encoding, monkeypatch):
+    import threading
+    from gptui.models.context import prefill_tokens_num
+    from gptui.models.utils.tokens_num import tokens_num_cache
+    context = OpenaiContext(chat_context=[{"role": "user", "content": "Hi!"}, {"role": "assistant", "content": None}], parameters={"model": "gpt-4"})
+    tokens_num_batch = tokens_num_cache.tokens_num_batch
+
+    def batch_with_sync(*args, **kwargs):
+        # Another thread appends a message and synchronizes the context while the prefill is counting.
+        def sync():
+            context.chat_context_append({"role": "user", "name": "abc", "content": "Hi!"})
+            context.tokens_num_list
+        thread = threading.Thread(target=sync)
+        thread.start()
+        thread.join()
+        return tokens_num_batch(*args, **kwargs)
+
+    monkeypatch.setattr(tokens_num_cache, "tokens_num_batch", batch_with_sync)
+    prefill_tokens_num([context], num_threads=2)
+    assert context.tokens_num_list == [13, 15, 17]
+    assert context.tokens_num == 45
+
+def test_openai_context_tokens_num_state(byte_encoding):
+    from gptui.models.utils.tokens_num import tokens_num_cache
+    openai_context = OpenaiContext(chat_context=[], parameters={"model": "gpt-4"})
+    openai_context.chat_context_append({"role": "user", "content": "Hi!"})
+    openai_context.chat_context_append({"role": "user", "name": "abc", "content": "Hi!"})
+    state = json.loads(json.dumps(openai_context.tokens_num_state()))
+    assert state["encoding"] == "test_bytes"
+    tokens_num_cache.clear()
+    build = asdict(openai_context)
+    build["parameters"]["model"] = "gpt-4-0613"
+    loaded_context = OpenaiContext(**build)
+    assert loaded_context.load_tokens_num_state(state)
+    assert loaded_context.tokens_num_list == [13, 17]
+    assert tokens_num_cache.info()["misses"] == 0
+    # Not trusted when it is not aligned with chat_context or the encoding does not match.
+    assert not OpenaiContext(chat_context=build["chat_context"][:1], parameters={"model": "gpt-4"}).load_tokens_num_state(state)
+    assert not OpenaiContext(**asdict(openai_context)).load_tokens_num_state({**state, "encoding": "other"})
+
+
+def test_openai_context_view(byte_encoding):
+    from gptui.models.context import BeadOpenaiContext
+    from gptui.models.openai_tokens_truncate import trim_excess_tokens
+    base = BeadOpenaiContext(chat_context=[], parameters={"model": "gpt-4"}, max_sending_tokens_num=40)
+    base.bead = [{"role": "system", "content": "Bead"}]
+    base.chat_context_append({"role": "user", "content": "Hi!"})
+    base.chat_context_append({"role": "user", "name": "abc", "content": "Hi!"})
+    view = base.view()
+    view.chat_context_append({"role": "assistant", "content": "Hello"})
+    view.parameters["stream"] = True
+    assert "stream" not in base.parameters
+    assert len(base.chat_context) == 2
+    assert view.chat_context[0] is base.chat_context[0]
+    assert view.chat_context[1:] == [base.chat_context[1], {"role": "assistant", "content": "Hello"}]
+    assert view.tokens_num_list == [13, 17, 20]
+    # Messages appended to the base afterwards are not seen by the view.
+    base.chat_context_append({"role": "user", "content": "later"})
+    assert len(view.chat_context) == 3 and view.tokens_num == 50
+    assert trim_excess_tokens(view) == [{"role": "user", "name": "abc", "content": "Hi!"}, {"role": "assistant", "content": "Hello"}]
+    # The bead is inserted into the view only.
+    assert view.auto_insert_bead()
+    assert view.chat_context[-1] == {"role": "system", "content": "Bead"}
+    assert base.bead_info["positions"] == [] and len(base.chat_context) == 3
+    # A different model in the view is counted without touching the base.
+    other_view = base.view(parameters={"model": "gpt-3.5-turbo-0301"})
+    assert other_view.tokens_num_list == [14, 16, 16]
+    assert base.tokens_num_list == [13, 17, 15]
+
+def test_openai_context_view_base_changed(byte_encoding):
+    base = OpenaiContext(chat_context=[], parameters={"model": "gpt-4"})
+    base.chat_context_append({"role": "user", "content": "Hi!"})
+    base.chat_context_append({"role": "user", "name": "abc", "content": "Hi!"})
+    view = base.view()
+    view.chat_context_append({"role": "assistant", "content": "Hello"})
+    assert view.tokens_num_list == [13, 17, 20]
+    # Inserting or popping in the middle of the base does not shift the messages or the tokens num under the view.
+    base.chat_context_insert(0, {"role": "user", "content": "inserted"})
+    assert view.chat_context[:] == [{"role": "user", "content": "Hi!"}, {"role": "user", "name": "abc", "content": "Hi!"}, {"role": "assistant", "content": "Hello"}]
+    assert view.tokens_num_list == [13, 17, 20] and view.tokens_num == 50
+    base.chat_context_pop(1)
+    base.chat_context_pop(1)
+    assert len(view.chat_context) == 3 and view.tokens_num_list == [13, 17, 20]
+    assert base.tokens_num_list == [18]
+    # A view created afterwards sees the base as it is now.
+    assert base.view().tokens_num_list == [18]
+
+def test_openai_context_handle():
+    import gc
+    from gptui.models.context_handle import OpenaiContextHandle, openai_context_registry
+    openai_context = OpenaiContext(chat_context=[{"role": "user", "content": "Hi!"}], id=3)
+    handle_str = openai_context_registry.handle(openai_context).to_json()
+    # Plugins only reading the id can still parse it as a dict.
+    assert json.loads(handle_str)["id"] == 3
+    handle = OpenaiContextHandle.from_json(handle_str)
+    assert handle.id == 3
+    assert handle.context is openai_context
+    del openai_context
+    gc.collect()
+    assert handle.context is None
+    with pytest.raises(ValueError):
+        OpenaiContextHandle.from_json("AUTO")
+
+def test_tokens_num_since_bead_matches_sum(byte_encoding):
+    import random
+    from gptui.models.context import BeadOpenaiContext
+    from gptui.models.utils.tokens_num import tokens_num_from_chat_context
+    rng = random.Random(0)
+    for _ in range(30):
+        context = BeadOpenaiContext(chat_context=[], parameters={"model": "gpt-4"}, max_sending_tokens_num=rng.randint(50, 300))
+        context.bead = [{"role": "system", "content": "bead" * rng.randint(1, 5)}]
+        for _ in range(60):
+            operation = rng.choice(["append", "append", "append", "pop", "insert_bead", "auto_insert_bead", "switch_model"])
+            if operation == "append":
+                message = {"role": rng.choice(["user", "assistant"]), "content": "x" * rng.randint(0, 40)}
+                if rng.random() < 0.3:
+                    message["name"] = "abc"
+                context.chat_context_append(message)
+            elif operation == "pop" and context.chat_context:
+                context.chat_context_pop(rng.randint(-len(context.chat_context), len(context.chat_context) - 1))
+            elif operation == "insert_bead":
+                context.insert_bead()
+            elif operation == "auto_insert_bead":
+                context.auto_insert_bead()
+            elif operation == "switch_model":
+                context.parameters["model"] = rng.choice(["gpt-4", "gpt-3.5-turbo-0301"])
+            model = context.parameters["model"]
+            last_bead_position = context.bead_info["positions"][-1] if context.bead_info["positions"] else 0
+            expected = sum(tokens_num_from_chat_context([message], model=model) for message in context.chat_context[last_bead_position:])
+            assert context.tokens_num_since_bead == expected
@@ -0,0 +1,25 @@
+from gptui.models.handlers import LLMNativeAsyncAdapter
+
+
+async def test_llm_native_async_adapter():
+    events = []
+
+    async def response():
+        for chunk in ["a", "b"]:
+            events.append(f"send {chunk}")
+            yield chunk
+
+    adapter = LLMNativeAsyncAdapter()
+    chunks = []
+    async for chunk in adapter.llm_to_async_iterable(
+        response=response(),
+        at_receiving_start=[{"function": lambda: events.append("start")}],
+        at_receiving_end=[{"function": lambda: events.append("end")}],
+    ):
+        chunks.append(chunk)
+    assert chunks == ["a", "b"]
+    assert events == ["send a", "start", "send b", "end"]
+    assert adapter.received_message == ["a", "b"]
+
+    # A sync response still works.
+    assert [chunk async for chunk in adapter.llm_to_async_iterable(response=["c"])] == ["c"]
@@ -0,0 +1,30 @@
+import os
+
+from openai import AsyncOpenAI, OpenAI
+
+from gptui.models.utils.openai_api import OpenAIClientRegistry
+
+
+def test_openai_client_registry(tmp_path):
+    dot_env_path = str(tmp_path / ".env")
+    with open(dot_env_path, "w") as f:
+        f.write("OPENAI_API_KEY=key_1\n")
+    registry = OpenAIClientRegistry(max_connections=5)
+    client = registry.client(dot_env_path)
+    assert isinstance(client, OpenAI)
+    assert registry.client(dot_env_path) is client
+    assert isinstance(registry.client(dot_env_path, async_client=True), AsyncOpenAI)
+    other_client = registry.client(dot_env_path, base_url="http://127.0.0.1:1/v1")
+    assert other_client is not client
+    # Sync clients share one connection pool.
+    assert other_client._client is client._client
+    assert registry.info()["clients"] == 3
+    assert registry.info()["hits"] == 1
+
+    # A changed dot env file is parsed again.
+    with open(dot_env_path, "w") as f:
+        f.write("OPENAI_API_KEY=key_2\n")
+    os.utime(dot_env_path, (0, 0))
+    new_client = registry.client(dot_env_path)
+    assert new_client is not client
+    assert new_client.api_key == "key_2"
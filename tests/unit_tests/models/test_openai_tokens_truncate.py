@@ -1,4 +1,6 @@
-from gptui.models.openai_tokens_truncate import find_position
+from gptui.models.context import BeadOpenaiContext, OpenaiContext
+from gptui.models.openai_tokens_truncate import find_position, prefix_cache_tracker, trim_excess_tokens, trim_string_by_tokens
+from gptui.models.utils.tokens_num import tokens_num_from_chat_context
 
 
 def test_find_position():
@@ -14,3 +16,67 @@ def test_find_position():
     assert result == 9
     result = find_position(lst, 20)
     assert result == 0
+
+
+def test_trim_string_by_tokens(byte_encoding):
+    string = "first line\nsecond line\nthird line"
+    assert trim_string_by_tokens(string, max_tokens=100, model="gpt-4") == string
+    assert trim_string_by_tokens(string, max_tokens=0, model="gpt-4") == ""
+    assert trim_string_by_tokens(string, max_tokens=13, model="gpt-4") == "ne\nthird line"
+    assert trim_string_by_tokens(string, max_tokens=13, model="gpt-4", snap="word") == "third line"
+    assert trim_string_by_tokens(string, max_tokens=17, model="gpt-4", snap="line") == "third line"
+    # A cut inside a multi-byte character drops the incomplete bytes.
+    assert trim_string_by_tokens("aé", max_tokens=1, model="gpt-4") == ""
+
+
+def test_trim_excess_tokens_trims_last_message(byte_encoding):
+    context = OpenaiContext(parameters={"model": "gpt-4"}, chat_context=[])
+    context.chat_context_append({"role": "user", "content": "old message"})
+    context.chat_context_append({"role": "user", "content": "a" * 100})
+    trimmed = trim_excess_tokens(context, max_tokens_num=30)
+    assert trimmed == [{"role": "user", "content": "a" * 19}]
+    assert tokens_num_from_chat_context(trimmed, model="gpt-4") == 29
+    # The original context is not changed.
+    assert context.chat_context[-1]["content"] == "a" * 100
+
+
+def test_trim_excess_tokens_chunked_window(byte_encoding):
+    context = BeadOpenaiContext(parameters={"model": "gpt-4"}, chat_context=[], bead=[{"role": "system", "content": "bead"}], id="chunked")
+    context.insert_bead()
+    firsts, suffix_firsts = [], []
+    for i in range(40):
+        context.chat_context_append({"role": "user", "content": f"message {i:02d}"})
+        suffix_firsts.append(trim_excess_tokens(context, max_tokens_num=200, strategy="suffix")[0]["content"])
+        trimmed = trim_excess_tokens(context, max_tokens_num=200, strategy="chunked_window")
+        assert tokens_num_from_chat_context(trimmed, model="gpt-4") < 200 + 3
+        # The bead stays pinned at the beginning.
+        assert trimmed[0] == {"role": "system", "content": "bead"}
+        firsts.append(trimmed[1]["content"])
+    # Once over the window, the suffix strategy starts with a different message on every turn,
+    # while the chunked window only moves once in a few turns.
+    assert sum(a != b for a, b in zip(suffix_firsts[-20:], suffix_firsts[-19:])) == 19
+    assert sum(a != b for a, b in zip(firsts[-20:], firsts[-19:])) <= 9
+    fraction = prefix_cache_tracker.cached_prefix_fraction("chunked", truncated_only=True)
+    assert fraction is not None
+
+    # While the window does not move, a request shares the whole previous request as its prefix.
+    previous = trim_excess_tokens(context, max_tokens_num=200, strategy="chunked_window")
+    checked = 0
+    for i in range(5):
+        context.chat_context_append({"role": "assistant", "content": f"reply {i}"})
+        trimmed = trim_excess_tokens(context, max_tokens_num=200, strategy="chunked_window")
+        if trimmed[1] == previous[1]:
+            total = context.tokens_num_index.range_sum(0, 1) + sum(context.tokens_num_list[-len(trimmed) + 1:])
+            assert prefix_cache_tracker.cached_prefix_fraction("chunked") == (total - context.tokens_num_list[-1]) / total
+            checked += 1
+        previous = trimmed
+    assert checked
+
+
+def test_trim_excess_tokens_chunked_window_skips_tool_replies(byte_encoding):
+    context = OpenaiContext(parameters={"model": "gpt-4"}, chat_context=[])
+    for i in range(10):
+        context.chat_context_append({"role": "tool", "tool_call_id": str(i), "content": "x" * 20})
+    context.chat_context_append({"role": "user", "content": "last"})
+    trimmed = trim_excess_tokens(context, max_tokens_num=100, strategy="chunked_window")
+    assert trimmed[0]["role"] != "tool"
@@ -0,0 +1,148 @@
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+
+from gptui.models.request_scheduler import RequestPriority, RequestScheduler
+
+
+def rate_limit_error(headers: dict) -> openai.RateLimitError:
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(429, headers=headers, request=request)
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+
+def test_request_scheduler_priority():
+    scheduler = RequestScheduler(default_rpm=60, default_tpm=100000, poll_interval=0.01)
+    # Use up the requests, one comes back every second.
+    for _ in range(60):
+        scheduler.acquire("gpt-4", tokens_num=10)
+    order = []
+
+    def request(name: str, priority: RequestPriority):
+        scheduler.acquire("gpt-4", tokens_num=10, priority=priority)
+        order.append(name)
+
+    threads = [threading.Thread(target=request, args=("background", RequestPriority.BACKGROUND))]
+    threads[0].start()
+    time.sleep(0.05)
+    threads.append(threading.Thread(target=request, args=("user", RequestPriority.USER)))
+    threads[1].start()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert order == ["user", "background"]
+    assert scheduler.info()["models"]["gpt-4"]["waiting"] == 0
+
+
+def test_request_scheduler_headers():
+    scheduler = RequestScheduler(default_rpm=500, default_tpm=30000)
+    scheduler.update_from_headers(
+        "gpt-4",
+        {
+            "x-ratelimit-limit-requests": "10000",
+            "x-ratelimit-limit-tokens": "300000",
+            "x-ratelimit-remaining-requests": "9999",
+            "x-ratelimit-remaining-tokens": "1000",
+        },
+    )
+    info = scheduler.info()["models"]["gpt-4"]
+    assert info["requests_left"] == 9999
+    assert 1000 <= info["tokens_left"] < 1100
+    # A request larger than the tokens left waits for the refill, 5000 tokens per second.
+    start = time.monotonic()
+    scheduler.acquire("gpt-4", tokens_num=1500)
+    assert 0.05 < time.monotonic() - start < 1
+
+
+def test_request_scheduler_headers_raise_budget():
+    scheduler = RequestScheduler(default_rpm=500, default_tpm=30000)
+    scheduler.acquire("gpt-4", tokens_num=1000)
+    # A large prompt uses up the rest of the bucket by our own estimate.
+    scheduler.acquire("gpt-4", tokens_num=29000)
+    assert scheduler.info()["models"]["gpt-4"]["tokens_left"] < 10
+    # It is answered, the server has more budget left, less the first request which is still in flight.
+    scheduler.settle(
+        "gpt-4",
+        tokens_num=29000,
+        headers={"x-ratelimit-limit-tokens": "300000", "x-ratelimit-remaining-tokens": "250000"},
+    )
+    assert 249000 <= scheduler.info()["models"]["gpt-4"]["tokens_left"] < 249100
+    start = time.monotonic()
+    scheduler.acquire("gpt-4", tokens_num=100000)
+    assert time.monotonic() - start < 0.05
+
+
+def test_estimate_tokens_num_tools_version(monkeypatch):
+    from gptui.models import request_scheduler as request_scheduler_module
+
+    versions = []
+    monkeypatch.setattr(request_scheduler_module, "tokens_num_from_chat_context", lambda messages, model: 10)
+    monkeypatch.setattr(
+        request_scheduler_module,
+        "tokens_num_for_functions_call",
+        lambda tools, model, version=None: versions.append(version) or 5,
+    )
+    request = {"model": "gpt-4", "messages": [{"role": "user", "content": "Hi"}], "tools": [{"type": "function"}], "max_tokens": 100}
+    assert request_scheduler_module.estimate_tokens_num(request, tools_version=7) == 115
+    # The tokens num of the schema is cached by its version.
+    assert versions == [7]
+
+
+def test_request_scheduler_retry():
+    scheduler = RequestScheduler(max_retries=2, base_delay=0.01)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) == 1:
+            raise rate_limit_error({"retry-after-ms": "10"})
+        if len(calls) == 2:
+            raise openai.APITimeoutError(request=httpx.Request("POST", "https://api.openai.com"))
+        return "done"
+
+    assert scheduler.call(flaky, model="gpt-4", tokens_num=10) == "done"
+    assert scheduler.retries == 2
+
+    calls.clear()
+    scheduler = RequestScheduler(max_retries=1, base_delay=0.01)
+    with pytest.raises(openai.APITimeoutError):
+        scheduler.call(flaky, model="gpt-4", tokens_num=10)
+    assert len(calls) == 2
+
+    def bad_request():
+        raise ValueError("not transient")
+
+    with pytest.raises(ValueError):
+        scheduler.call(bad_request, model="gpt-4")
+
+
+async def test_request_scheduler_async_call():
+    scheduler = RequestScheduler(max_retries=1, base_delay=0.01)
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) == 1:
+            raise rate_limit_error({"retry-after": "0.01", "x-ratelimit-limit-requests": "3"})
+        return "done"
+
+    assert await scheduler.async_call(flaky, model="gpt-4", tokens_num=10, priority=RequestPriority.BACKGROUND) == "done"
+    assert scheduler.info()["models"]["gpt-4"]["requests_left"] <= 3
+
+
+def test_request_scheduler_is_the_only_retry_layer(byte_encoding):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(500, json={"error": {"message": "Server error", "type": "server_error"}})
+
+    client = openai.OpenAI(api_key="fake", http_client=httpx.Client(transport=httpx.MockTransport(handler)))
+    scheduler = RequestScheduler(max_retries=1, base_delay=0.01)
+    with pytest.raises(openai.InternalServerError):
+        scheduler.chat_completions_create(client, model="gpt-4", messages=[{"role": "user", "content": "Hi!"}])
+    # One retry by the scheduler, none by the client.
+    assert len(requests) == 2
+    assert scheduler.retries == 1
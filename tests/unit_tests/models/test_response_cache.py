@@ -0,0 +1,84 @@
+import os
+
+from openai.types.chat import ChatCompletionChunk
+
+from gptui.models.response_cache import ResponseCache
+
+
+def make_chunks(contents: list[str]) -> list[ChatCompletionChunk]:
+    chunks = []
+    for i, content in enumerate(contents):
+        chunks.append(
+            ChatCompletionChunk.construct(
+                **{
+                    "id": "chatcmpl",
+                    "object": "chat.completion.chunk",
+                    "created": 0,
+                    "model": "gpt-4",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "delta": {"content": content},
+                            "finish_reason": "stop" if i == len(contents) - 1 else None,
+                        }
+                    ],
+                }
+            )
+        )
+    return [ChatCompletionChunk.parse_obj(chunk.model_dump()) for chunk in chunks]
+
+
+def test_response_cache_chat_completion(tmp_path):
+    cache = ResponseCache(path=str(tmp_path), enable=True, call_sites={"chat": True})
+    request = {"model": "gpt-4", "messages": [{"role": "user", "content": "Hi!"}], "stream": True, "temperature": 0}
+    assert cache.load_chat_completion("chat", request) is None
+
+    recorded = cache.record_chat_completion("chat", request, iter(make_chunks(["Hello", "!"])))
+    assert [chunk.choices[0].delta.content for chunk in recorded] == ["Hello", "!"]
+    replayed = cache.load_chat_completion("chat", dict(request, timeout=20.0))
+    assert [chunk.choices[0].delta.content for chunk in replayed] == ["Hello", "!"]
+    assert cache.info()["hits"] == 1
+
+    # Other sampling parameters, sites which are not enabled and non-deterministic requests miss.
+    assert cache.load_chat_completion("chat", dict(request, top_p=0.5)) is None
+    assert cache.load_chat_completion("group_talk", request) is None
+    sampled_request = dict(request, temperature=1)
+    assert cache.record_chat_completion("chat", sampled_request, "response") == "response"
+
+    # An interrupted stream is not cached.
+    other_request = dict(request, messages=[{"role": "user", "content": "Bye!"}])
+    recorded = cache.record_chat_completion("chat", other_request, iter(make_chunks(["Bye", "!"])))
+    next(iter(recorded))
+    assert cache.load_chat_completion("chat", other_request) is None
+
+
+async def test_response_cache_async_stream(tmp_path):
+    cache = ResponseCache(path=str(tmp_path), enable=True, call_sites={"chat": True})
+    request = {"model": "gpt-4", "messages": [{"role": "user", "content": "Hi!"}], "stream": True, "temperature": 0}
+
+    async def response():
+        for chunk in make_chunks(["Hello", "!"]):
+            yield chunk
+
+    recorded = cache.record_chat_completion("chat", request, response())
+    assert [chunk.choices[0].delta.content async for chunk in recorded] == ["Hello", "!"]
+    replayed = cache.load_chat_completion("chat", request, async_stream=True)
+    assert [chunk.choices[0].delta.content async for chunk in replayed] == ["Hello", "!"]
+
+
+def test_response_cache_eviction(tmp_path):
+    cache = ResponseCache(path=str(tmp_path), enable=True, max_size_mb=0.001, call_sites={"conversation_title": True})
+    for i in range(4):
+        cache.put("conversation_title", {"input": i}, "text", "x" * 300)
+    # Reading the first entry makes the second one the least recently used.
+    cache.get("conversation_title", {"input": 1})
+    cache.put("conversation_title", {"input": 4}, "text", "x" * 300)
+    assert cache.get("conversation_title", {"input": 1}) == ("text", "x" * 300)
+    assert cache.get("conversation_title", {"input": 2}) is None
+    assert sum(os.path.getsize(entry.path) for entry in os.scandir(tmp_path)) <= 1024 * 1.05
+
+    # The index is rebuilt from the disk.
+    reloaded = ResponseCache(path=str(tmp_path), enable=True, call_sites={"conversation_title": True})
+    assert reloaded.get("conversation_title", {"input": 4}) == ("text", "x" * 300)
+    reloaded.clear()
+    assert not os.listdir(tmp_path)
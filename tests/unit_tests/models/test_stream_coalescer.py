@@ -0,0 +1,51 @@
+import asyncio
+
+from gptui.models.stream_coalescer import StreamFlushPolicy, is_sentence_boundary
+
+
+async def deltas(items, delay: float = 0.0):
+    for item in items:
+        if delay:
+            await asyncio.sleep(delay)
+        yield item
+
+
+async def collect(batches):
+    return [batch async for batch in batches]
+
+
+async def test_stream_coalescer_batches():
+    policy = StreamFlushPolicy(interval_ms=1000, max_chars=6)
+    batches = await collect(policy.coalesce(deltas(["ab", "cd", "ef", "g", "h."])))
+    assert batches == [["ab", "cd", "ef"], ["g", "h."]]
+
+    # The sentence boundary flushes only when it is asked for.
+    batches = await collect(policy.coalesce(deltas(["a", ".", "b"]), boundary=is_sentence_boundary))
+    assert batches == [["a", "."], ["b"]]
+    policy.configure(interval_ms=1000, max_chars=6, sentence_flush=False)
+    batches = await collect(policy.coalesce(deltas(["a", ".", "b"]), boundary=is_sentence_boundary))
+    assert batches == [["a", ".", "b"]]
+
+    policy.configure(enable=False)
+    assert await collect(policy.coalesce(deltas(["a", "b"]))) == [["a"], ["b"]]
+
+
+async def test_stream_coalescer_flushes_on_time():
+    # The batch is flushed at its deadline while the next delta is late, and the late delta is not lost.
+    policy = StreamFlushPolicy(interval_ms=20, max_chars=1000)
+
+    async def source():
+        yield "a"
+        yield "b"
+        await asyncio.sleep(0.2)
+        yield "c"
+
+    batches = []
+    async for batch in policy.coalesce(source()):
+        batches.append(batch)
+    assert batches == [["a", "b"], ["c"]]
+
+    # Deltas faster than the interval are grouped.
+    batches = await collect(policy.coalesce(deltas(["x"] * 20, delay=0.005)))
+    assert sum(batches, []) == ["x"] * 20
+    assert len(batches) < 20
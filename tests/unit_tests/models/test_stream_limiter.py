@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from gptui.models.stream_limiter import AsyncLimitedStream, StreamLimiter
+
+
+async def test_stream_limiter_round_robin():
+    limiter = StreamLimiter(max_streams=1, max_streams_per_conversation=0)
+    first = await limiter.async_acquire("group_talk")
+    order = []
+
+    async def stream(key, name):
+        slot = await limiter.async_acquire(key)
+        order.append(name)
+        await asyncio.sleep(0)
+        slot.release()
+
+    # A group talk queues three streams before the user's conversation queues one.
+    tasks = [asyncio.create_task(stream("group_talk", f"role_{i}")) for i in range(3)]
+    await asyncio.sleep(0)
+    tasks.append(asyncio.create_task(stream(1, "user")))
+    await asyncio.sleep(0)
+    assert limiter.info()["waiting"] == 4
+    first.release()
+    await asyncio.gather(*tasks)
+    assert order == ["role_0", "user", "role_1", "role_2"]
+    assert limiter.info()["active"] == 0
+    assert limiter.info()["waited"] == 4
+
+
+async def test_stream_limiter_per_conversation():
+    limiter = StreamLimiter(max_streams=4, max_streams_per_conversation=2)
+    slots = [await limiter.async_acquire("group_talk") for _ in range(2)]
+    waiting = asyncio.create_task(limiter.async_acquire("group_talk"))
+    # Other conversations still get slots.
+    other = await asyncio.wait_for(limiter.async_acquire(1), timeout=1)
+    await asyncio.sleep(0)
+    assert not waiting.done()
+    slots[0].release()
+    slots[0].release()  # Releasing twice is harmless.
+    third = await asyncio.wait_for(waiting, timeout=1)
+    assert limiter.info()["active"] == 3
+    for slot in (slots[1], other, third):
+        slot.release()
+    assert limiter.info()["active"] == 0
+
+    # A cancelled waiter leaves the queue.
+    slots = [await limiter.async_acquire("group_talk") for _ in range(2)]
+    waiting = asyncio.create_task(limiter.async_acquire("group_talk"))
+    await asyncio.sleep(0)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert limiter.info()["waiting"] == 0
+    with pytest.raises(TimeoutError):
+        limiter.acquire("group_talk", timeout=0.01)
+    assert limiter.info()["waiting"] == 0
+
+
+async def test_stream_limiter_streams():
+    limiter = StreamLimiter(max_streams=1)
+
+    # A sync stream holds its slot until it is exhausted.
+    stream = limiter.open_stream(1, lambda: iter(["a", "b"]))
+    assert limiter.info()["active"] == 1
+    assert list(stream) == ["a", "b"]
+    assert limiter.info()["active"] == 0
+
+    # The slot is released if the stream can not be opened.
+    def fail():
+        raise ValueError("request failed")
+
+    with pytest.raises(ValueError):
+        limiter.open_stream(1, fail)
+    assert limiter.info()["active"] == 0
+
+    async def open_async_stream():
+        async def chunks():
+            yield "c"
+        return chunks()
+
+    async_stream = await limiter.async_open_stream(1, open_async_stream)
+    assert isinstance(async_stream, AsyncLimitedStream)
+    assert [chunk async for chunk in async_stream] == ["c"]
+
+    # A lazy stream does not take a slot before it is iterated.
+    opened = []
+
+    def open_lazy():
+        opened.append(1)
+        return ["d", "e"]
+
+    lazy_stream = limiter.lazy_stream(2, open_lazy)
+    assert limiter.info()["active"] == 0 and not opened
+    assert [chunk async for chunk in lazy_stream] == ["d", "e"]
+    assert limiter.info()["active"] == 0
@@ -0,0 +1,120 @@
+import asyncio
+import time
+
+import pytest
+from openai import OpenAI
+from openai.types.chat import ChatCompletionChunk
+
+from gptui.benchmark.fake_openai_server import FakeOpenAIServer, FakeServerOptions
+from gptui.models.request_scheduler import RequestScheduler
+from gptui.models.stream_timeout import (
+    CONTINUE_PROMPT,
+    AsyncGuardedStream,
+    GuardedStream,
+    StreamStalledError,
+    StreamTimeoutPolicy,
+    StreamTimeouts,
+    stream_timeout_policy,
+)
+
+
+def chunk(content: str | None = None, finish_reason: str | None = None, tool_call: bool = False) -> ChatCompletionChunk:
+    delta = {"content": content}
+    if tool_call:
+        delta["tool_calls"] = [{"index": 0, "id": "call_0", "type": "function", "function": {"name": "f", "arguments": ""}}]
+    return ChatCompletionChunk.parse_obj(
+        {
+            "id": "chatcmpl",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "gpt-4",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+    )
+
+
+def stalling(chunks: list, stall: float = 1.0):
+    yield from chunks
+    time.sleep(stall)
+    yield chunk(" late")
+
+
+def test_stream_timeout_policy():
+    policy = StreamTimeoutPolicy(default={"connect": 3, "idle": 10}, call_sites={"ai_care": {"first_token": 30, "unknown": 1}})
+    assert policy.timeouts("chat") == StreamTimeouts(connect=3, first_token=60.0, idle=10)
+    assert policy.timeouts("ai_care") == StreamTimeouts(connect=3, first_token=30, idle=10)
+    assert policy.timeouts(None).httpx_timeout().read == 60.0
+
+
+def test_guarded_stream_continues_stalled_stream():
+    requests = []
+
+    def reopen(messages):
+        requests.append(messages)
+        return iter([chunk("", None), chunk(" world"), chunk(None, "stop")]), time.monotonic()
+
+    messages = [{"role": "user", "content": "Hi!"}]
+    stream = GuardedStream(stalling([chunk("Hello")]), reopen, messages, StreamTimeouts(first_token=1, idle=0.05))
+    contents = [c.choices[0].delta.content for c in stream]
+    # The text received before the stall is not repeated.
+    assert contents == ["Hello", "", " world", None]
+    assert requests == [messages + [{"role": "assistant", "content": "Hello"}, {"role": "user", "content": CONTINUE_PROMPT}]]
+
+    # Nothing within the first token timeout, the request is sent again as it is.
+    requests.clear()
+    stream = GuardedStream(stalling([]), reopen, messages, StreamTimeouts(first_token=0.05, idle=1))
+    assert [c.choices[0].delta.content for c in stream] == ["", " world", None]
+    assert requests == [messages]
+
+
+def test_guarded_stream_gives_up():
+    def reopen(messages):
+        return stalling([chunk("again")]), time.monotonic()
+
+    timeouts = StreamTimeouts(first_token=1, idle=0.05)
+    stream = GuardedStream(stalling([chunk("Hello")]), reopen, [], timeouts, max_retries=1)
+    with pytest.raises(StreamStalledError):
+        list(stream)
+    # A stream of tool calls is not continued.
+    stream = GuardedStream(stalling([chunk(tool_call=True)]), reopen, [], timeouts, max_retries=1)
+    with pytest.raises(StreamStalledError):
+        list(stream)
+    # A stream which has finished is not continued.
+    stream = GuardedStream(stalling([chunk("Hi", "stop")]), reopen, [], timeouts)
+    assert len(list(stream)) == 1
+
+
+async def test_async_guarded_stream():
+    async def async_stalling(chunks):
+        for c in chunks:
+            yield c
+        await asyncio.sleep(1)
+        yield chunk(" late")
+
+    async def reopen(messages):
+        async def chunks():
+            yield chunk(" world")
+            yield chunk(None, "stop")
+        return chunks(), time.monotonic()
+
+    stream = AsyncGuardedStream(async_stalling([chunk("Hello")]), reopen, [], StreamTimeouts(first_token=1, idle=0.05))
+    assert [c.choices[0].delta.content async for c in stream] == ["Hello", " world", None]
+
+
+def test_stalled_stream_is_continued_through_the_scheduler(byte_encoding):
+    options = FakeServerOptions(completion_tokens=20, stalls=1, stall_after=5, stall_seconds=2)
+    stream_timeout_policy.configure(default={"idle": 0.2})
+    try:
+        with FakeOpenAIServer(options) as server:
+            client = OpenAI(api_key="fake", base_url=server.base_url)
+            messages = [{"role": "user", "content": "Hi!"}]
+            stream = RequestScheduler().chat_completions_create(client, call_site="chat", model="gpt-4", messages=messages, stream=True)
+            chunks = list(stream)
+    finally:
+        stream_timeout_policy.configure()
+    assert chunks[-1].choices[0].finish_reason == "stop"
+    first_part = "".join(chunk.choices[0].delta.content or "" for chunk in chunks[:5])
+    assert server.requests[1]["body"]["messages"] == messages + [
+        {"role": "assistant", "content": first_part},
+        {"role": "user", "content": CONTINUE_PROMPT},
+    ]
@@ -0,0 +1,49 @@
+from gptui.models.utils.tokens_num import (
+    TokensNumCache,
+    tokenizer_registry,
+    tokens_num_cache,
+    tokens_num_for_functions_call,
+    tokens_num_from_chat_context,
+    tokens_num_from_string,
+)
+
+
+def test_tokens_num_from_string(byte_encoding):
+    assert tokens_num_from_string("hello", model="gpt-4") == 5
+    assert tokens_num_from_string("hello", model="gpt-4") == 5
+    assert tokens_num_cache.info()["hits"] == 1
+    assert tokenizer_registry.encoding_for_model("gpt-4") is byte_encoding
+
+
+def test_tokens_num_from_chat_context(byte_encoding):
+    messages = [{"role": "user", "content": "Hi!"}, {"role": "user", "name": "abc", "content": "Hi!"}]
+    # 3 + len("user") + len("Hi!") for the first message, plus len("abc") + 1 for the named one, plus 3 for the reply.
+    assert tokens_num_from_chat_context(messages, model="gpt-4") == 10 + 14 + 3
+    assert tokens_num_from_chat_context(messages, model="gpt-4") == 27
+
+
+def test_tokens_num_cache_is_bounded(byte_encoding):
+    cache = TokensNumCache(maxsize=2)
+    assert cache.tokens_num("a", byte_encoding) == 1
+    assert cache.tokens_num("bb", byte_encoding) == 2
+    assert cache.tokens_num("a", byte_encoding) == 1
+    assert cache.tokens_num("ccc", byte_encoding) == 3
+    info = cache.info()
+    assert info["size"] == 2
+    assert info["hits"] == 1
+    # "bb" is the least recently used one and has been evicted.
+    cache.tokens_num("bb", byte_encoding)
+    assert cache.info()["misses"] == 4
+
+
+def test_tokens_num_for_functions_call_cached_by_version(byte_encoding):
+    functions = [{"type": "function", "function": {"name": "f", "parameters": {}}}]
+    tokens_num = tokens_num_for_functions_call(functions, model="gpt-4", version=1)
+    assert tokens_num == len(repr(functions))
+    misses = tokens_num_cache.info()["misses"]
+    hits = tokens_num_cache.info()["hits"]
+    # The schema is not serialized or looked up again for the same version.
+    assert tokens_num_for_functions_call(functions, model="gpt-4", version=1) == tokens_num
+    assert tokens_num_cache.info()["misses"] == misses and tokens_num_cache.info()["hits"] == hits
+    functions.append({"type": "function", "function": {"name": "g", "parameters": {}}})
+    assert tokens_num_for_functions_call(functions, model="gpt-4", version=2) == len(repr(functions))
@@ -0,0 +1,73 @@
+import random
+
+from gptui.models.context import OpenaiContext
+from gptui.models.openai_tokens_truncate import find_position
+from gptui.models.utils.tokens_num_index import ChainedTokensNumIndex, TokensNumIndex
+
+
+def test_suffix_position_matches_find_position():
+    rng = random.Random(0)
+    for _ in range(200):
+        lst = [rng.randint(0, 20) for _ in range(rng.randint(0, 30))]
+        index = TokensNumIndex(lst)
+        for num in range(-2, sum(lst) + 3):
+            assert index.suffix_position(num) == find_position(lst, num)
+
+
+def test_tokens_num_index_operations():
+    rng = random.Random(1)
+    index = TokensNumIndex()
+    reference = []
+    for _ in range(500):
+        operation = rng.choice(["append", "extend", "insert", "pop"])
+        if operation == "append":
+            value = rng.randint(0, 50)
+            index.append(value)
+            reference.append(value)
+        elif operation == "extend":
+            values = [rng.randint(0, 50) for _ in range(rng.randint(0, 4))]
+            index.extend(values)
+            reference.extend(values)
+        elif operation == "insert":
+            position = rng.randint(-len(reference) - 1, len(reference) + 1)
+            value = rng.randint(0, 50)
+            index.insert(position, value)
+            reference.insert(position, value)
+        elif reference:
+            position = rng.randint(-len(reference), len(reference) - 1)
+            assert index.pop(position) == reference.pop(position)
+        assert index.values == reference
+        assert index.total == sum(reference)
+        for i in range(len(reference) + 1):
+            assert index.prefix_sum(i) == sum(reference[:i])
+        if reference:
+            start = rng.randint(0, len(reference))
+            assert index.range_sum(start) == sum(reference[start:])
+
+
+def test_openai_context_tokens_num_index(byte_encoding):
+    context = OpenaiContext(parameters={"model": "gpt-4"})
+    context.chat_context_append({"role": "user", "content": "a"})
+    context.chat_context_append({"role": "user", "content": "bb"})
+    context.chat_context_insert(0, {"role": "user", "content": "ccc"})
+    assert context.tokens_num_list == [13, 11, 12]
+    assert context.chat_context_pop(1) == {"role": "user", "content": "a"}
+    assert context.tokens_num_list == [13, 12]
+    assert context.tokens_num == 25
+
+
+def test_chained_tokens_num_index_matches_concatenation():
+    rng = random.Random(2)
+    for _ in range(200):
+        base_values = [rng.randint(0, 20) for _ in range(rng.randint(0, 15))]
+        base_length = rng.randint(0, len(base_values))
+        tail_values = [rng.randint(0, 20) for _ in range(rng.randint(0, 5))]
+        chained = ChainedTokensNumIndex(TokensNumIndex(base_values), base_length, TokensNumIndex(tail_values))
+        reference = TokensNumIndex(base_values[:base_length] + tail_values)
+        assert len(chained) == len(reference)
+        assert chained.values == reference.values
+        assert chained.total == reference.total
+        for i in range(len(reference) + 1):
+            assert chained.prefix_sum(i) == reference.prefix_sum(i)
+        for num in range(-2, reference.total + 3):
+            assert chained.suffix_position(num) == reference.suffix_position(num)
@@ -0,0 +1,43 @@
+from textual.app import App
+
+from gptui.utils.my_text import MyText as Text
+from gptui.utils.my_text import MyLines as Lines
+from gptui.views.mywidgets import MyChatWindow
+
+
+class ChatWindowApp(App):
+    def compose(self):
+        yield MyChatWindow(id="chat_region")
+
+
+async def test_chat_window_virtualized():
+    rendered = []
+
+    def renderer(piece: dict) -> Lines:
+        rendered.append(piece["content"])
+        # Three times as high as estimated.
+        return Lines([Text(f"{piece['content']} line {i}") for i in range(3 * (piece["content"].count("\n") + 1) + 12)])
+
+    pieces = [{"role": "user", "name": None, "content": f"message {i}"} for i in range(5000)]
+    app = ChatWindowApp()
+    async with app.run_test(size=(80, 24)) as pilot:
+        chat_window = app.query_one(MyChatWindow)
+        chat_window.update_messages(pieces, renderer)
+        await pilot.pause()
+        # Only the messages around the end are decorated.
+        assert 0 < len(rendered) < 20
+        assert chat_window.my_render_content.plain.splitlines()[-1] == "message 4999 line 14"
+
+        chat_window.my_scroll_offset = chat_window.my_scroll_offset._replace(y=0)
+        await pilot.pause()
+        assert chat_window.my_render_content.plain.startswith("message 0 line 0\n")
+        assert len(rendered) < 40
+
+        # The content written goes after the messages.
+        chat_window.write_lines(Lines([Text("streaming")]))
+        await pilot.pause()
+        assert chat_window.my_render_content.plain.splitlines()[-1] == "streaming"
+
+        chat_window.update_lines(Lines([Text("only")]))
+        assert chat_window.my_messages == []
+        assert chat_window.my_render_content.plain == "only\n"